@@ -0,0 +1,61 @@
+from src.translation_cache import CachedTranslator, TranslationCache
+from src.translation_server import TranslationServer, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_LATENCY
+from src.translators import BEAM_SIZE, MAX_SENTENCE_LENGTH, OnmtTranslator, HuggingfaceTranslator, set_num_threads
+
+# Standard libraries
+import argparse
+
+def _load_translator(spec: str, beam_size: int, max_length: int) -> (str, object):
+    """
+    Loads a translator from its command line spec:
+        name=onmt:path/to/model.pt[:language_code]  (language_code of the source texts, 'eng', 'enm' or 'ang')
+        name=huggingface:model_name_or_path[:task]
+    """
+    (name, backend) = spec.split('=', 1)
+    (kind, arguments) = backend.split(':', 1)
+
+    if kind == 'onmt':
+        (model_path, _, language_code) = arguments.partition(':')
+        return (name, OnmtTranslator(model_path, language_code or 'eng', beam_size = beam_size, max_length = max_length))
+
+    if kind == 'huggingface':
+        (model, _, task) = arguments.partition(':')
+        return (name, HuggingfaceTranslator(model, task or 'translation', num_beams = beam_size, max_length = max_length))
+
+    raise ValueError(f'unknown translator kind {kind!r} in {spec!r}, expected onmt or huggingface')
+
+def _serve_translations():
+    """
+    Loads the translators given on the command line and serves them until interrupted, i.e.:
+        python3 serve_translations.py kjv2bbe=onmt:models/kjv2bbe.pt ang2kjv=onmt:models/ang2kjv.pt:ang --threads 4
+    """
+    parser = argparse.ArgumentParser(description = 'Serves translation models with dynamic batching.')
+    parser.add_argument('models', nargs = '+', help = 'name=onmt:model.pt[:language_code] or name=huggingface:model[:task]')
+    parser.add_argument('--address', default = '127.0.0.1:8765', help = 'host:port, or unix:/path/to/socket')
+    parser.add_argument('--threads', type = int, default = None, help = 'number of cpu inference threads')
+    parser.add_argument('--max-batch-size', type = int, default = DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--max-latency', type = float, default = DEFAULT_MAX_LATENCY, help = 'seconds a batch waits for more texts')
+    parser.add_argument('--beam-size', type = int, default = BEAM_SIZE)
+    parser.add_argument('--max-length', type = int, default = MAX_SENTENCE_LENGTH)
+    parser.add_argument('--cache', action = 'store_true', help = 'cache the translations on disk (see src/translation_cache.py)')
+    parser.add_argument('--verbose', action = 'store_true', help = 'log every request')
+    args = parser.parse_args()
+
+    set_num_threads(args.threads)
+    translators = dict(_load_translator(spec, args.beam_size, args.max_length) for spec in args.models)
+
+    if args.cache:
+        cache = TranslationCache()
+        translators = { name: CachedTranslator(translator, cache) for (name, translator) in translators.items() }
+
+    server = TranslationServer(translators, args.address, args.max_batch_size, args.max_latency, args.verbose)
+
+    print(f"Serving {', '.join(translators)} on {args.address}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped.')
+
+if __name__ == '__main__':
+    _serve_translations()
@@ -0,0 +1,152 @@
+"""
+Columnar export of the dataset splits, as Arrow or Parquet files.
+
+Each split ('training', 'validation', 'test') becomes one file under DATA_ARROW_PATH,
+with the verse id columns (book, chapter, verse) followed by one string column per
+bible version, rows in the same order as the split text files. Files are written
+incrementally (ARROW_BATCH_SIZE rows at a time) to a temporary file, then renamed
+into place.
+
+Arrow files use the IPC stream format, the format huggingface datasets uses for its
+own cache files, so they can be memory-mapped without copying:
+
+    datasets.Dataset.from_file('data/arrow/training.arrow')
+
+Parquet files are smaller on disk, and can be loaded with:
+
+    datasets.load_dataset('parquet', data_files = { 'train': 'data/arrow/training.parquet', ... })
+
+Requires pyarrow (pip install pyarrow, also installed along with datasets).
+"""
+
+from src.paths import DATA_ARROW_PATH, ARROW_DATASET_FORMAT
+
+# Standard libraries
+import os, tempfile
+from pathlib import Path
+
+# additional libraries (pip install ...)
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+ARROW_FORMATS = ('arrow', 'parquet')
+ARROW_BATCH_SIZE = 4096
+
+# verse id columns, before the version columns
+ID_COLUMNS = ('book', 'chapter', 'verse')
+
+def get_arrow_schema(table_names: [str]) -> pyarrow.Schema:
+    return pyarrow.schema([(name, pyarrow.int32()) for name in ID_COLUMNS] + [(name, pyarrow.string()) for name in table_names])
+
+class _PendingDataset:
+    """ One split being written to a temporary file, one record batch at a time """
+
+    def __init__(self, path: Path, schema: pyarrow.Schema, format: str):
+        self.path = path
+        self.schema = schema
+        fd, self.temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+        os.close(fd)
+
+        if format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, schema)
+        else:
+            self.sink = pyarrow.OSFile(self.temp_path, 'wb')
+            self.writer = pyarrow.ipc.new_stream(self.sink, schema)
+
+        self.format = format
+        self.rows = []
+
+    def write(self, verse_id: (int, int, int), texts: [str]):
+        self.rows.append((*verse_id, *texts))
+
+        if len(self.rows) >= ARROW_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        columns = list(zip(*self.rows))
+        batch = pyarrow.record_batch([pyarrow.array(column, type = field.type) for (column, field) in zip(columns, self.schema)], schema = self.schema)
+
+        if self.format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+        self.rows = []
+
+    def close(self, commit: bool):
+        completed = False
+
+        try:
+            if commit and self.rows:
+                self.flush()
+
+            self.writer.close()
+            self.format == 'arrow' and self.sink.close()
+            completed = commit
+        finally:
+            if completed:
+                os.replace(self.temp_path, self.path)
+            else:
+                os.unlink(self.temp_path)
+
+class ArrowDatasetWriter:
+    """
+    Writes the dataset splits as Arrow or Parquet files one verse at a time (see the module
+    docstring). Files replace the previous ones on close; an exception inside a with block
+    leaves the previous files untouched.
+
+    Arguments:
+        table_names {[str]} -- names of the bible version tables, in the order of the texts
+
+    Keyword Arguments:
+        format {str} -- 'arrow' or 'parquet' (default: {'arrow'})
+        directory {Path} -- where the files are written (default: {DATA_ARROW_PATH})
+
+    Example usage:
+        with ArrowDatasetWriter(['t_asv', 't_bbe']) as writer:
+            writer.write('training', (1, 1, 1), ['In the beginning God created the heavens and the earth.', ...])
+    """
+
+    def __init__(self, table_names: [str], format: str = 'arrow', directory: Path = DATA_ARROW_PATH):
+        self.schema = get_arrow_schema(table_names)
+        self.format = format
+        self.directory = directory
+        self.datasets = {}
+
+        directory.mkdir(parents = True, exist_ok = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(commit = exc_type is None)
+
+    def add_dataset(self, dataset: str):
+        """ Adds a (so far empty) split, if it wasn't added yet """
+        if dataset not in self.datasets:
+            path = self.directory / ARROW_DATASET_FORMAT.format(dataset = dataset, format = self.format)
+            self.datasets[dataset] = _PendingDataset(path, self.schema, self.format)
+
+    def write(self, dataset: str, verse_id: (int, int, int), texts: [str]):
+        """ Appends one verse (its id, and one text per table) to a split """
+        self.add_dataset(dataset)
+        self.datasets[dataset].write(verse_id, texts)
+
+    def close(self, commit: bool = True):
+        for pending in self.datasets.values():
+            pending.close(commit)
+
+        self.datasets = {}
+
+def load_arrow_dataset(dataset: str, format: str = 'arrow', directory: Path = DATA_ARROW_PATH) -> pyarrow.Table:
+    """
+    Loads one exported split as a pyarrow Table. Arrow files are memory-mapped, so no
+    data is copied or decoded until it is accessed.
+    """
+    path = directory / ARROW_DATASET_FORMAT.format(dataset = dataset, format = format)
+
+    if format == 'parquet':
+        return pyarrow.parquet.read_table(path, memory_map = True)
+
+    return pyarrow.ipc.open_stream(pyarrow.memory_map(str(path))).read_all()
@@ -0,0 +1,177 @@
+"""
+Length-bucketed batching of verse pairs.
+
+Verses range from a single word to over 80, so random batches spend much of their
+compute on padding. LengthBucketSampler groups verse pairs of similar length: each
+epoch, the verses are sorted by length (ties broken randomly), cut into batches that
+fit a max_tokens budget (batch size * longest source or target in the batch), and the
+batches are shuffled. Every batch holds verses of similar length, but the order of the
+batches is still random.
+
+The sampler yields lists of indexes, so it can be used directly as the batch_sampler
+of a torch DataLoader, in our own training loops or in a huggingface Trainer (see
+get_bucketed_dataloader).
+"""
+
+from src.preprocess import count_words
+
+# Standard libraries
+import random
+from typing import Callable
+
+# additional libraries (pip install ...)
+import numpy
+
+class LengthBucketSampler:
+    """
+    Arguments:
+        source_lengths {[int]} -- length (in words or tokens) of each source verse
+        target_lengths {[int]} -- length of each target verse, in the same order
+
+    Keyword Arguments:
+        max_tokens {int} -- maximum number of (padded) source or target tokens per batch (default: {4096})
+        max_batch_size {int or None} -- maximum number of verses per batch, None for no maximum (default: {None})
+        shuffle {bool} -- whether to break length ties randomly and shuffle the batch order (default: {True})
+        seed {int or None} -- seed of the shuffle, combined with the epoch (see set_epoch),
+                              None for the global random state (default: {None})
+        drop_last {bool} -- whether to drop the batch holding the longest verses if it is
+                            smaller than the others (default: {False})
+
+    Example usage:
+        sampler = LengthBucketSampler.from_datasets(datasets['training'], 't_bbe', 't_kjv', max_tokens = 2048, seed = 1)
+        loader = torch.utils.data.DataLoader(dataset, batch_sampler = sampler, collate_fn = collate)
+    """
+
+    def __init__(self, source_lengths: [int], target_lengths: [int], max_tokens: int = 4096, max_batch_size: int or None = None, shuffle: bool = True, seed: int or None = None, drop_last: bool = False):
+        self.source_lengths = numpy.asarray(source_lengths, dtype = numpy.int64)
+        self.target_lengths = numpy.asarray(target_lengths, dtype = numpy.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches = None
+
+    @classmethod
+    def from_datasets(cls, dataset: {str: [str]}, source_table: str, target_table: str, length_function: Callable[[str], int] = count_words, **kwargs) -> 'LengthBucketSampler':
+        """
+        Builds a sampler over one dataset of a create_datasets or load_datasets result,
+        i.e. datasets['training'], measuring verse lengths with length_function (words by default).
+        """
+        return cls([length_function(text) for text in dataset[source_table]], [length_function(text) for text in dataset[target_table]], **kwargs)
+
+    @classmethod
+    def from_tokenized(cls, dataset: {str: 'TokenizedVerses'}, source_table: str, target_table: str, **kwargs) -> 'LengthBucketSampler':
+        """
+        Builds a sampler over one dataset of a load_tokenized_datasets result, measuring verse
+        lengths in tokens (read from the offset arrays, without touching the tokens).
+        """
+        return cls(dataset[source_table].lengths(), dataset[target_table].lengths(), **kwargs)
+
+    def set_epoch(self, epoch: int):
+        """ Changes the shuffle of the next iterations (with a seed, each epoch gets its own shuffle) """
+        self.epoch = epoch
+        self._batches = None
+
+    def _get_rng(self) -> random.Random:
+        return random if self.seed is None else random.Random(f'{self.seed}:{self.epoch}')
+
+    def get_batches(self) -> [[int]]:
+        """ The batches of the current epoch, as lists of verse indexes """
+        if self._batches is not None:
+            return self._batches
+
+        rng = self._get_rng()
+        lengths = numpy.maximum(self.source_lengths, self.target_lengths)
+        tie_breaks = [rng.random() for _ in range(len(lengths))] if self.shuffle else numpy.arange(len(lengths))
+        order = numpy.lexsort((tie_breaks, lengths))
+
+        batches = []
+        batch = []
+
+        # lengths only grow along the order, so the verse being added is always the longest of its batch
+        for index in order.tolist():
+            length = max(int(lengths[index]), 1)
+
+            if batch and ((len(batch) + 1) * length > self.max_tokens or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch = []
+
+            batch.append(index)
+
+        if batch and not (self.drop_last and batches and len(batch) < len(batches[-1])):
+            batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches()
+
+        # a new shuffle for the next iteration, unless set_epoch is called explicitly
+        self.epoch += 1
+        self._batches = None
+
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self.get_batches())
+
+    def padding_stats(self, batches: [[int]] or None = None) -> {str: float}:
+        """
+        Padding efficiency of the batches (by default, those of the current epoch), along with the
+        efficiency of random batches of the same sizes for comparison. Efficiency is the fraction
+        of the padded source and target tokens that are actual tokens.
+
+        Example return:
+            { 'num_batches': 236, 'mean_batch_size': 63.2, 'tokens': 601234, 'padded_tokens': 642345,
+              'efficiency': 0.936, 'random_efficiency': 0.512 }
+        """
+        batches = batches if batches is not None else self.get_batches()
+        sizes = [len(batch) for batch in batches]
+
+        def get_padded_tokens(batches: [[int]]) -> int:
+            return sum(len(batch) * (int(self.source_lengths[batch].max()) + int(self.target_lengths[batch].max())) for batch in batches if len(batch) > 0)
+
+        tokens = sum(int(self.source_lengths[batch].sum()) + int(self.target_lengths[batch].sum()) for batch in batches if len(batch) > 0)
+        padded_tokens = get_padded_tokens(batches)
+
+        # the same batch sizes, over a random permutation of the same verses
+        permutation = numpy.random.default_rng(0).permutation(numpy.concatenate(batches) if batches else [])
+        random_batches = numpy.split(permutation, numpy.cumsum(sizes)[:-1]) if batches else []
+        random_padded_tokens = get_padded_tokens(random_batches)
+
+        return {
+            'num_batches': len(batches),
+            'mean_batch_size': sum(sizes) / len(batches) if batches else 0.,
+            'tokens': tokens,
+            'padded_tokens': padded_tokens,
+            'efficiency': tokens / padded_tokens if padded_tokens else 1.,
+            'random_efficiency': tokens / random_padded_tokens if random_padded_tokens else 1.
+        }
+
+def get_bucketed_dataloader(dataset, sampler: LengthBucketSampler, collate_fn: Callable or None = None, **kwargs):
+    """
+    Returns a torch DataLoader over dataset (anything indexable in the sampler's verse order)
+    drawing its batches from sampler. Pad batches to their longest verse (not a fixed maximum)
+    in collate_fn to benefit from the bucketing.
+
+    To use it in a huggingface Trainer (i.e. the Seq2SeqTrainer of the BART notebook), override
+    get_train_dataloader:
+
+        class BucketedSeq2SeqTrainer(Seq2SeqTrainer):
+            def get_train_dataloader(self):
+                return get_bucketed_dataloader(self.train_dataset, sampler, self.data_collator)
+
+    Keyword Arguments:
+        collate_fn {Callable or None} -- merges a list of dataset items into a batch (default: {None})
+        **kwargs -- other DataLoader arguments, i.e. num_workers
+    """
+    # torch is only required for training
+    from torch.utils.data import DataLoader
+
+    return DataLoader(dataset, batch_sampler = sampler, collate_fn = collate_fn, **kwargs)
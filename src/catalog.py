@@ -0,0 +1,142 @@
+"""
+Load-once catalog of the metadata key files (bible versions, books, genres,
+book abbreviations and miscellaneous texts), with indexed lookups.
+
+Use get_catalog() rather than constructing a Catalog directly: it keeps a single
+catalog per process and reloads it only when one of the key files changes.
+"""
+
+from src.paths import TABLE_KEY_PATH, KEY_ENGLISH_PATH, KEY_GENRE_ENGLISH_PATH, KEY_ABBREVIATIONS_ENGLISH_PATH, MISC_TEXTS_KEY_PATH
+from src.csv_keys import BOOK_KEY, TESTAMENT_KEY, GENRE_KEY, NAME_KEY, DATASET_KEY, ID_KEY
+
+# Standard libraries
+import csv, os
+from collections import defaultdict
+from pathlib import Path
+
+KEY_FILE_PATHS = (TABLE_KEY_PATH, KEY_ENGLISH_PATH, KEY_GENRE_ENGLISH_PATH, KEY_ABBREVIATIONS_ENGLISH_PATH, MISC_TEXTS_KEY_PATH)
+
+# key_abbreviations_english.csv header names
+ABBREVIATION_KEY = 'a'
+
+def _read_csv(path: Path) -> [dict]:
+    with open(path, 'r', encoding = 'utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader)
+
+        return [{k: line[i] for (i, k) in enumerate(headers)} for line in reader]
+
+def _get_file_signatures() -> tuple:
+    """ (mtime, size) of every key file, used to detect changes """
+    signatures = []
+
+    for path in KEY_FILE_PATHS:
+        try:
+            stat = os.stat(path)
+            signatures.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signatures.append(None)
+
+    return tuple(signatures)
+
+class Catalog:
+    """
+    All of the key file contents, parsed once and indexed.
+
+    Attributes:
+        versions {[dict]} -- bible versions in t_key.csv order (see data_manager.get_bible_versions)
+        versions_by_id {int: dict} -- bible versions by id
+        versions_by_table {str: dict} -- bible versions by table (file) name
+        genres {int: str} -- genre names by genre id
+        books {int: dict} -- book details by book id (see data_manager.get_bible_books)
+        book_ids_by_name {str: int} -- book ids by lowercase book name
+        book_ids_by_abbreviation {str: int} -- book ids by lowercase book abbreviation
+        book_ids_by_testament {str: [int]} -- sorted book ids by testament label ('OT' or 'NT')
+        book_ids_by_genre {int: [int]} -- sorted book ids by genre id
+        book_ids_by_dataset {str: [int]} -- sorted book ids by dataset split ('train' or 'test')
+        misc_texts {[dict]} -- miscellaneous texts in misc_texts/t_key.csv order
+    """
+
+    def __init__(self):
+        self.signatures = _get_file_signatures()
+
+        self.versions = _read_csv(TABLE_KEY_PATH)
+        for version in self.versions:
+            version['id'] = int(version['id'])
+
+        self.versions_by_id = { version['id']: version for version in self.versions }
+        self.versions_by_table = { version['table']: version for version in self.versions }
+
+        self.genres = { int(genre[GENRE_KEY]): genre[NAME_KEY] for genre in _read_csv(KEY_GENRE_ENGLISH_PATH) }
+
+        self.books = {
+            int(book[BOOK_KEY]): {
+                'name': book[NAME_KEY],
+                'testament': book[TESTAMENT_KEY],
+                'genre_id': int(book[GENRE_KEY]),
+                'genre': self.genres[int(book[GENRE_KEY])],
+                'dataset': book[DATASET_KEY]
+            } for book in _read_csv(KEY_ENGLISH_PATH)
+        }
+
+        self.book_ids_by_name = { book['name'].lower(): book_id for (book_id, book) in self.books.items() }
+        self.book_ids_by_abbreviation = {
+            abbreviation[ABBREVIATION_KEY].lower(): int(abbreviation[BOOK_KEY])
+            for abbreviation in _read_csv(KEY_ABBREVIATIONS_ENGLISH_PATH)
+        }
+
+        self.book_ids_by_testament = defaultdict(list)
+        self.book_ids_by_genre = defaultdict(list)
+        self.book_ids_by_dataset = defaultdict(list)
+
+        for (book_id, book) in sorted(self.books.items()):
+            self.book_ids_by_testament[book['testament']].append(book_id)
+            self.book_ids_by_genre[book['genre_id']].append(book_id)
+            self.book_ids_by_dataset[book['dataset']].append(book_id)
+
+        self.misc_texts = _read_csv(MISC_TEXTS_KEY_PATH) if MISC_TEXTS_KEY_PATH.exists() else []
+        for text in self.misc_texts:
+            text[ID_KEY] = int(text[ID_KEY])
+
+    def is_stale(self) -> bool:
+        """ Whether any of the key files changed since this catalog was loaded """
+        return self.signatures != _get_file_signatures()
+
+    def get_book_id(self, name: str) -> int or None:
+        """
+        Looks up a book id by name or abbreviation (case insensitive), i.e.
+        'Genesis', 'genesis', 'Gen' and 'Gn' all return 1.
+        """
+        name = name.lower()
+        return self.book_ids_by_name.get(name, self.book_ids_by_abbreviation.get(name))
+
+    def get_book_ids(self, testament: str or None = None, genre_id: int or None = None, dataset: str or None = None) -> [int]:
+        """
+        Returns the sorted ids of the books matching all of the given criteria.
+
+        Keyword Arguments:
+            testament {str or None} -- testament label, 'OT' or 'NT' (default: {None})
+            genre_id {int or None} -- genre id (default: {None})
+            dataset {str or None} -- dataset split, 'train' or 'test' (default: {None})
+        """
+        book_ids = set(self.books)
+
+        testament is not None and book_ids.intersection_update(self.book_ids_by_testament.get(testament, []))
+        genre_id is not None and book_ids.intersection_update(self.book_ids_by_genre.get(genre_id, []))
+        dataset is not None and book_ids.intersection_update(self.book_ids_by_dataset.get(dataset, []))
+
+        return sorted(book_ids)
+
+_catalog = None
+
+def get_catalog() -> Catalog:
+    """
+    Returns the process-wide catalog, (re)loading it if it was never loaded
+    or if any of the key files changed since.
+    """
+    global _catalog
+
+    if _catalog is None or _catalog.is_stale():
+        _catalog = Catalog()
+
+    return _catalog
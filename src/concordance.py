@@ -0,0 +1,408 @@
+"""
+On-disk inverted index (concordance) of every table in t_key.csv and misc_texts/t_key.csv.
+
+Each table is indexed separately under DATA_CONCORDANCE_PATH, so tables are built in
+parallel and only rebuilt when their csv changes (each is stamped with its csv's mtime
+and size in the manifest). A table index is made of:
+
+    {table}.ids.npy      -- packed verse ids (see verse_join.encode_verse_id), by document number
+    {table}.terms.json   -- sorted word forms (lowercased)
+    {table}.offsets.npy  -- byte offset of each word form's postings, plus the end of the last
+    {table}.postings.bin -- postings of every word form, back to back
+
+A posting is the position of one occurrence, packed as document number * stride + word
+position (stride is one more than the longest document of the table), so postings are
+sorted and a phrase is a sequence of consecutive postings. Postings are delta-encoded as
+varints, memory-mapped, and decoded with numpy, so lookups take milliseconds.
+
+Misc texts have no books or chapters: their paragraphs are returned as
+VerseIdentifier(0, 0, id).
+
+Example usage:
+    build_concordance()
+    concordance = Concordance()
+    concordance.search('"the lamb"').counts -> { 't_asv': 29, 't_bbe': 27, ... }
+    concordance.search('heuen*').verses['t_wyc'] -> [VerseIdentifier(book=1, chapter=1, verse=1), ...]
+"""
+
+from src.paths import DATA_CONCORDANCE_PATH, CONCORDANCE_MANIFEST_PATH, TABLE_DIRECTORY, TABLE_NAME_FORMAT, MISC_TEXTS_PATH
+from src.csv_keys import ID_KEY, MISC_TEXT_KEY
+from src.catalog import get_catalog
+from src.table_cache import load_verse_table
+from src.verse_join import get_sorted_keys, BOOK_ID_FACTOR, CHAPTER_ID_FACTOR
+from src.data_manager import VerseIdentifier
+from src.preprocess import tokenize_words
+
+# Standard libraries
+import csv, io, json, os, tempfile
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# additional libraries (pip install ...)
+import numpy
+
+CONCORDANCE_FORMAT_VERSION = 1
+
+ConcordanceResult = namedtuple('ConcordanceResult', ['verses', 'counts'])
+
+def get_concordance_sources() -> [dict]:
+    """
+    Tables to index, in catalog order: every bible version, then every misc text, whose csv exists.
+
+    Example return:
+        [{ 'table': 't_asv', 'path': 'data/t_asv.csv', 'kind': 'bible' }, ..., { 'table': 't_hom', 'path': 'data/misc_texts/t_hom.csv', 'kind': 'misc' }]
+    """
+    catalog = get_catalog()
+    sources = [{ 'table': version['table'], 'path': TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = version['table']), 'kind': 'bible' } for version in catalog.versions]
+    sources += [{ 'table': text['table'], 'path': MISC_TEXTS_PATH / TABLE_NAME_FORMAT.format(table = text['table']), 'kind': 'misc' } for text in catalog.misc_texts]
+
+    return [dict(source, path = str(source['path'])) for source in sources if source['path'].exists()]
+
+def _iter_documents(source: dict):
+    """ Generator of (packed verse id, text), sorted by id, a repeated id keeping its last text """
+    if source['kind'] == 'bible':
+        with load_verse_table(Path(source['path'])) as table:
+            (keys, last_rows, _) = get_sorted_keys(table)
+            yield from ((key, table.text(row)) for (key, row) in zip(keys, last_rows))
+    else:
+        with open(source['path'], 'r', encoding = 'utf-8', newline = '') as file:
+            texts = { int(row[ID_KEY]): row[MISC_TEXT_KEY] for row in csv.DictReader(file) }
+            yield from sorted(texts.items())
+
+def get_varint_sizes(values: numpy.ndarray) -> numpy.ndarray:
+    """ Number of bytes of each non-negative integer encoded as a varint """
+    values = numpy.asarray(values, dtype = numpy.uint64)
+    num_bytes = numpy.ones(len(values), dtype = numpy.int64)
+
+    for k in range(1, 10):
+        num_bytes += values >= numpy.uint64(1 << (7 * k))
+
+    return num_bytes
+
+def encode_varints(values: numpy.ndarray) -> numpy.ndarray:
+    """ Encodes non-negative integers as little endian base 128 varints, returned as a uint8 array """
+    values = numpy.asarray(values, dtype = numpy.uint64)
+    num_bytes = get_varint_sizes(values)
+
+    starts = numpy.cumsum(num_bytes) - num_bytes
+    data = numpy.empty(int(num_bytes.sum()), dtype = numpy.uint8)
+
+    for k in range(int(num_bytes.max(initial = 0))):
+        selected = num_bytes > k
+        chunk = (values[selected] >> numpy.uint64(7 * k)) & numpy.uint64(0x7f)
+        more = (num_bytes[selected] > k + 1).astype(numpy.uint64) << numpy.uint64(7)
+        data[starts[selected] + k] = (chunk | more).astype(numpy.uint8)
+
+    return data
+
+def decode_delta_varints(data: numpy.ndarray, segment_starts: numpy.ndarray or None = None) -> numpy.ndarray:
+    """
+    Decodes varints (see encode_varints) holding delta-encoded sorted integers. Deltas restart
+    at every index of segment_starts (value indexes, default: only the first value).
+    """
+    data = numpy.asarray(data, dtype = numpy.uint8)
+
+    if len(data) == 0:
+        return numpy.zeros(0, dtype = numpy.int64)
+
+    is_last = data < 0x80
+    value_ends = numpy.flatnonzero(is_last)
+    value_starts = numpy.concatenate(([0], value_ends[:-1] + 1))
+    value_of_byte = numpy.concatenate(([0], numpy.cumsum(is_last)[:-1]))
+    shifts = 7 * (numpy.arange(len(data)) - value_starts[value_of_byte])
+    deltas = numpy.add.reduceat((data & 0x7f).astype(numpy.int64) << shifts, value_starts)
+
+    sums = numpy.cumsum(deltas)
+
+    if segment_starts is None or len(segment_starts) <= 1:
+        return sums
+
+    # undo the running sum of the previous segments
+    bases = numpy.concatenate(([0], sums[segment_starts[1:] - 1]))
+    return sums - numpy.repeat(bases, numpy.diff(numpy.append(segment_starts, len(sums))))
+
+def _to_npy_bytes(array: numpy.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    numpy.save(buffer, array)
+    return buffer.getvalue()
+
+def _write_atomic(path: Path, data: bytes):
+    fd, temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def _get_table_paths(directory: Path, table: str) -> {str: Path}:
+    return { part: directory / f'{table}.{part}' for part in ('ids.npy', 'terms.json', 'offsets.npy', 'postings.bin') }
+
+def build_table_index(source: dict, directory: Path = DATA_CONCORDANCE_PATH) -> dict:
+    """
+    Indexes one table (see get_concordance_sources), writing its files under directory.
+
+    Returns:
+        dict -- the table's manifest entry
+
+    Example return:
+        { 'kind': 'bible', 'path': 'data/t_kjv.csv', 'mtime_ns': 1610000000000000000, 'size': 4530000, 'stride': 91, 'num_documents': 31102, 'num_terms': 12850, 'num_postings': 790000 }
+    """
+    stat = os.stat(source['path'])
+    verse_ids = []
+    documents = []
+
+    for (verse_id, text) in _iter_documents(source):
+        verse_ids.append(verse_id)
+        documents.append(tokenize_words(text))
+
+    stride = max(map(len, documents), default = 0) + 1
+    postings = defaultdict(list)
+
+    for (document, words) in enumerate(documents):
+        base = document * stride
+
+        for (position, word) in enumerate(words):
+            postings[word].append(base + position)
+
+    terms = sorted(postings)
+    lengths = numpy.array([len(postings[term]) for term in terms], dtype = numpy.int64)
+    keys = numpy.fromiter((key for term in terms for key in postings[term]), dtype = numpy.int64, count = int(lengths.sum()))
+
+    # deltas within each term, the first posting of a term being absolute
+    deltas = numpy.diff(keys, prepend = 0)
+    term_starts = numpy.cumsum(lengths) - lengths
+    deltas[term_starts[lengths > 0]] = keys[term_starts[lengths > 0]]
+
+    data = encode_varints(deltas)
+    byte_ends = numpy.concatenate(([0], numpy.cumsum(get_varint_sizes(deltas))))
+    offsets = byte_ends[numpy.concatenate(([0], numpy.cumsum(lengths)))]
+
+    directory.mkdir(parents = True, exist_ok = True)
+    paths = _get_table_paths(directory, source['table'])
+    _write_atomic(paths['ids.npy'], _to_npy_bytes(numpy.array(verse_ids, dtype = numpy.int64)))
+    _write_atomic(paths['terms.json'], json.dumps(terms, ensure_ascii = False).encode('utf-8'))
+    _write_atomic(paths['offsets.npy'], _to_npy_bytes(offsets.astype(numpy.int64)))
+    _write_atomic(paths['postings.bin'], data.tobytes())
+
+    return {
+        'kind': source['kind'],
+        'path': source['path'],
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'stride': stride,
+        'num_documents': len(verse_ids),
+        'num_terms': len(terms),
+        'num_postings': len(keys)
+    }
+
+def _build_table_index(arguments: (dict, Path)) -> dict:
+    return build_table_index(*arguments)
+
+def read_concordance_manifest(manifest_path: Path = CONCORDANCE_MANIFEST_PATH) -> dict:
+    """ Returns the concordance manifest, with no tables if there is none (or it was written by a different version) """
+    try:
+        with open(manifest_path, 'r', encoding = 'utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    return manifest if manifest.get('version') == CONCORDANCE_FORMAT_VERSION else { 'version': CONCORDANCE_FORMAT_VERSION, 'tables': {} }
+
+def _is_table_fresh(entry: dict or None, source: dict) -> bool:
+    if entry is None or entry['path'] != source['path']:
+        return False
+
+    stat = os.stat(source['path'])
+    return (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size)
+
+def build_concordance(tables: [str] or None = None, max_workers: int or None = None, directory: Path = DATA_CONCORDANCE_PATH, verbose: bool = False) -> dict:
+    """
+    Builds (or updates) the concordance: indexes the tables whose index is missing or out of
+    date, concurrently on a process pool, then writes the manifest.
+
+    Keyword Arguments:
+        tables {[str] or None} -- names of the tables to index, None for every table (default: {None})
+        max_workers {int or None} -- number of worker processes, 1 to build serially (default: {None}, i.e. one per cpu)
+        directory {Path} -- where the index files are written (default: {DATA_CONCORDANCE_PATH})
+        verbose {bool} -- whether to print the tables being indexed (default: {False})
+
+    Returns:
+        dict -- the manifest, see read_concordance_manifest
+    """
+    manifest_path = directory / CONCORDANCE_MANIFEST_PATH.name
+    manifest = read_concordance_manifest(manifest_path)
+    sources = [source for source in get_concordance_sources() if tables is None or source['table'] in tables]
+    stale_sources = [source for source in sources if not _is_table_fresh(manifest['tables'].get(source['table']), source)]
+
+    verbose and stale_sources and print(f"Indexing {', '.join(source['table'] for source in stale_sources)}...")
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(stale_sources))
+    arguments = [(source, directory) for source in stale_sources]
+
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            entries = list(executor.map(_build_table_index, arguments))
+    else:
+        entries = list(map(_build_table_index, arguments))
+
+    for (source, entry) in zip(stale_sources, entries):
+        manifest['tables'][source['table']] = entry
+
+    directory.mkdir(parents = True, exist_ok = True)
+    _write_atomic(manifest_path, json.dumps(manifest, indent = 4).encode('utf-8'))
+
+    return manifest
+
+class _TableIndex:
+    """ Memory-mapped index files of one table """
+
+    def __init__(self, directory: Path, table: str, entry: dict):
+        paths = _get_table_paths(directory, table)
+
+        with open(paths['terms.json'], 'r', encoding = 'utf-8') as file:
+            self.terms = json.load(file)
+
+        self.kind = entry['kind']
+        self.stride = entry['stride']
+        self.verse_ids = numpy.load(paths['ids.npy'], mmap_mode = 'r')
+        self.offsets = numpy.load(paths['offsets.npy'], mmap_mode = 'r')
+        self.postings = numpy.memmap(paths['postings.bin'], dtype = numpy.uint8, mode = 'r') if entry['num_postings'] > 0 else numpy.zeros(0, dtype = numpy.uint8)
+
+    def get_term_range(self, term: str, prefix: bool = False) -> (int, int):
+        """ Index range of a word form (or of every word form starting with it) in the sorted terms """
+        start = bisect_left(self.terms, term)
+
+        if prefix:
+            return (start, bisect_left(self.terms, term + '\U0010ffff', start))
+
+        return (start, start + 1) if start < len(self.terms) and self.terms[start] == term else (start, start)
+
+    def get_postings(self, start: int, end: int) -> numpy.ndarray:
+        """ Postings of the word forms of the index range [start, end), concatenated term by term """
+        if start == end:
+            return numpy.zeros(0, dtype = numpy.int64)
+
+        (byte_start, byte_end) = (int(self.offsets[start]), int(self.offsets[end]))
+        data = numpy.asarray(self.postings[byte_start:byte_end])
+
+        # value index at which each term's postings start (deltas restart there)
+        is_last = numpy.concatenate(([0], numpy.cumsum(data < 0x80)))
+        segment_starts = is_last[numpy.asarray(self.offsets[start:end]) - byte_start]
+
+        return decode_delta_varints(data, segment_starts)
+
+    def get_documents(self, postings: numpy.ndarray) -> numpy.ndarray:
+        return numpy.unique(postings // self.stride)
+
+    def get_verses(self, documents: numpy.ndarray) -> [VerseIdentifier]:
+        verse_ids = numpy.asarray(self.verse_ids[documents])
+
+        if self.kind == 'misc':
+            (books, chapters, verses) = (numpy.zeros_like(verse_ids), numpy.zeros_like(verse_ids), verse_ids)
+        else:
+            # vectorized verse_join.decode_verse_id
+            (books, rest) = numpy.divmod(verse_ids, BOOK_ID_FACTOR)
+            (chapters, verses) = numpy.divmod(rest, CHAPTER_ID_FACTOR)
+
+        return list(map(VerseIdentifier, books.tolist(), chapters.tolist(), verses.tolist()))
+
+class Concordance:
+    """
+    Query interface of the concordance built by build_concordance (see the module docstring).
+    Table indexes are loaded (memory-mapped) on their first query.
+
+    Keyword Arguments:
+        directory {Path} -- where the index files are (default: {DATA_CONCORDANCE_PATH})
+    """
+
+    def __init__(self, directory: Path = DATA_CONCORDANCE_PATH):
+        self.directory = directory
+        self.manifest = read_concordance_manifest(directory / CONCORDANCE_MANIFEST_PATH.name)
+        self._indexes = {}
+
+    @property
+    def tables(self) -> [str]:
+        return list(self.manifest['tables'])
+
+    def _get_index(self, table: str) -> _TableIndex:
+        if table not in self._indexes:
+            self._indexes[table] = _TableIndex(self.directory, table, self.manifest['tables'][table])
+
+        return self._indexes[table]
+
+    def _query(self, find_documents, tables: [str] or None, with_verses: bool = True) -> ConcordanceResult:
+        verses = {}
+        counts = {}
+
+        for table in (tables if tables is not None else self.tables):
+            index = self._get_index(table)
+            documents = find_documents(index)
+            counts[table] = len(documents)
+
+            if with_verses:
+                verses[table] = index.get_verses(documents)
+
+        return ConcordanceResult(verses if with_verses else None, counts)
+
+    def term(self, word: str, tables: [str] or None = None, with_verses: bool = True) -> ConcordanceResult:
+        """
+        Verses containing a word form (case insensitive), by table, with the number of verses
+        of each table. Several words are looked up as a phrase.
+
+        Keyword Arguments:
+            tables {[str] or None} -- tables to search, None for every table (default: {None})
+            with_verses {bool} -- whether to return the verses, or only count them (much faster for common words) (default: {True})
+
+        Example return (concordance.term('heuene', ['t_wyc'])):
+            ConcordanceResult(verses = { 't_wyc': [VerseIdentifier(book=1, chapter=1, verse=1), ...] }, counts = { 't_wyc': 412 })
+        """
+        words = tokenize_words(word)
+
+        if len(words) != 1:
+            return self.phrase(word, tables, with_verses)
+
+        return self._query(lambda index: index.get_documents(index.get_postings(*index.get_term_range(words[0]))), tables, with_verses)
+
+    def prefix(self, prefix: str, tables: [str] or None = None, with_verses: bool = True) -> ConcordanceResult:
+        """ Verses containing a word form starting with prefix (case insensitive), see term """
+        prefix = prefix.lower()
+        return self._query(lambda index: index.get_documents(index.get_postings(*index.get_term_range(prefix, prefix = True))), tables, with_verses)
+
+    def phrase(self, text: str, tables: [str] or None = None, with_verses: bool = True) -> ConcordanceResult:
+        """ Verses containing the word forms of text as consecutive words (case insensitive), see term """
+        words = tokenize_words(text)
+
+        def find_documents(index: _TableIndex) -> numpy.ndarray:
+            if not words:
+                return numpy.zeros(0, dtype = numpy.int64)
+
+            starts = index.get_postings(*index.get_term_range(words[0]))
+
+            # keep the starts followed by the i-th word i positions later, in the same document
+            for (i, word) in enumerate(words[1:], 1):
+                starts = starts[(starts % index.stride + i < index.stride) & numpy.isin(starts + i, index.get_postings(*index.get_term_range(word)), assume_unique = True)]
+
+            return index.get_documents(starts)
+
+        return self._query(find_documents, tables, with_verses)
+
+    def search(self, query: str, tables: [str] or None = None, with_verses: bool = True) -> ConcordanceResult:
+        """
+        Runs a query: "quoted words" for a phrase, word* for a prefix, otherwise a word form (see term).
+
+        Example usage:
+            concordance.search('"the lamb"'), concordance.search('heuen*'), concordance.search('þæt', with_verses = False)
+        """
+        query = query.strip()
+
+        if len(query) > 1 and query.startswith('"') and query.endswith('"'):
+            return self.phrase(query[1:-1], tables, with_verses)
+        if query.endswith('*'):
+            return self.prefix(query[:-1], tables, with_verses)
+
+        return self.term(query, tables, with_verses)
@@ -0,0 +1,16 @@
+"""
+CSV header names shared by the data tables (t_*.csv) and key files (key_*.csv)
+"""
+
+BOOK_KEY = 'b'
+CHAPTER_KEY = 'c'
+VERSE_KEY = 'v'
+TEXT_KEY = 't'
+TESTAMENT_KEY = 't'
+GENRE_KEY = 'g'
+NAME_KEY = 'n'
+DATASET_KEY = 'dataset'
+ID_KEY = 'id'
+
+# misc_texts/t_*.csv header names (the id column is ID_KEY)
+MISC_TEXT_KEY = 'text'
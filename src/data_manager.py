@@ -1,34 +1,68 @@
 from src.paths import *
+from src.csv_keys import *
 from src.utils import time_function
+from src.table_cache import VerseTable, load_verse_table, ensure_table_cache, is_table_cache_fresh, get_table_hash
+from src.catalog import get_catalog
+from src.verse_index import VerseIndex, build_verse_index, load_verse_index, is_verse_index_fresh
+from src.verse_join import join_verse_tables, filter_joined_rows, iter_joined_texts, decode_verse_id
+from src.dataset_cache import get_dataset_cache, hash_key_parts
+from src.split_files import SplitWriter, SplitLines, read_split_manifest
+from src.split_assignment import SplitAssignment, load_split_assignment
+from src.near_duplicates import are_distinct_texts, NEAR_DUPLICATE_THRESHOLD, SHINGLE_SIZE
+from src.normalization import normalize_text, load_normalization_table
+from src.preprocess import PreprocessOperation, PreprocessFilter, PreprocessVerseFilter, PreprocessTransform, PreprocessStats, run_fused_operations, split_leading_filters, bind_tables, SAME, NONINCREASING
 
 # Standard libraries
 import csv
-from collections import defaultdict, namedtuple
-import random, shutil, re
+from collections import defaultdict, deque, namedtuple
+from itertools import repeat
+from pathlib import Path
+import random, re, os
+from contextlib import nullcontext
+from concurrent.futures import Executor, ProcessPoolExecutor
+from time import time
 from typing import Callable
 
 # additional libraries (pip install ...)
 import contractions
-
-# CSV header names
-BOOK_KEY = 'b'
-CHAPTER_KEY = 'c'
-VERSE_KEY = 'v'
-TEXT_KEY = 't'
-TESTAMENT_KEY = 't'
-GENRE_KEY = 'g'
-NAME_KEY = 'n'
-DATASET_KEY = 'dataset'
-ID_KEY = 'id'
+import numpy
 
 VerseIdentifier = namedtuple('VerseIdentifier', ['book', 'chapter', 'verse'])
 
 # Other constants
 TESTAMENT_NAMES = { 'OT': 'Old Testament', 'NT': 'New Testament' }
 
+# symbols removed by preprocess_remove_punctuation, by whether periods are preserved
+REMOVE_PUNCTUATION_PATTERNS = {
+    preserve_periods: re.compile(r"[\";\,\:\[\]\(\)&‘'" + ("" if preserve_periods else r"\.!?") + ']')
+    for preserve_periods in (True, False)
+}
+
+# bump when a change to create_datasets changes its results, so older cached results are not reused
+DATASETS_CACHE_VERSION = 2
+
+# character datasets (see create_character_datasets): start and end of the target texts, and padding
+START_CHARACTER = '\t'
+END_CHARACTER = '\n'
+PAD_CHARACTER = ' '
+
+# streaming mode (see stream_datasets): verses per preprocessing chunk, and verses held for shuffling
+STREAM_CHUNK_SIZE = 1024
+STREAM_SHUFFLE_BUFFER_SIZE = 8192
+
+# ways of assigning the non-test verses to the training and validation datasets (see create_datasets)
+SPLIT_METHODS = ('random', 'hash')
+
+# below this many bytes of csv to parse, tables are loaded serially (a process pool costs more than it saves)
+PARALLEL_LOAD_MIN_BYTES = 4 * 2 ** 20
+
+# below this many verses, preprocess operations are run serially (same reason)
+PARALLEL_PREPROCESS_MIN_VERSES = 4096
+
 def get_bible_versions() -> [dict]:
     """
     Returns a list of bible version objects, taken from t_key.csv
+    (through the load-once catalog, see src/catalog.py)
 
     Returns:
         [
@@ -49,17 +83,7 @@ def get_bible_versions() -> [dict]:
             ...
         ]
     """
-    bible_versions = list()
-
-    with open(TABLE_KEY_PATH, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-
-        for line in reader:
-            bible_versions.append({k: line[i] for (i, k) in enumerate(headers)})
-            bible_versions[-1]['id'] = int(bible_versions[-1]['id'])
-
-    return bible_versions
+    return [dict(version) for version in get_catalog().versions]
 
 def get_bible_versions_by_file_name(tables: [str]) -> [dict]:
     """
@@ -71,7 +95,7 @@ def get_bible_versions_by_file_name(tables: [str]) -> [dict]:
     Returns:
         Same as get_bible_versions
     """
-    return list(filter(lambda book: book['table'] in tables, get_bible_versions()))
+    return [dict(version) for version in get_catalog().versions if version['table'] in tables]
 
 def get_bible_book_genres() -> {int: str}:
     """
@@ -90,14 +114,7 @@ def get_bible_book_genres() -> {int: str}:
             8: 'Apocalyptic'
         }
     """
-    with open(KEY_GENRE_ENGLISH_PATH, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-
-        genre_index = headers.index(GENRE_KEY)
-        name_index = headers.index(NAME_KEY)
-
-        return { int(genre[genre_index]): genre[name_index] for genre in reader }
+    return dict(get_catalog().genres)
 
 def get_bible_books() -> {int: dict}:
     """
@@ -123,27 +140,7 @@ def get_bible_books() -> {int: dict}:
             ...
         }
     """
-    genres = get_bible_book_genres()
-
-    with open(KEY_ENGLISH_PATH, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-
-        book_index = headers.index(BOOK_KEY)
-        name_index = headers.index(NAME_KEY)
-        testament_index = headers.index(TESTAMENT_KEY)
-        genre_index = headers.index(GENRE_KEY)
-        dataset_index = headers.index(DATASET_KEY)
-
-        return {
-            int(book[book_index]): {
-                'name': book[name_index],
-                'testament': book[testament_index],
-                'genre_id': int(book[genre_index]),
-                'genre': genres[int(book[genre_index])],
-                'dataset': book[dataset_index]
-            } for book in reader
-        }
+    return { book_id: dict(book) for (book_id, book) in get_catalog().books.items() }
 
 def get_bible_book_id_map() -> {str: int}:
     """
@@ -157,7 +154,7 @@ def get_bible_book_id_map() -> {str: int}:
             ...
         }
     """
-    return { book['name'].lower(): book_id for (book_id, book) in get_bible_books().items() }
+    return dict(get_catalog().book_ids_by_name)
 
 def get_test_bible_book_ids() -> {int}:
     """
@@ -167,7 +164,124 @@ def get_test_bible_book_ids() -> {int}:
     Returns:
         {1, 5, 13, 15, 16, 18, 19, 21, 25, 30, 36, 37, 42, 43, 45, 50, 51, 52, 53, 55, 57, 60, 62, 66}
     """
-    return {book_id for (book_id, book) in get_bible_books().items() if book['dataset'] == 'test' }
+    return set(get_catalog().book_ids_by_dataset['test'])
+
+def get_table_path(bible_version: dict) -> Path:
+    """
+    Returns the csv file path of a given bible version's table.
+
+    Arguments:
+        bible_version {dict} -- the bible version object, as returned by get_bible_versions
+    """
+    return TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = bible_version['table'])
+
+def get_verse_table(bible_version: dict) -> VerseTable:
+    """
+    Returns the memory-mapped compiled cache of a bible version's table (see src/table_cache.py),
+    which is (re)compiled automatically whenever the table's csv file changes.
+    Close it when done, or use it as a context manager.
+
+    Arguments:
+        bible_version {dict} -- the bible version object, as returned by get_bible_versions
+
+    Example usage:
+        with get_verse_table(bible_version) as table:
+            table.books[0], table.chapters[0], table.verses[0], table.text(0)
+            -> (1, 1, 1, 'In the beginning God created the heavens and the earth.')
+    """
+    return load_verse_table(get_table_path(bible_version))
+
+def _get_num_workers(max_workers: int or None) -> int:
+    return max_workers or os.cpu_count() or 1
+
+def load_verse_tables(bible_versions: [dict], max_workers: int or None = None, min_parallel_bytes: int = PARALLEL_LOAD_MIN_BYTES) -> [VerseTable]:
+    """
+    Loads the memory-mapped tables of many bible versions at once (see get_verse_table),
+    returned in the same order as the bible_versions argument. Tables whose cache is
+    missing or out of date are parsed concurrently on a process pool, unless there is
+    too little csv data to parse for a pool to pay off, in which case they are parsed
+    serially. Close the returned tables when done.
+
+    Arguments:
+        bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
+
+    Keyword Arguments:
+        max_workers {int or None} -- number of worker processes, 1 to always parse serially (default: {None}, i.e. one per cpu)
+        min_parallel_bytes {int} -- minimum total csv size to parse in parallel (default: {PARALLEL_LOAD_MIN_BYTES})
+    """
+    table_paths = [get_table_path(version) for version in bible_versions]
+    stale_paths = list({ path: None for path in table_paths if not is_table_cache_fresh(path) })
+
+    max_workers = min(_get_num_workers(max_workers), len(stale_paths))
+
+    if max_workers > 1 and sum(path.stat().st_size for path in stale_paths) >= min_parallel_bytes:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            list(executor.map(ensure_table_cache, stale_paths))
+
+    return [load_verse_table(path) for path in table_paths]
+
+def get_verse_index(bible_version: dict) -> VerseIndex:
+    """
+    Returns the book/chapter index of a bible version's table (see src/verse_index.py), which is
+    (re)built automatically whenever the table's csv file changes.
+
+    Arguments:
+        bible_version {dict} -- the bible version object, as returned by get_bible_versions
+
+    Example usage:
+        index = get_verse_index(bible_version)
+        index.books, index.chapters(66), index.num_verses(66, 6)
+        -> ([1, 2, ..., 66], [1, 2, ..., 22], 17)
+    """
+    return load_verse_index(get_table_path(bible_version))
+
+def load_verse_indexes(bible_versions: [dict], max_workers: int or None = None, min_parallel_bytes: int = PARALLEL_LOAD_MIN_BYTES) -> [VerseIndex]:
+    """
+    Returns the indexes of many bible versions at once (see get_verse_index), in the same order
+    as the bible_versions argument. Missing or out of date indexes are built like the tables
+    of load_verse_tables: concurrently on a process pool if there is enough csv data to scan.
+
+    Arguments:
+        bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
+
+    Keyword Arguments:
+        max_workers {int or None} -- number of worker processes, 1 to always build serially (default: {None}, i.e. one per cpu)
+        min_parallel_bytes {int} -- minimum total csv size to scan in parallel (default: {PARALLEL_LOAD_MIN_BYTES})
+    """
+    table_paths = [get_table_path(version) for version in bible_versions]
+    stale_paths = list({ path: None for path in table_paths if not is_verse_index_fresh(path) })
+
+    max_workers = min(_get_num_workers(max_workers), len(stale_paths))
+
+    if max_workers > 1 and sum(path.stat().st_size for path in stale_paths) >= min_parallel_bytes:
+        with ProcessPoolExecutor(max_workers = max_workers) as executor:
+            list(executor.map(build_verse_index, stale_paths))
+
+    return [load_verse_index(path) for path in table_paths]
+
+def get_bible_verse_range(bible_version: dict, book: int, chapters: int or (int, int) or None = None, verses: (int, int) or None = None) -> {VerseIdentifier: str}:
+    """
+    Same as get_bible_verses, restricted to a book, a chapter or an inclusive (first, last) span
+    of chapters, and an inclusive (first, last) span of verses within those chapters. Only the
+    rows of the selected chapters are read from the csv, using the table's index (see get_verse_index).
+
+    Arguments:
+        bible_version {dict} -- the bible version object, as returned by get_bible_versions
+        book {int} -- the book id, see get_bible_book_id_map
+
+    Keyword Arguments:
+        chapters {int or (int, int) or None} -- a chapter id, or a span of chapter ids, None for every chapter (default: {None})
+        verses {(int, int) or None} -- a span of verse ids, None for every verse (default: {None})
+
+    Example return (get_bible_verse_range(bible_version, 66, 6, (1, 10))):
+        {
+            VerseIdentifier(book=66, chapter=6, verse=1): 'And I saw when the Lamb opened one of the seven seals, ...',
+            ...
+            VerseIdentifier(book=66, chapter=6, verse=10): 'and they cried with a great voice, saying, ...'
+        }
+    """
+    rows = get_verse_index(bible_version).read_rows(book, chapters, verses)
+    return { VerseIdentifier(book, chapter, verse): text for (book, chapter, verse, text) in rows }
 
 def get_bible_verses(bible_version: dict) -> {VerseIdentifier: str}:
     """
@@ -185,18 +299,8 @@ def get_bible_verses(bible_version: dict) -> {VerseIdentifier: str}:
             VerseIdentifier(book=66, chapter=22, verse=21): 'The grace of the Lord Jesus be with the saints. Amen.'
         }
     """
-    table_path = TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = bible_version['table'])
-
-    with open(table_path, 'r', encoding = 'utf-8') as csvfile:
-        reader = csv.reader(csvfile)
-
-        headers = next(reader)
-        book_index = headers.index(BOOK_KEY)
-        chapter_index = headers.index(CHAPTER_KEY)
-        verse_index = headers.index(VERSE_KEY)
-        text_index = headers.index(TEXT_KEY)
-
-        return { VerseIdentifier(int(verse[book_index]), int(verse[chapter_index]), int(verse[verse_index])): verse[text_index] for verse in reader }
+    with get_verse_table(bible_version) as table:
+        return { VerseIdentifier(book, chapter, verse): text for (book, chapter, verse, text) in table.rows() }
 
 def get_book_mapping(bible_version: dict) -> {int: {int: {int: str}}}:
     """
@@ -219,25 +323,15 @@ def get_book_mapping(bible_version: dict) -> {int: {int: {int: str}}}:
             ...
         }
     """
-    table_path = TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = bible_version['table'])
-
-    with open(table_path, 'r', encoding = 'utf-8') as csvfile:
-        reader = csv.reader(csvfile)
+    book_mapping = defaultdict(lambda: defaultdict(dict))
 
-        headers = next(reader)
-        book_index = headers.index(BOOK_KEY)
-        chapter_index = headers.index(CHAPTER_KEY)
-        verse_index = headers.index(VERSE_KEY)
-        text_index = headers.index(TEXT_KEY)
+    with get_verse_table(bible_version) as table:
+        for (book, chapter, verse, text) in table.rows():
+            book_mapping[book][chapter][verse] = text
 
-        book_mapping = defaultdict(lambda: defaultdict(dict))
+    return book_mapping
 
-        for verse in reader:
-            book_mapping[int(verse[book_index])][int(verse[chapter_index])][int(verse[verse_index])] = verse[text_index]
-
-        return book_mapping
-
-def get_shared_bible_verses(bible_versions: [dict]) -> {VerseIdentifier: [str]}:
+def get_shared_bible_verses(bible_versions: [dict], max_workers: int or None = None, preprocess_filters: [PreprocessFilter] = [], stats: PreprocessStats or None = None) -> {VerseIdentifier: [str]}:
     """
     Returns the verses that are shared between all the bible versions in
     the argument. The verses are returned as a dict where the key is the verse
@@ -247,6 +341,12 @@ def get_shared_bible_verses(bible_versions: [dict]) -> {VerseIdentifier: [str]}:
     Arguments:
         bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
 
+    Keyword Arguments:
+        max_workers {int or None} -- number of processes used to load the tables, see load_verse_tables (default: {None})
+        preprocess_filters {[PreprocessFilter]} -- filters on the raw texts, evaluated on the features precomputed
+                                                   in the table cache, see verse_join.filter_joined_rows (default: {[]})
+        stats {PreprocessStats or None} -- collects per filter time and drop counts (default: {None})
+
     Example return:
         {
             VerseIdentifier(book=1, chapter=1, verse=1): [
@@ -262,16 +362,34 @@ def get_shared_bible_verses(bible_versions: [dict]) -> {VerseIdentifier: [str]}:
             ...
         }
     """
-    all_verses = defaultdict(list)
+    return dict(iter_shared_bible_verses(bible_versions, max_workers, preprocess_filters, stats))
+
+def iter_shared_bible_verses(bible_versions: [dict], max_workers: int or None = None, preprocess_filters: [PreprocessFilter] = [], stats: PreprocessStats or None = None):
+    """
+    Generator version of get_shared_bible_verses, yielding (VerseIdentifier, [str]) pairs
+    in the same order. The versions are joined on their packed verse ids (see src/verse_join.py),
+    so only the shared verses are ever held in memory, and their texts are decoded one
+    verse at a time.
 
-    for version in bible_versions:
-        for (verse_id, verse) in get_bible_verses(version).items():
-            all_verses[verse_id].append(verse)
+    Arguments:
+        bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
 
-    return dict(filter(
-        lambda kv: len(kv[1]) == len(bible_versions),
-        all_verses.items()
-    ))
+    Keyword Arguments:
+        max_workers {int or None} -- number of processes used to load the tables, see load_verse_tables (default: {None})
+        preprocess_filters {[PreprocessFilter]} -- filters on the raw texts, see get_shared_bible_verses (default: {[]})
+        stats {PreprocessStats or None} -- collects per filter time and drop counts (default: {None})
+    """
+    tables = load_verse_tables(bible_versions, max_workers)
+
+    try:
+        keys, rows = join_verse_tables(tables)
+        keys, rows = filter_joined_rows(tables, keys, rows, preprocess_filters, stats)
+
+        for (verse_id, texts) in iter_joined_texts(tables, keys, rows):
+            yield VerseIdentifier(*decode_verse_id(verse_id)), texts
+    finally:
+        for table in tables:
+            table.close()
 
 def get_books_contained_by_version(bible_version: dict) -> [int]:
     """
@@ -288,17 +406,9 @@ def get_books_contained_by_version(bible_version: dict) -> [int]:
     Example return:
         [1, 2, 3, ..., 64, 65, 66] (if no books are missing)
     """
-    table_path = TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = bible_version['table'])
-
-    with open(table_path, 'r', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile)
-
-        headers = next(reader)
-        book_index = headers.index(BOOK_KEY)
-
-        return sorted({int(verse[book_index]) for verse in reader})
+    return get_verse_index(bible_version).books
 
-def get_versions_missing_books(bible_versions: [dict]) -> {int: [int]}:
+def get_versions_missing_books(bible_versions: [dict], max_workers: int or None = None) -> {int: [int]}:
     """
     Some versions might be missing books (once we start web scraping).
     This will return a dictionary where each key is a version id,
@@ -307,12 +417,18 @@ def get_versions_missing_books(bible_versions: [dict]) -> {int: [int]}:
     Arguments:
         bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
 
+    Keyword Arguments:
+        max_workers {int or None} -- number of processes used to build missing indexes, see load_verse_indexes (default: {None})
+
     Example return:
         {1: [], 2: [], 3: [], 4: [], 5: [], 6: [], 7: []}
     """
-    all_books = set(get_bible_books().keys())
+    all_books = set(get_catalog().books)
 
-    return { version['id']: sorted(all_books - set(get_books_contained_by_version(version))) for version in bible_versions }
+    return {
+        version['id']: sorted(all_books - set(index.books))
+        for (version, index) in zip(bible_versions, load_verse_indexes(bible_versions, max_workers))
+    }
 
 def filter_test_verses(verses: {VerseIdentifier: [str]}) -> ({VerseIdentifier: [str], VerseIdentifier: [str]}):
     """
@@ -346,20 +462,55 @@ def filter_test_verses(verses: {VerseIdentifier: [str]}) -> ({VerseIdentifier: [
     return dict(filter(lambda kv: kv[0].book not in test_book_ids, verses.items())), \
            dict(filter(lambda kv: kv[0].book in     test_book_ids, verses.items()))
 
-def filter_validation_verses(verses: {VerseIdentifier: [str]}, training_fraction: float) -> ({VerseIdentifier: [str], VerseIdentifier: [str]}):
+def filter_validation_verses(verses: {VerseIdentifier: [str]}, training_fraction: float, rng: random.Random = random) -> ({VerseIdentifier: [str], VerseIdentifier: [str]}):
     """
     Same thing as filter_test_verses, but instead of splitting by book,
     it splits by a random sample of data points based on the training
     fraction. This is used to split the non-test verses into a training
     and a validation set.
+
+    Keyword Arguments:
+        rng {random.Random} -- random number generator to sample with (default: {random}, the global one)
     """
     num_training_verses = int(len(verses) * training_fraction)
-    training_verse_ids = set(random.sample(list(verses), k = num_training_verses))
+    training_verse_ids = set(rng.sample(list(verses), k = num_training_verses))
 
     return dict(filter(lambda kv: kv[0] in     training_verse_ids, verses.items())), \
            dict(filter(lambda kv: kv[0] not in training_verse_ids, verses.items()))
 
-def zip_verses(bible_versions: [dict], verses: {VerseIdentifier: [str]}, shuffle: bool) -> {str: [str]}:
+def _check_split(split: str):
+    if split not in SPLIT_METHODS:
+        raise ValueError(f'unknown split {split!r}, expected one of {SPLIT_METHODS}')
+
+def get_split_assignment(training_fraction: float, seed: int or None = None) -> SplitAssignment:
+    """
+    Returns the stable, hash-based split assignment (see src/split_assignment.py) used by
+    create_datasets(split = 'hash'), along with the verses recorded in its manifest.
+    A seed of None uses seed 0.
+    """
+    return load_split_assignment(training_fraction, get_test_bible_book_ids(), seed if seed is not None else 0)
+
+def assign_split_verses(verses: {VerseIdentifier: [str]}, assignment: SplitAssignment) -> {str: {VerseIdentifier: [str]}}:
+    """
+    Alternative to filter_test_verses followed by filter_validation_verses, splitting verses by
+    a seeded hash of their id (see src/split_assignment.py) instead of a random sample. A verse
+    is always assigned to the same dataset, whatever the other verses are.
+
+    Example return:
+        {
+            'training': { VerseIdentifier(book=2, chapter=1, verse=2): [...], ... },
+            'validation': { VerseIdentifier(book=2, chapter=1, verse=1): [...], ... },
+            'test': { VerseIdentifier(book=1, chapter=1, verse=1): [...], ... }
+        }
+    """
+    split_verses = { 'training': {}, 'validation': {}, 'test': {} }
+
+    for (verse_id, texts) in verses.items():
+        split_verses[assignment.assign(*verse_id)][verse_id] = texts
+
+    return split_verses
+
+def zip_verses(bible_versions: [dict], verses: {VerseIdentifier: [str]}, shuffle: bool, rng: random.Random = random) -> {str: [str]}:
     """
     Converts the verse-index based dictionary to a bible-version based dictionary.
     In other words, changed from this:
@@ -391,7 +542,8 @@ def zip_verses(bible_versions: [dict], verses: {VerseIdentifier: [str]}, shuffle
             ...
         }
 
-    And this function can optionally shuffle all the verses as well.
+    And this function can optionally shuffle all the verses as well (using rng,
+    the global random number generator by default).
 
     Example return:
         {
@@ -412,21 +564,28 @@ def zip_verses(bible_versions: [dict], verses: {VerseIdentifier: [str]}, shuffle
             ]
         }
     """
+    return zip_verses_with_ids(bible_versions, verses, shuffle, rng)[0]
+
+def zip_verses_with_ids(bible_versions: [dict], verses: {VerseIdentifier: [str]}, shuffle: bool, rng: random.Random = random) -> ({str: [str]}, [VerseIdentifier]):
+    """
+    Same as zip_verses (with the same shuffle for the same rng state), also returning
+    the id of each zipped verse, in the same order.
+    """
     table_names = [version['table'] for version in bible_versions]
 
     split_verses = defaultdict(list)
 
-    verse_values = list(verses.values())
+    verse_items = list(verses.items())
     if shuffle:
-        random.shuffle(verse_values)
+        rng.shuffle(verse_items)
 
-    for verse_texts in verse_values:
+    for (_, verse_texts) in verse_items:
         for (table_name, text) in zip(table_names, verse_texts):
             split_verses[table_name].append(text)
 
-    return split_verses
+    return split_verses, [verse_id for (verse_id, _) in verse_items]
 
-def zip_split_verses(bible_versions: [dict], split_verses: {str: {VerseIdentifier: [str]}}, shuffle: bool) -> {str: {str: [str]}}:
+def zip_split_verses(bible_versions: [dict], split_verses: {str: {VerseIdentifier: [str]}}, shuffle: bool, rng: random.Random = random) -> {str: {str: [str]}}:
     """
     See zip_verses above.
 
@@ -437,28 +596,226 @@ def zip_split_verses(bible_versions: [dict], split_verses: {str: {VerseIdentifie
             'test': <zip_verses output on test data>
         }
     """
-    return { dataset: zip_verses(bible_versions, verses, shuffle) for (dataset, verses) in split_verses.items() }
+    return { dataset: zip_verses(bible_versions, verses, shuffle, rng) for (dataset, verses) in split_verses.items() }
 
-def write_zipped_verses(zipped_verses: {str: {str: [str]}}):
+def zip_split_verses_with_ids(bible_versions: [dict], split_verses: {str: {VerseIdentifier: [str]}}, shuffle: bool, rng: random.Random = random) -> ({str: {str: [str]}}, {str: [VerseIdentifier]}):
+    """
+    Same as zip_split_verses, also returning the ids of each dataset's verses, see zip_verses_with_ids.
+    """
+    zipped_verses, verse_ids = {}, {}
+
+    for (dataset, verses) in split_verses.items():
+        zipped_verses[dataset], verse_ids[dataset] = zip_verses_with_ids(bible_versions, verses, shuffle, rng)
+
+    return zipped_verses, verse_ids
+
+def write_zipped_verses(zipped_verses: {str: {str: [str]}}, parameters: dict = {}):
     """
     Writes the contents of a  zipped verses object (zip_split_verses return type)
     to many different files under the new data/split directory (more generally, the
-    DATA_SPLIT_PATH directory), deleting the previous directory contents. This way
+    DATA_SPLIT_PATH directory), removing split files from a previous execution. This way
     there are no artifacts from a previous execution.
+
+    Files are replaced atomically, unchanged files are not rewritten, and a manifest
+    is written along with them (see src/split_files.py).
+
+    Keyword Arguments:
+        parameters {dict} -- parameters that generated the split, stored in the manifest,
+                             see get_split_parameters (default: {{}})
+    """
+    with SplitWriter(parameters) as writer:
+        for (dataset, verse_versions) in zipped_verses.items():
+            for (table, verses) in verse_versions.items():
+                writer.add_file(dataset, table)
+
+                for verse in verses:
+                    writer.write_line(dataset, table, verse)
+
+def get_split_parameters(bible_versions: [dict], training_fraction: float, shuffle: bool, preprocess_operations: [PreprocessOperation or Callable[[dict], dict]], seed: int or None, stream: bool = False, split: str = 'random') -> dict:
+    """
+    The parameters of a create_datasets call, as recorded in the split files' manifest
+    (see src/split_files.py). Tables are identified by their content hash.
+    """
+    _check_split(split)
+
+    return {
+        'tables': [[version['table'], get_table_hash(get_table_path(version)).hex()] for version in bible_versions],
+        'test_books': sorted(get_test_bible_book_ids()),
+        'preprocess_operations': [
+            operation.describe() if isinstance(operation, PreprocessOperation) else getattr(operation, '__qualname__', repr(operation))
+            for operation in preprocess_operations
+        ],
+        'training_fraction': training_fraction,
+        'shuffle': shuffle,
+        'seed': seed,
+        'stream': stream,
+        'split': split
+    }
+
+def write_arrow_datasets(bible_versions: [dict], zipped_verses: {str: {str: [str]}}, verse_ids: {str: [VerseIdentifier]}, format: str = 'arrow'):
+    """
+    Writes a zipped verses object, along with the ids of its verses (see zip_split_verses_with_ids),
+    as one Arrow or Parquet file per dataset under DATA_ARROW_PATH, with book, chapter and verse
+    columns, then one column per bible version (see src/arrow_export.py). Arrow files can be
+    memory-mapped by datasets.Dataset.from_file, and Parquet files loaded by datasets.load_dataset.
+    Requires pyarrow.
+
+    Keyword Arguments:
+        format {str} -- 'arrow' or 'parquet' (default: {'arrow'})
+    """
+    # pyarrow is only required for exports
+    from src.arrow_export import ArrowDatasetWriter
+
+    table_names = [version['table'] for version in bible_versions]
+
+    with ArrowDatasetWriter(table_names, format) as writer:
+        for (dataset, verse_versions) in zipped_verses.items():
+            writer.add_dataset(dataset)
+
+            for (verse_id, *texts) in zip(verse_ids[dataset], *(verse_versions[table] for table in table_names)):
+                writer.write(dataset, verse_id, texts)
+
+class SplitFileWriter:
     """
-    shutil.rmtree(DATA_SPLIT_PATH, ignore_errors = True)
-    DATA_SPLIT_PATH.mkdir()
+    Writes verses to the split files (see write_zipped_verses) one verse at a time,
+    so a dataset never needs to be held in memory. The new split files replace the
+    previous ones (atomically, see src/split_files.py) on close. Use it as a context manager,
+    where an exception leaves the previous split files untouched, or call close when done.
 
-    for (dataset, verse_versions) in zipped_verses.items():
-        for (table, verses) in verse_versions.items():
-            path = DATA_SPLIT_PATH / SPLIT_DATASET_FORMAT.format(dataset = dataset, table = table)
+    Arguments:
+        bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
 
-            with open(path, 'w') as file:
-                file.write('\n'.join(verses))
+    Keyword Arguments:
+        parameters {dict} -- parameters that generated the split, stored in the manifest,
+                             see get_split_parameters (default: {{}})
 
-def preprocess_filter_num_words(max_num_words: int, min_num_words: int = 1) -> Callable[[dict], dict]:
+    Example usage:
+        with SplitFileWriter(bible_versions) as writer:
+            writer.write('training', ['In the beginning God created the heavens and the earth.', ...])
     """
-    A preprocess function for create_datasets.
+
+    def __init__(self, bible_versions: [dict], parameters: dict = {}):
+        self.table_names = [version['table'] for version in bible_versions]
+        self.writer = SplitWriter(parameters)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+    def write(self, dataset: str, texts: [str]):
+        """ Appends one verse (one text per bible version, in bible_versions order) to a dataset's files """
+        for (table, text) in zip(self.table_names, texts):
+            self.writer.write_line(dataset, table, text)
+
+    def close(self):
+        self.writer.commit()
+
+def _iter_chunks(items, chunk_size: int):
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def _iter_counted(items, counts: {str: int}, key: str):
+    for item in items:
+        counts[key] += 1
+        yield item
+
+def iter_preprocessed_verses(verses, preprocess_operations: [PreprocessOperation], chunk_size: int = STREAM_CHUNK_SIZE, stats: PreprocessStats or None = None, executor: Executor or None = None, max_pending_chunks: int = 8):
+    """
+    Generator that runs preprocess operations over a stream of (VerseIdentifier, [str]) pairs,
+    chunk_size verses at a time, yielding the verses that survive, in order.
+
+    Keyword Arguments:
+        chunk_size {int} -- number of verses preprocessed at once (default: {STREAM_CHUNK_SIZE})
+        stats {PreprocessStats or None} -- collects per operation time and drop counts (default: {None})
+        executor {Executor or None} -- if given, chunks are preprocessed on it, with at most max_pending_chunks
+                                       in flight (only when every operation is a PreprocessOperation) (default: {None})
+        max_pending_chunks {int} -- maximum number of chunks submitted to the executor at once (default: {8})
+    """
+    stats = stats if stats is not None else PreprocessStats()
+
+    if executor is None or not all(isinstance(operation, PreprocessOperation) for operation in preprocess_operations):
+        for chunk in _iter_chunks(verses, chunk_size):
+            yield from run_preprocess_operations(dict(chunk), preprocess_operations, stats).items()
+        return
+
+    pending = deque()
+
+    for chunk in _iter_chunks(verses, chunk_size):
+        pending.append(executor.submit(_run_preprocess_chunk, chunk, preprocess_operations))
+
+        if len(pending) >= max_pending_chunks:
+            yield from _get_preprocessed_chunk(pending.popleft(), stats)
+
+    while pending:
+        yield from _get_preprocessed_chunk(pending.popleft(), stats)
+
+def _run_preprocess_chunk(chunk: [(VerseIdentifier, [str])], preprocess_operations: [PreprocessOperation]) -> ([(VerseIdentifier, [str])], PreprocessStats):
+    """ Worker process side of the parallel preprocessing """
+    stats = PreprocessStats()
+    return list(run_fused_operations(dict(chunk), preprocess_operations, stats).items()), stats
+
+def _get_preprocessed_chunk(future, stats: PreprocessStats) -> [(VerseIdentifier, [str])]:
+    verses, chunk_stats = future.result()
+    stats.merge(chunk_stats)
+    return verses
+
+def iter_verse_splits(verses, training_fraction: float, rng: random.Random = random, assignment: SplitAssignment or None = None):
+    """
+    Generator that assigns each verse of a stream of (VerseIdentifier, [str]) pairs
+    to a dataset, yielding (dataset, VerseIdentifier, [str]) tuples. Test verses are
+    chosen by book, like filter_test_verses, and each remaining verse goes to training
+    with probability training_fraction, otherwise to validation (unlike
+    filter_validation_verses, which needs all of the verses up front).
+
+    Keyword Arguments:
+        rng {random.Random} -- random number generator to draw with (default: {random}, the global one)
+        assignment {SplitAssignment or None} -- if given, verses are assigned by hash instead,
+                                                see assign_split_verses (default: {None})
+    """
+    test_book_ids = get_test_bible_book_ids()
+
+    for (verse_id, texts) in verses:
+        if assignment is not None:
+            yield assignment.assign(*verse_id), verse_id, texts
+        elif verse_id.book in test_book_ids:
+            yield 'test', verse_id, texts
+        elif rng.random() < training_fraction:
+            yield 'training', verse_id, texts
+        else:
+            yield 'validation', verse_id, texts
+
+def _iter_shuffled(items, buffer_size: int, rng: random.Random = random):
+    """ Shuffles a stream through a fixed size buffer, i.e. only items up to buffer_size apart can swap places """
+    buffer = []
+
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+        else:
+            index = rng.randrange(buffer_size)
+            yield buffer[index]
+            buffer[index] = item
+
+    rng.shuffle(buffer)
+    yield from buffer
+
+def preprocess_filter_num_words(max_num_words: int, min_num_words: int = 1) -> PreprocessOperation:
+    """
+    A preprocess operation for create_datasets.
     Filters verses where a bible version has too many or too few verses.
     Words are split on whitespace.
 
@@ -468,11 +825,11 @@ def preprocess_filter_num_words(max_num_words: int, min_num_words: int = 1) -> C
     Keyword Arguments:
         min_num_words {int} -- minimum number of words per verse (default: {1})
     """
-    return lambda shared_verses: dict(filter(lambda verse: all((min_num_words <= len(text.split()) <= max_num_words for text in verse[1])), shared_verses.items()))
+    return PreprocessFilter('filter_num_words', 'num_words', min_value = min_num_words, max_value = max_num_words)
 
-def preprocess_filter_num_sentences(max_num_sentences: int = 1, min_num_sentences: int = 1) -> Callable[[dict], dict]:
+def preprocess_filter_num_sentences(max_num_sentences: int = 1, min_num_sentences: int = 1) -> PreprocessOperation:
     """
-    A preprocess function for create_datasets.
+    A preprocess operation for create_datasets.
     Filters verses where a bible version has too many or too few sentences.
     Sentences are split on .!? followed by a character.
 
@@ -480,49 +837,267 @@ def preprocess_filter_num_sentences(max_num_sentences: int = 1, min_num_sentence
         max_num_sentences {int} -- maximum number of sentences per verse (default: {1})
         min_num_sentences {int} -- minimum number of sentences per verse (default: {1})
     """
-    delim = re.compile(r'[.!?].')
+    return PreprocessFilter('filter_num_sentences', 'num_sentences', min_value = min_num_sentences, max_value = max_num_sentences)
 
-    return lambda shared_verses: dict(filter(lambda verse: all((min_num_sentences <= len(re.split(delim, text)) <= max_num_sentences for text in verse[1])), shared_verses.items()))
-
-
-def preprocess_expand_contractions() -> Callable[[dict], dict]:
+def preprocess_expand_contractions() -> PreprocessOperation:
     """
-    A preprocess function for create_datasets.
+    A preprocess operation for create_datasets.
     Expands contractions in verses, i.e.:
     Why do you reason that it's because you have no bread? -> Why do you reason that it is because you have no bread?
     Warning: This module (contractions) seems to be a simple regex, picking the most common contraction, so it's not perfect.
     Warning 2: This module doesn't preserve case, if that is important for you.
+    Note: contractions can also delete words (i.e. a quoted 'all), so filters placed after
+    this operation are never run before it. Put filters first when possible.
     """
-    return lambda shared_verses: dict(map(lambda verse: (verse[0], [contractions.fix(text) for text in verse[1]]), shared_verses.items()))
+    return PreprocessTransform('expand_contractions', contractions.fix)
+
+def _remove_punctuation(text: str, preserve_periods: bool) -> str:
+    return re.sub(REMOVE_PUNCTUATION_PATTERNS[preserve_periods], '', text)
 
-def preprocess_remove_punctuation(preserve_periods: bool = True) -> Callable[[dict], dict]:
+def preprocess_remove_punctuation(preserve_periods: bool = True) -> PreprocessOperation:
     """
-    A preprocess function for create_datasets.
+    A preprocess operation for create_datasets.
     Removes punctuation for each verse.
 
     Keyword Arguments:
         preserve_periods {bool} -- whether to preserve ending punctuation (.?!) (default: {True})
     """
-    remove_symbols = r"[\";\,\:\[\]\(\)&‘'" + ("" if preserve_periods else r"\.!?") + ']'
-    return lambda shared_verses: dict(map(lambda verse: (verse[0], [re.sub(remove_symbols, '', text) for text in verse[1]]), shared_verses.items()))
+    # removing characters can only remove words (made only of punctuation), never add any
+    return PreprocessTransform('remove_punctuation', _remove_punctuation, { 'preserve_periods': preserve_periods },
+        effects = { 'num_words': NONINCREASING, 'num_characters': NONINCREASING })
 
-def preprocess_lowercase() -> Callable[[dict], dict]:
+def _lowercase(text: str) -> str:
+    return text.lower()
+
+def preprocess_lowercase() -> PreprocessOperation:
     """
-    A preprocess function for create_datasets.
+    A preprocess operation for create_datasets.
     Converts each verse to lowercase characters only.
     """
-    return lambda shared_verses: dict(map(lambda verse: (verse[0], [text.lower() for text in verse[1]]), shared_verses.items()))
+    return PreprocessTransform('lowercase', _lowercase, effects = { 'num_words': SAME, 'num_sentences': SAME })
+
+def preprocess_filter_near_duplicates(threshold: float = NEAR_DUPLICATE_THRESHOLD, shingle_size: int = SHINGLE_SIZE) -> PreprocessOperation:
+    """
+    A preprocess operation for create_datasets.
+    Filters verses where two bible versions are near-duplicates, i.e. the Jaccard similarity
+    of their word n-grams is at least threshold (see src/near_duplicates.py), like KJV and WBT
+    verses that only differ by a word or two. Exact duplicates are always filtered.
+
+    Keyword Arguments:
+        threshold {float} -- minimum similarity of near-duplicates (default: {NEAR_DUPLICATE_THRESHOLD})
+        shingle_size {int} -- number of words per n-gram (default: {SHINGLE_SIZE})
+    """
+    return PreprocessVerseFilter('filter_near_duplicates', are_distinct_texts, { 'threshold': threshold, 'shingle_size': shingle_size })
 
-def run_preprocess_operations(shared_verses: {VerseIdentifier: [str]}, preprocess_operations: [Callable[[dict], dict]]) -> {VerseIdentifier: [str]}:
+def preprocess_normalize(language_code: str, bible_versions: [dict]) -> PreprocessOperation:
     """
-    Helper function to run preprocess operations on shared verses
+    A preprocess operation for create_datasets.
+    Normalizes the verses of bible_versions like Demo.ipynb's _normalize, with the cltk normalization
+    of a language: ascii encoding of old english ('ang'), spelling normalization of middle english ('enm').
+    The texts of the other versions are left untouched. Each distinct word is normalized once, then
+    looked up (see src/normalization.py). The normalized vocabularies of bible_versions are loaded
+    (or built and stored) right away.
+
+    Arguments:
+        language_code {str} -- 'ang' or 'enm'
+        bible_versions {[dict]} -- bible versions in that language, as returned by get_bible_versions
+    """
+    for bible_version in bible_versions:
+        load_normalization_table(bible_version['table'], language_code)
+
+    return PreprocessTransform('normalize', normalize_text, { 'language_code': language_code }, tables = [version['table'] for version in bible_versions])
+
+def _run_fused_operations_parallel(shared_verses: {VerseIdentifier: [str]}, preprocess_operations: [PreprocessOperation], stats: PreprocessStats, executor: Executor, num_chunks: int) -> {VerseIdentifier: [str]}:
     """
-    for preprocess_operation in preprocess_operations:
-        shared_verses = preprocess_operation(shared_verses)
+    Runs fused preprocess operations over num_chunks contiguous chunks of the verses on an executor,
+    merging the results back in order, so the output is identical to the serial one.
+    """
+    verses = list(shared_verses.items())
+    chunk_size = -(-len(verses) // num_chunks)
+    chunks = [verses[i:i + chunk_size] for i in range(0, len(verses), chunk_size)]
+
+    result = {}
+
+    for (chunk_verses, chunk_stats) in executor.map(_run_preprocess_chunk, chunks, repeat(preprocess_operations)):
+        result.update(chunk_verses)
+        stats.merge(chunk_stats)
+
+    return result
+
+def split_vectorized_filters(preprocess_operations: [PreprocessOperation or Callable[[dict], dict]]) -> ([PreprocessFilter], [PreprocessOperation or Callable[[dict], dict]]):
+    """
+    Splits preprocess operations into the filters that can run on the joined tables' precomputed
+    features (see get_shared_bible_verses), and the (planned) operations left to run on the texts.
+    Only lists made entirely of PreprocessOperation objects can be split.
+    """
+    if not all(isinstance(operation, PreprocessOperation) for operation in preprocess_operations):
+        return [], preprocess_operations
+
+    return split_leading_filters(preprocess_operations)
+
+def run_preprocess_operations(shared_verses: {VerseIdentifier: [str]}, preprocess_operations: [PreprocessOperation or Callable[[dict], dict]], stats: PreprocessStats or None = None, max_workers: int or None = 1, executor: Executor or None = None) -> {VerseIdentifier: [str]}:
+    """
+    Helper function to run preprocess operations on shared verses.
+    Consecutive PreprocessOperations (as returned by the preprocess_* functions) are fused into
+    a single pass over the verses (see src/preprocess.py). Any other callable taking and returning
+    a shared verses dictionary is still supported, and is run on its own.
+
+    Fused operations can fan chunks of verses out to worker processes. The result (content and
+    order) is identical to the serial one. Per operation times are then summed over the workers.
+
+    Keyword Arguments:
+        stats {PreprocessStats or None} -- collects per operation time and drop counts (default: {None})
+        max_workers {int or None} -- number of worker processes, None for one per cpu (default: {1}, i.e. serial)
+        executor {Executor or None} -- executor to run chunks on instead of a new process pool, i.e. to
+                                       reuse one across calls; max_workers is then ignored (default: {None})
+    """
+    stats = stats if stats is not None else PreprocessStats()
+    num_workers = _get_num_workers(None if executor is not None else max_workers)
+    parallel = (executor is not None or num_workers > 1) and len(shared_verses) >= PARALLEL_PREPROCESS_MIN_VERSES
+    fused_operations = []
+
+    for preprocess_operation in list(preprocess_operations) + [None]:
+        if isinstance(preprocess_operation, PreprocessOperation):
+            fused_operations.append(preprocess_operation)
+            continue
+
+        if fused_operations and parallel:
+            # a few chunks per worker, to even out chunks with more expensive verses
+            num_chunks = 4 * num_workers
+
+            if executor is None:
+                with ProcessPoolExecutor(max_workers = num_workers) as pool:
+                    shared_verses = _run_fused_operations_parallel(shared_verses, fused_operations, stats, pool, num_chunks)
+            else:
+                shared_verses = _run_fused_operations_parallel(shared_verses, fused_operations, stats, executor, num_chunks)
+        elif fused_operations:
+            shared_verses = run_fused_operations(shared_verses, fused_operations, stats)
+
+        fused_operations = []
+
+        if preprocess_operation is not None:
+            name = getattr(preprocess_operation, '__qualname__', repr(preprocess_operation))
+            num_verses = len(shared_verses)
+            start_time = time()
+            shared_verses = preprocess_operation(shared_verses)
+            stats.seconds[name] += time() - start_time
+            stats.dropped[name] += num_verses - len(shared_verses)
 
     return shared_verses
 
-def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: bool = True, write_files: bool = False, verbose: bool = True, preprocess_operations: [Callable[[dict], dict]] = []) -> {str: {str: [str]}}:
+def stream_datasets(bible_versions: [dict], training_fraction: float, shuffle: bool = True, preprocess_operations: [PreprocessOperation] = [], return_datasets: bool = False, chunk_size: int = STREAM_CHUNK_SIZE, shuffle_buffer_size: int = STREAM_SHUFFLE_BUFFER_SIZE, stats: PreprocessStats or None = None, max_workers: int or None = 1, executor: Executor or None = None, seed: int or None = None, split: str = 'random', export_format: str or None = None) -> ({str: int}, {str: {str: [str]}} or None):
+    """
+    Streaming version of create_datasets (with write_files = True). Verses flow one at a time
+    through a generator pipeline: join -> preprocess (in chunks) -> split assignment -> shuffle
+    buffer -> split files. Peak memory is bounded by chunk_size and shuffle_buffer_size rather
+    than by the size of the corpus, unless return_datasets is set.
+
+    The differences with create_datasets are that the validation split is drawn per verse
+    (so it only approximately matches training_fraction, see iter_verse_splits, unless split
+    is 'hash', which assigns the same verses either way), and that shuffling only mixes verses
+    within shuffle_buffer_size of each other.
+
+    Arguments:
+        bible_versions {[dict]} -- list of bible version objects, as returned by get_bible_versions
+        training_fraction {float} -- fraction of non-test data to be allocated to training
+
+    Keyword Arguments:
+        shuffle {bool} -- whether to shuffle the verses (default: {True})
+        preprocess_operations {[PreprocessOperation]} -- preprocess operations to run (default: {[]})
+        return_datasets {bool} -- whether to also collect the datasets in memory (default: {False})
+        chunk_size {int} -- number of verses preprocessed at once (default: {STREAM_CHUNK_SIZE})
+        shuffle_buffer_size {int} -- number of verses held in the shuffle buffer (default: {STREAM_SHUFFLE_BUFFER_SIZE})
+        stats {PreprocessStats or None} -- collects per preprocess operation time and drop counts (default: {None})
+        max_workers {int or None} -- number of processes used to load tables and preprocess chunks,
+                                     None for one per cpu (default: {1}, i.e. serial)
+        executor {Executor or None} -- executor to preprocess chunks on instead of a new process pool (default: {None})
+        seed {int or None} -- seed of the split assignment and shuffle, None for the global random state (default: {None})
+        split {str} -- 'random' to draw the validation verses randomly, or 'hash' for a stable assignment
+                       by verse id, recorded in SPLIT_ASSIGNMENT_PATH (see assign_split_verses) (default: {'random'})
+        export_format {str or None} -- 'arrow' or 'parquet' to also stream the datasets to columnar files,
+                                       see write_arrow_datasets (default: {None})
+
+    Returns:
+        ({str: int}, {str: {str: [str]}} or None) -- the number of verses at each stage
+        ('shared', 'preprocessed', 'training', 'validation', 'test'), and the datasets
+        (same as create_datasets), or None if return_datasets is False
+    """
+    _check_split(split)
+
+    counts = defaultdict(int)
+    stats = stats if stats is not None else PreprocessStats()
+    num_dropped = sum(stats.dropped.values())
+    rng = random if seed is None else random.Random(seed)
+    table_names = [version['table'] for version in bible_versions]
+    datasets = { dataset: { table: [] for table in table_names } for dataset in ('training', 'validation', 'test') } if return_datasets else None
+
+    pool = ProcessPoolExecutor(_get_num_workers(max_workers)) if executor is None and _get_num_workers(max_workers) > 1 else None
+
+    preprocess_filters, text_operations = split_vectorized_filters(bind_tables(preprocess_operations, table_names))
+
+    verses = iter_shared_bible_verses(bible_versions, max_workers, preprocess_filters, stats)
+    verses = _iter_counted(iter_preprocessed_verses(verses, text_operations, chunk_size, stats, executor or pool), counts, 'preprocessed')
+    assignment = get_split_assignment(training_fraction, seed) if split == 'hash' else None
+    split_verses = iter_verse_splits(verses, training_fraction, rng, assignment)
+
+    if shuffle:
+        split_verses = _iter_shuffled(split_verses, shuffle_buffer_size, rng)
+
+    try:
+        parameters = get_split_parameters(bible_versions, training_fraction, shuffle, preprocess_operations, seed, stream = True, split = split)
+
+        # pyarrow is only required for exports
+        arrow_writer = nullcontext()
+        if export_format is not None:
+            from src.arrow_export import ArrowDatasetWriter
+            arrow_writer = ArrowDatasetWriter(table_names, export_format)
+
+            # every split gets a file, even if no verse is assigned to it
+            for dataset in ('training', 'validation', 'test'):
+                arrow_writer.add_dataset(dataset)
+
+        with SplitFileWriter(bible_versions, parameters) as writer, arrow_writer:
+            for (dataset, verse_id, texts) in split_verses:
+                counts[dataset] += 1
+                writer.write(dataset, texts)
+                export_format and arrow_writer.write(dataset, verse_id, texts)
+
+                if return_datasets:
+                    for (table, text) in zip(table_names, texts):
+                        datasets[dataset][table].append(text)
+    finally:
+        pool and pool.shutdown()
+
+    assignment and assignment.save()
+
+    # every shared verse is either kept or dropped by exactly one operation
+    counts['shared'] = counts['preprocessed'] + sum(stats.dropped.values()) - num_dropped
+
+    return dict(counts), datasets
+
+def get_datasets_cache_key(bible_versions: [dict], training_fraction: float, shuffle: bool, preprocess_operations: [PreprocessOperation], seed: int or None, split: str = 'random') -> str or None:
+    """
+    Returns the dataset cache key (see src/dataset_cache.py) of a create_datasets call, a hash of
+    the contents of the selected tables, the test books, the canonical description of the preprocess
+    operations and their parameters, training_fraction, shuffle, seed and split. Returns None if the result
+    cannot be cached: without a seed the split is random, and arbitrary preprocess callables
+    (anything but a PreprocessOperation) cannot be described.
+    """
+    if seed is None or not all(isinstance(operation, PreprocessOperation) for operation in preprocess_operations):
+        return None
+
+    return hash_key_parts({
+        'version': DATASETS_CACHE_VERSION,
+        'tables': [[version['table'], get_table_hash(get_table_path(version)).hex()] for version in bible_versions],
+        'test_books': sorted(get_test_bible_book_ids()),
+        'preprocess_operations': [operation.describe() for operation in preprocess_operations],
+        'training_fraction': training_fraction,
+        'shuffle': shuffle,
+        'seed': seed,
+        'split': split
+    })
+
+def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: bool = True, write_files: bool = False, verbose: bool = True, preprocess_operations: [PreprocessOperation] = [], stream: bool = False, return_datasets: bool = True, max_workers: int or None = 1, executor: Executor or None = None, seed: int or None = None, use_cache: bool = True, split: str = 'random', export_format: str or None = None) -> {str: {str: [str]}} or None:
     """
     Creates dataset splits from specific bible versions, and returns the split.
     This should take ~1 second or so to execute. If this is too slow for you,
@@ -541,6 +1116,26 @@ def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: b
         shuffle {bool} -- [whether to shuffle the verses] (default: {True})
         write_files {bool} -- [whether to write to files] (default: {False})
         verbose {bool} -- [whether to print status and details] (default: {True})
+        preprocess_operations {[PreprocessOperation]} -- [preprocess operations to run, see the preprocess_*
+                                                         functions] (default: {[]})
+        stream {bool} -- [whether to stream verses to files with bounded memory, see stream_datasets;
+                          implies write_files] (default: {False})
+        return_datasets {bool} -- [in stream mode, whether to also return the datasets; if not,
+                                   returns None] (default: {True})
+        max_workers {int or None} -- [number of processes used to load tables and run preprocess operations,
+                                      None for one per cpu; the result is the same either way] (default: {1})
+        executor {Executor or None} -- [executor to run preprocess operations on, instead of a new
+                                        process pool] (default: {None})
+        seed {int or None} -- [seed of the validation split and shuffle; None uses the global random
+                               state] (default: {None})
+        use_cache {bool} -- [whether to reuse a stored result of an identical call with a seed,
+                             see get_datasets_cache_key; not used in stream mode] (default: {True})
+        split {str} -- ['random' to sample the validation verses with the random state, or 'hash' to
+                        assign each verse by a seeded hash of its id, so verses keep their dataset when
+                        versions or preprocess operations change, see assign_split_verses; the
+                        assignment is recorded in SPLIT_ASSIGNMENT_PATH when writing files] (default: {'random'})
+        export_format {str or None} -- ['arrow' or 'parquet' to also write the datasets as columnar files
+                                        (with verse ids), see write_arrow_datasets] (default: {None})
 
     Example return:
         {
@@ -570,10 +1165,46 @@ def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: b
             }
         }
     """
+    _check_split(split)
+
+    if stream:
+        return _create_streamed_datasets(bible_versions, training_fraction, shuffle, verbose, preprocess_operations, return_datasets, max_workers, executor, seed, split, export_format)
+
+    rng = random if seed is None else random.Random(seed)
+    cache_key = use_cache and get_datasets_cache_key(bible_versions, training_fraction, shuffle, preprocess_operations, seed, split)
+
+    if cache_key:
+        cached = time_function('Load datasets from cache...', lambda: get_dataset_cache().get(cache_key), verbose)
+
+        if cached is not None:
+            zipped_verses = cached['datasets']
+            verse_ids = { dataset: [VerseIdentifier(*verse_id) for verse_id in ids] for (dataset, ids) in cached['verse_ids'].items() }
+
+            write_files and time_function(f'Store datasets to files...',
+                lambda: write_zipped_verses(zipped_verses, get_split_parameters(bible_versions, training_fraction, shuffle, preprocess_operations, seed, split = split)), verbose)
+
+            if write_files and split == 'hash':
+                # record the cached verses in the assignment, as on a miss
+                assignment = get_split_assignment(training_fraction, seed)
+                assign_split_verses({ verse_id: None for ids in verse_ids.values() for verse_id in ids }, assignment)
+                assignment.save()
+
+            export_format and time_function(f'Export datasets to {export_format}...',
+                lambda: write_arrow_datasets(bible_versions, zipped_verses, verse_ids, export_format), verbose)
+
+            num_verses = { dataset: len(next(iter(verses.values()), [])) for (dataset, verses) in zipped_verses.items() }
+            verbose and _print_split_sizes(num_verses)
+
+            return zipped_verses
+
+    preprocess_stats = PreprocessStats()
+    preprocess_filters, text_operations = split_vectorized_filters(bind_tables(preprocess_operations, [version['table'] for version in bible_versions]))
+
     shared_verses = time_function(f'Finding shared verses between {len(bible_versions)} versions...',
-        lambda: get_shared_bible_verses(bible_versions), verbose)
+        lambda: get_shared_bible_verses(bible_versions, max_workers, preprocess_filters, preprocess_stats), verbose)
 
-    raw_num_verses = len(shared_verses)
+    # verses dropped by the filters on the precomputed features were shared as well
+    raw_num_verses = len(shared_verses) + sum(preprocess_stats.dropped.values())
 
     if raw_num_verses == 0:
         print(f'WARNING: There were no shared verses between the given versions.')
@@ -581,7 +1212,7 @@ def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: b
 
     if len(preprocess_operations) > 0:
         shared_verses = time_function(f'Run preprocess operations...',
-            lambda: run_preprocess_operations(shared_verses, preprocess_operations), verbose)
+            lambda: run_preprocess_operations(shared_verses, text_operations, preprocess_stats, max_workers, executor), verbose)
 
         preprocess_num_verses = len(shared_verses)
 
@@ -589,45 +1220,108 @@ def create_datasets(bible_versions: [dict], training_fraction: float, shuffle: b
             print(f'WARNING: No verses matched preprocessing criteria.')
             return { 'training': [], 'validation': [], 'test': [] }
 
-    training_verses, test_verses = time_function('Separate test verses...',
-        lambda: filter_test_verses(shared_verses), verbose)
+    if split == 'hash':
+        assignment = get_split_assignment(training_fraction, seed)
+        split_verses = time_function('Assign verses to datasets by hash...',
+            lambda: assign_split_verses(shared_verses, assignment), verbose)
 
-    training_verses, validation_verses = time_function('Separate validation verses...',
-        lambda: filter_validation_verses(training_verses, training_fraction), verbose)
+        write_files and assignment.save()
+    else:
+        training_verses, test_verses = time_function('Separate test verses...',
+            lambda: filter_test_verses(shared_verses), verbose)
 
-    split_verses = { 'training': training_verses, 'validation': validation_verses, 'test': test_verses }
+        training_verses, validation_verses = time_function('Separate validation verses...',
+            lambda: filter_validation_verses(training_verses, training_fraction, rng), verbose)
 
-    zipped_verses = time_function(f'Zip together verses (shuffle = {shuffle})...',
-        lambda: zip_split_verses(bible_versions, split_verses, shuffle), verbose)
+        split_verses = { 'training': training_verses, 'validation': validation_verses, 'test': test_verses }
 
+    zipped_verses, verse_ids = time_function(f'Zip together verses (shuffle = {shuffle})...',
+        lambda: zip_split_verses_with_ids(bible_versions, split_verses, shuffle, rng), verbose)
+
+    cache_key and get_dataset_cache().put(cache_key, { 'datasets': zipped_verses, 'verse_ids': verse_ids })
 
     write_files and time_function(f'Store datasets to files...',
-            lambda: write_zipped_verses(zipped_verses), verbose)
+            lambda: write_zipped_verses(zipped_verses, get_split_parameters(bible_versions, training_fraction, shuffle, preprocess_operations, seed, split = split)), verbose)
+
+    export_format and time_function(f'Export datasets to {export_format}...',
+            lambda: write_arrow_datasets(bible_versions, zipped_verses, verse_ids, export_format), verbose)
 
-    verbose and len(preprocess_operations) > 0 and print(f'\n# verses before preprocessing: {raw_num_verses:7,d}\n# verses after  preprocessing: {preprocess_num_verses:7,d} ({preprocess_num_verses / raw_num_verses * 100:.0f}%)\n')
+    verbose and len(preprocess_operations) > 0 and print(f'\n# verses before preprocessing: {raw_num_verses:7,d}\n# verses after  preprocessing: {preprocess_num_verses:7,d} ({preprocess_num_verses / raw_num_verses * 100:.0f}%)\n\n{preprocess_stats.report()}\n')
 
-    verbose and print(f'\n# training verses:   {len(training_verses):7,d} ({len(training_verses) / len(shared_verses) * 100:.0f}%)\n# validation verses: {len(validation_verses):7,d} ({len(validation_verses) / len(shared_verses) * 100:.0f}%)\n# test verses:       {len(test_verses):7,d} ({len(test_verses) / len(shared_verses) * 100:.0f}%)')
+    verbose and _print_split_sizes({ dataset: len(verses) for (dataset, verses) in split_verses.items() })
 
     return zipped_verses
 
-def load_datasets() ->  {str: {str: [str]}}:
+def _print_split_sizes(num_verses: {str: int}):
+    """
+    Example output:
+        # training verses:    10,305 (59%)
+        # validation verses:   4,357 (25%)
+        # test verses:         2,735 (16%)
+    """
+    total = sum(num_verses.values())
+    print('\n' + '\n'.join(f'# {dataset + " verses:":18} {num_verses.get(dataset, 0):7,d} ({num_verses.get(dataset, 0) / total * 100:.0f}%)' for dataset in ('training', 'validation', 'test')))
+
+def _create_streamed_datasets(bible_versions: [dict], training_fraction: float, shuffle: bool, verbose: bool, preprocess_operations: [PreprocessOperation], return_datasets: bool, max_workers: int or None, executor: Executor or None, seed: int or None, split: str, export_format: str or None) -> {str: {str: [str]}} or None:
+    """
+    Stream mode of create_datasets, printing the same details.
+    """
+    preprocess_stats = PreprocessStats()
+
+    counts, datasets = time_function(f'Stream {len(bible_versions)} versions to files (shuffle = {shuffle})...',
+        lambda: stream_datasets(bible_versions, training_fraction, shuffle, preprocess_operations, return_datasets,
+            stats = preprocess_stats, max_workers = max_workers, executor = executor, seed = seed, split = split, export_format = export_format), verbose)
+
+    raw_num_verses = counts.get('shared', 0)
+    num_verses = counts.get('preprocessed', 0)
+
+    if raw_num_verses == 0:
+        print(f'WARNING: There were no shared verses between the given versions.')
+    elif num_verses == 0:
+        print(f'WARNING: No verses matched preprocessing criteria.')
+    else:
+        verbose and len(preprocess_operations) > 0 and print(f'\n# verses before preprocessing: {raw_num_verses:7,d}\n# verses after  preprocessing: {num_verses:7,d} ({num_verses / raw_num_verses * 100:.0f}%)\n\n{preprocess_stats.report()}\n')
+
+        verbose and _print_split_sizes({ dataset: counts.get(dataset, 0) for dataset in ('training', 'validation', 'test') })
+
+    return datasets
+
+def load_datasets(lazy: bool = True) ->  {str: {str: [str]}}:
     """
-    Loads datasets already created through create_datasets. Takes on the order
-    of tenths of seconds. Returns the same object that create_datasets returned.
+    Loads datasets already created through create_datasets. Returns the same object
+    that create_datasets returned. Only the files listed in the split manifest are
+    read, if there is one.
+
+    By default, each list of verses is a lazy SplitLines sequence (see src/split_files.py):
+    the file is memory-mapped and indexed by line, so loading takes milliseconds, and
+    only the verses that are accessed are decoded, i.e. datasets['test']['t_kjv'][:4]
+    decodes 4 verses. It supports len(), indexing, slicing and iteration like a list.
+
+    Keyword Arguments:
+        lazy {bool} -- whether to return lazy sequences instead of lists, which takes
+                       on the order of tenths of seconds (default: {True})
     """
     zipped_verses = defaultdict(lambda: defaultdict(list))
+    manifest = read_split_manifest()
 
-    for path in DATA_SPLIT_PATH.glob('*.txt'):
-        table, dataset = re.match(r'^(.+)_(validation|training|test)$', path.stem).groups()
+    if manifest is not None:
+        files = [(DATA_SPLIT_PATH / name, entry['table'], entry['dataset']) for (name, entry) in manifest['files'].items()]
+    else:
+        files = [(path, *re.match(r'^(.+)_(validation|training|test)$', path.stem).groups()) for path in DATA_SPLIT_PATH.glob('*.txt')]
 
-        with open(path, 'r') as file:
-            zipped_verses[dataset][table] = file.read().splitlines()
+    for (path, table, dataset) in files:
+        if lazy:
+            zipped_verses[dataset][table] = SplitLines(path)
+        else:
+            with open(path, 'r', encoding = 'utf-8') as file:
+                zipped_verses[dataset][table] = file.read().splitlines()
 
     return zipped_verses
 
 def get_unique_verses(version1: [str], version2: [str]) -> ((str,), (str,)):
     """
     Given verses of two datasets, returns list of verse pairs with identical verses removed.
+    To also remove pairs that only differ by a word or two, see preprocess_filter_near_duplicates.
 
     Arguments:
         version1 [str] -- list of bible verses for version1
@@ -639,3 +1333,151 @@ def get_unique_verses(version1: [str], version2: [str]) -> ((str,), (str,)):
             (And Jesus answered and said, Suffer ye thus far. And he touched his ear, and healed him., ...))
     """
     return zip(*((v1, v2) for v1, v2 in zip(version1, version2) if v1 != v2))
+
+class CharacterSequences:
+    """
+    Texts encoded as character indexes (see create_character_datasets): one flat int16 (int32
+    for vocabularies of 2 ** 15 characters or more) array of every text's indexes, and the
+    offsets of the texts in it (text i is codes[offsets[i]:offsets[i + 1]]).
+
+    Arguments:
+        codes {numpy.ndarray} -- character indexes of every text, concatenated
+        offsets {numpy.ndarray} -- int64 start of every text in codes, plus the end of the last one
+    """
+
+    def __init__(self, codes: numpy.ndarray, offsets: numpy.ndarray):
+        self.codes = codes
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> numpy.ndarray:
+        """ Number of characters of every text """
+        return numpy.diff(self.offsets)
+
+    def padded(self, rows: [int], pad_index: int, length: int or None = None) -> numpy.ndarray:
+        """
+        Returns the (len(rows), length) index matrix of some texts, padded with pad_index
+        (length defaults to the longest of the texts, longer texts are truncated).
+        """
+        rows = numpy.asarray(rows)
+        lengths = self.lengths[rows]
+        length = int(lengths.max(initial = 0)) if length is None else length
+        matrix = numpy.full((len(rows), length), pad_index, dtype = self.codes.dtype)
+
+        for (i, (start, text_length)) in enumerate(zip(self.offsets[rows].tolist(), numpy.minimum(lengths, length).tolist())):
+            matrix[i, :text_length] = self.codes[start:start + text_length]
+
+        return matrix
+
+def get_character_vocabulary(texts_lists: [[str]]) -> [str]:
+    """ Returns the sorted distinct characters of some lists of texts (i.e. every split of a version) """
+    characters = set()
+
+    for texts in texts_lists:
+        characters.update(''.join(texts))
+
+    return sorted(characters)
+
+def encode_characters(texts: [str], vocabulary: [str]) -> CharacterSequences:
+    """
+    Encodes texts as indexes of their characters in a sorted vocabulary (see get_character_vocabulary),
+    vectorized over code points. Every character of the texts must be in the vocabulary.
+    """
+    texts = list(texts)
+    dtype = numpy.int16 if len(vocabulary) < 2 ** 15 else numpy.int32
+    code_points = numpy.frombuffer(''.join(texts).encode('utf-32-le'), dtype = numpy.uint32)
+    vocabulary_code_points = numpy.array([ord(character) for character in vocabulary], dtype = numpy.uint32)
+
+    offsets = numpy.zeros(len(texts) + 1, dtype = numpy.int64)
+    numpy.cumsum([len(text) for text in texts], out = offsets[1:])
+
+    return CharacterSequences(numpy.searchsorted(vocabulary_code_points, code_points).astype(dtype), offsets)
+
+def create_character_datasets(zipped_verses: {str: {str: [str]}}, source_table: str, target_table: str) -> dict:
+    """
+    Encodes the source and target versions of every split (see create_datasets or load_datasets)
+    as character index sequences, instead of dense one-hot arrays (see character_lstm.ipynb):
+    memory is O(characters) instead of O(verses * max length * vocabulary size). Target texts
+    are wrapped in START_CHARACTER and END_CHARACTER. The vocabularies are built from every split.
+    Expand batches to one-hot with iter_one_hot_batches.
+
+    Arguments:
+        zipped_verses {{str: {str: [str]}}} -- the datasets, as returned by create_datasets or load_datasets
+        source_table {str} -- table name of the source version, i.e. 't_kjv'
+        target_table {str} -- table name of the target version, i.e. 't_bbe'
+
+    Example return:
+        {
+            'vocabularies': { 'source': ['\\n', ' ', '!', ...], 'target': ['\\t', '\\n', ' ', ...] },
+            'training': { 'source': CharacterSequences, 'target': CharacterSequences },
+            'validation': {...},
+            'test': {...}
+        }
+    """
+    source_texts = { dataset: versions[source_table] for (dataset, versions) in zipped_verses.items() }
+    target_texts = { dataset: [f'{START_CHARACTER}{text}{END_CHARACTER}' for text in versions[target_table]] for (dataset, versions) in zipped_verses.items() }
+
+    vocabularies = {
+        'source': get_character_vocabulary([*source_texts.values(), [PAD_CHARACTER]]),
+        'target': get_character_vocabulary([*target_texts.values(), [PAD_CHARACTER]])
+    }
+
+    character_datasets = { 'vocabularies': vocabularies }
+
+    for dataset in zipped_verses:
+        character_datasets[dataset] = {
+            'source': encode_characters(source_texts[dataset], vocabularies['source']),
+            'target': encode_characters(target_texts[dataset], vocabularies['target'])
+        }
+
+    return character_datasets
+
+def iter_one_hot_batches(source: CharacterSequences, target: CharacterSequences, vocabularies: {str: [str]}, batch_size: int = 64, rows: [int] or None = None, shuffle: bool = True, loop: bool = False, seed: int or None = None):
+    """
+    Generator of one-hot batches of character sequences (see create_character_datasets), only
+    expanded one batch at a time, yielding ((encoder input, decoder input), decoder target)
+    float32 arrays of shapes (batch, length, vocabulary size) like character_lstm.ipynb's:
+    texts are padded with PAD_CHARACTER to the longest text of their batch, and the decoder
+    target is the decoder input one step ahead.
+
+    Arguments:
+        source {CharacterSequences} -- encoded source texts
+        target {CharacterSequences} -- encoded target texts, in the same order
+        vocabularies {{str: [str]}} -- the 'vocabularies' of create_character_datasets
+
+    Keyword Arguments:
+        batch_size {int} -- number of verses per batch (default: {64})
+        rows {[int] or None} -- the verses to iterate over, None for all of them (default: {None})
+        shuffle {bool} -- whether to shuffle the verses (every pass) (default: {True})
+        loop {bool} -- whether to loop over the verses forever, i.e. for keras' model.fit (default: {False})
+        seed {int or None} -- seed of the shuffling (default: {None})
+
+    Example usage:
+        character_datasets = create_character_datasets(load_datasets(), 't_kjv', 't_bbe')
+        training = character_datasets['training']
+        batches = iter_one_hot_batches(training['source'], training['target'], character_datasets['vocabularies'], loop = True)
+        model.fit(batches, steps_per_epoch = math.ceil(len(training['source']) / 64), epochs = 10)
+    """
+    rows = numpy.arange(len(source)) if rows is None else numpy.asarray(rows)
+    rng = numpy.random.default_rng(seed)
+    source_identity = numpy.eye(len(vocabularies['source']), dtype = numpy.float32)
+    target_identity = numpy.eye(len(vocabularies['target']), dtype = numpy.float32)
+    source_pad = vocabularies['source'].index(PAD_CHARACTER)
+    target_pad = vocabularies['target'].index(PAD_CHARACTER)
+
+    while True:
+        order = rng.permutation(rows) if shuffle else rows
+
+        for start in range(0, len(order), batch_size):
+            batch_rows = order[start:start + batch_size]
+            decoder_input = target.padded(batch_rows, target_pad)
+            decoder_target = numpy.full_like(decoder_input, target_pad)
+            decoder_target[:, :-1] = decoder_input[:, 1:]
+
+            yield (source_identity[source.padded(batch_rows, source_pad)], target_identity[decoder_input]), target_identity[decoder_target]
+
+        if not loop:
+            return
@@ -0,0 +1,122 @@
+"""
+Content-addressed, size-bounded disk cache of create_datasets results.
+
+Entries are stored as one json file per key under DATASET_CACHE_PATH. The key is a
+hash of everything that determines the result (see data_manager.get_datasets_cache_key),
+so entries never need to be invalidated: a changed table, preprocess operation or
+seed simply produces a different key. Least recently used entries are evicted once
+the cache holds more than max_entries entries or max_bytes bytes.
+"""
+
+from src.paths import DATASET_CACHE_PATH
+
+# Standard libraries
+import hashlib, json, os, tempfile
+from pathlib import Path
+
+DATASET_CACHE_MAX_BYTES = 512 * 2 ** 20
+DATASET_CACHE_MAX_ENTRIES = 32
+
+def hash_key_parts(parts: object) -> str:
+    """
+    Hashes any json-serializable description of a computation into a cache key.
+    Dictionary keys are sorted, so equal descriptions always hash the same.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys = True).encode('utf-8')).hexdigest()
+
+class DatasetCache:
+    """
+    Keyword Arguments:
+        directory {Path} -- where entries are stored (default: {DATASET_CACHE_PATH})
+        max_bytes {int} -- maximum total size of the entries (default: {DATASET_CACHE_MAX_BYTES})
+        max_entries {int} -- maximum number of entries (default: {DATASET_CACHE_MAX_ENTRIES})
+    """
+
+    def __init__(self, directory: Path = DATASET_CACHE_PATH, max_bytes: int = DATASET_CACHE_MAX_BYTES, max_entries: int = DATASET_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def _get_path(self, key: str) -> Path:
+        return self.directory / f'{key}.json'
+
+    def _get_entries(self) -> [os.DirEntry]:
+        """ Cache entries, least recently used first """
+        if not self.directory.exists():
+            return []
+
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        return sorted(entries, key = lambda entry: entry.stat().st_mtime_ns)
+
+    def get(self, key: str) -> object or None:
+        """ Returns the cached value of key, or None if it isn't cached """
+        path = self._get_path(key)
+
+        try:
+            with open(path, 'r', encoding = 'utf-8') as file:
+                value = json.load(file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # the mtime doubles as the last access time for the LRU eviction
+        os.utime(path)
+        self.hits += 1
+
+        return value
+
+    def put(self, key: str, value: object):
+        """ Stores a json-serializable value under key, then evicts entries over the size bounds """
+        self.directory.mkdir(parents = True, exist_ok = True)
+        fd, temp_path = tempfile.mkstemp(dir = self.directory, prefix = f'.{key}.')
+
+        try:
+            with os.fdopen(fd, 'w', encoding = 'utf-8') as file:
+                json.dump(value, file, ensure_ascii = False)
+            os.replace(temp_path, self._get_path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """ Removes least recently used entries until the cache is within its bounds """
+        entries = self._get_entries()
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            entry = entries.pop(0)
+            total_bytes -= entry.stat().st_size
+            os.unlink(entry.path)
+
+    def clear(self):
+        for entry in self._get_entries():
+            os.unlink(entry.path)
+
+    def stats(self) -> {str: int}:
+        """
+        Example return:
+            { 'hits': 3, 'misses': 1, 'entries': 1, 'bytes': 8123456 }
+        """
+        entries = self._get_entries()
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(entry.stat().st_size for entry in entries)
+        }
+
+_dataset_cache = None
+
+def get_dataset_cache() -> DatasetCache:
+    """ Returns the process-wide dataset cache (with the default bounds) """
+    global _dataset_cache
+
+    if _dataset_cache is None:
+        _dataset_cache = DatasetCache()
+
+    return _dataset_cache
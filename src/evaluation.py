@@ -0,0 +1,251 @@
+"""
+Evaluation of translations of the test split, with per book, genre and testament breakdowns.
+
+Every test verse is scored on its own (sentence sacrebleu, chrF and METEOR), in parallel
+chunks on a process pool whose workers load the metrics once. Verse scores are cached in a
+SQLite database keyed by the hash of the (prediction, reference) pair, so rescoring a new
+checkpoint only scores the verses whose translation changed.
+
+Aggregates are the means of the verse scores of every group of verses (all of them, and
+each book, genre and testament, see data_manager.get_bible_books), along with the corpus
+sacrebleu and chrF of the whole split.
+
+Example usage:
+    translator = CachedTranslator(OnmtTranslator('models/kjv2bbe.pt'))
+    report = evaluate_translator(translator, kjv, bbe)
+    report['all']['meteor'], report['genre']['Law']['sacrebleu'], report['book']['Genesis']['chrf']
+"""
+
+from src.paths import VERSE_SCORES_CACHE_PATH
+from src.data_manager import VerseIdentifier, get_bible_books, get_shared_bible_verses, get_test_bible_book_ids
+from src.translators import Translator
+
+# Standard libraries
+import hashlib, os, sqlite3, threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# additional libraries (pip install ...)
+import numpy
+
+METRIC_NAMES = ('sacrebleu', 'chrf', 'meteor')
+
+# bump when the verse scores change (i.e. different metric parameters), so older cached scores are not reused
+VERSE_SCORES_CACHE_VERSION = 1
+
+# verses per scoring task, and below this many verses to score, verses are scored serially
+SCORE_CHUNK_SIZE = 512
+PARALLEL_SCORE_MIN_VERSES = 2048
+
+# bound parameters per query (SQLite's historical limit is 999)
+LOOKUP_CHUNK_SIZE = 500
+
+TRANSLATE_BATCH_SIZE = 64
+
+# metric functions of this process, see _get_scorers
+_scorers = None
+
+def _get_scorers() -> {str: object}:
+    """ Loads the metrics once per process, returning a (prediction, reference) -> score function per metric """
+    global _scorers
+
+    if _scorers is None:
+        import sacrebleu
+        from nltk.corpus import wordnet
+        from nltk.translate.meteor_score import single_meteor_score
+
+        wordnet.ensure_loaded()
+
+        def meteor(prediction: str, reference: str) -> float:
+            try:
+                return single_meteor_score(reference.split(), prediction.split())
+            except AttributeError:
+                # nltk < 3.6.6 tokenizes the strings itself
+                return single_meteor_score(reference, prediction)
+
+        _scorers = {
+            'sacrebleu': lambda prediction, reference: sacrebleu.sentence_bleu(prediction, [reference]).score,
+            'chrf': lambda prediction, reference: sacrebleu.sentence_chrf(prediction, [reference]).score,
+            'meteor': meteor
+        }
+
+    return _scorers
+
+def _score_chunk(pairs: [(str, str)]) -> [(float, float, float)]:
+    scorers = _get_scorers()
+    return [tuple(scorers[name](prediction, reference) for name in METRIC_NAMES) for (prediction, reference) in pairs]
+
+def get_verse_score_key(prediction: str, reference: str) -> str:
+    return hashlib.sha256(f'{VERSE_SCORES_CACHE_VERSION}\0{prediction}\0{reference}'.encode('utf-8')).hexdigest()
+
+class VerseScoreCache:
+    """
+    SQLite store of verse scores, by get_verse_score_key.
+
+    Keyword Arguments:
+        path {Path} -- database file (default: {VERSE_SCORES_CACHE_PATH})
+    """
+
+    def __init__(self, path: Path = VERSE_SCORES_CACHE_PATH):
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread = False)
+        self.connection.execute(f'''
+            CREATE TABLE IF NOT EXISTS verse_scores (
+                key TEXT PRIMARY KEY,
+                {', '.join(f'{name} REAL NOT NULL' for name in METRIC_NAMES)}
+            )
+        ''')
+
+    def get_many(self, keys: [str]) -> {str: (float,)}:
+        keys = list(set(keys))
+        found = {}
+
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+                chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+                rows = self.connection.execute(f"SELECT * FROM verse_scores WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+                found.update((key, tuple(scores)) for (key, *scores) in rows)
+
+        return found
+
+    def put_many(self, scores: {str: (float,)}):
+        with self.lock, self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO verse_scores VALUES (?{', ?' * len(METRIC_NAMES)})",
+                ((key, *verse_scores) for (key, verse_scores) in scores.items()))
+
+    def close(self):
+        self.connection.close()
+
+def score_verses(predictions: [str], references: [str], max_workers: int or None = None, cache: VerseScoreCache or None = None) -> numpy.ndarray:
+    """
+    Scores every prediction against its reference, returning a (len(predictions), len(METRIC_NAMES))
+    array: sentence sacrebleu, chrF (on sacrebleu's scale) and METEOR. Only the pairs missing
+    from the cache are scored, on a process pool unless there are too few of them.
+
+    Arguments:
+        predictions {[str]} -- translated verses
+        references {[str]} -- reference verses, in the same order
+
+    Keyword Arguments:
+        max_workers {int or None} -- number of worker processes, 1 to always score serially (default: {None}, i.e. one per cpu)
+        cache {VerseScoreCache or None} -- the verse scores store, None to score every verse (default: {None})
+    """
+    keys = [get_verse_score_key(prediction, reference) for (prediction, reference) in zip(predictions, references)]
+    scores = cache.get_many(keys) if cache is not None else {}
+    missing = { key: pair for (key, pair) in zip(keys, zip(predictions, references)) if key not in scores }
+
+    if missing:
+        pairs = list(missing.values())
+        chunks = [pairs[start:start + SCORE_CHUNK_SIZE] for start in range(0, len(pairs), SCORE_CHUNK_SIZE)]
+        max_workers = min(max_workers or os.cpu_count() or 1, len(chunks))
+
+        if max_workers > 1 and len(pairs) >= PARALLEL_SCORE_MIN_VERSES:
+            with ProcessPoolExecutor(max_workers = max_workers) as executor:
+                chunk_scores = list(executor.map(_score_chunk, chunks))
+        else:
+            chunk_scores = [_score_chunk(chunk) for chunk in chunks]
+
+        new_scores = dict(zip(missing, (verse_scores for chunk in chunk_scores for verse_scores in chunk)))
+        cache is not None and cache.put_many(new_scores)
+        scores.update(new_scores)
+
+    return numpy.array([scores[key] for key in keys], dtype = numpy.float64).reshape(len(keys), len(METRIC_NAMES))
+
+def _summarize_scores(scores: numpy.ndarray) -> dict:
+    return { 'verses': len(scores), **dict(zip(METRIC_NAMES, scores.mean(axis = 0).tolist())) }
+
+def get_score_breakdown(verse_ids: [VerseIdentifier], scores: numpy.ndarray) -> dict:
+    """
+    Means of the verse scores (see score_verses) of all the verses, and of each book, genre and testament.
+
+    Example return:
+        {
+            'all': { 'verses': 8012, 'sacrebleu': 31.2, 'chrf': 55.2, 'meteor': 0.571 },
+            'testament': { 'OT': {...}, 'NT': {...} },
+            'genre': { 'Law': {...}, 'Wisdom': {...}, ... },
+            'book': { 'Genesis': {...}, 'Judges': {...}, ... }
+        }
+    """
+    books = get_bible_books()
+    groups = { 'testament': {}, 'genre': {}, 'book': {} }
+
+    for (row, verse_id) in enumerate(verse_ids):
+        book = books[verse_id.book]
+
+        for (group, name) in (('testament', book['testament']), ('genre', book['genre']), ('book', book['name'])):
+            groups[group].setdefault(name, []).append(row)
+
+    breakdown = { 'all': _summarize_scores(scores) } if len(scores) else { 'all': { 'verses': 0 } }
+
+    for (group, rows) in groups.items():
+        breakdown[group] = { name: _summarize_scores(scores[group_rows]) for (name, group_rows) in rows.items() }
+
+    return breakdown
+
+def evaluate_translations(verse_ids: [VerseIdentifier], predictions: [str], references: [str], max_workers: int or None = None, use_cache: bool = True) -> dict:
+    """
+    Scores translations of verses (see score_verses), returning their breakdown (see get_score_breakdown),
+    along with the corpus sacrebleu and chrF of all of them under 'all'.
+
+    Arguments:
+        verse_ids {[VerseIdentifier]} -- ids of the translated verses
+        predictions {[str]} -- translated verses, in the same order
+        references {[str]} -- reference verses, in the same order
+
+    Keyword Arguments:
+        max_workers {int or None} -- number of worker processes (default: {None}, i.e. one per cpu)
+        use_cache {bool} -- whether to reuse and store verse scores (default: {True})
+    """
+    import sacrebleu
+
+    cache = VerseScoreCache() if use_cache else None
+
+    try:
+        scores = score_verses(predictions, references, max_workers, cache)
+    finally:
+        cache is not None and cache.close()
+
+    breakdown = get_score_breakdown(verse_ids, scores)
+
+    if predictions:
+        breakdown['all']['corpus_sacrebleu'] = sacrebleu.corpus_bleu(list(predictions), [list(references)]).score
+        breakdown['all']['corpus_chrf'] = sacrebleu.corpus_chrf(list(predictions), [list(references)]).score
+
+    return breakdown
+
+def get_test_verse_pairs(source_version: dict, target_version: dict, max_workers: int or None = None) -> {VerseIdentifier: (str, str)}:
+    """ Returns the (source, reference) texts of the verses of the test books (see get_test_bible_book_ids) shared by two versions """
+    test_book_ids = get_test_bible_book_ids()
+    verses = get_shared_bible_verses([source_version, target_version], max_workers)
+
+    return { verse_id: tuple(texts) for (verse_id, texts) in verses.items() if verse_id.book in test_book_ids }
+
+def evaluate_translator(translator: Translator, source_version: dict, target_version: dict, batch_size: int = TRANSLATE_BATCH_SIZE, max_workers: int or None = None, use_cache: bool = True) -> dict:
+    """
+    Translates the whole test split of a pair of versions, and evaluates the translations (see evaluate_translations).
+    Wrap the translator with translation_cache.CachedTranslator to only translate the verses once per checkpoint.
+
+    Arguments:
+        translator {Translator} -- the model, see src/translators.py
+        source_version {dict} -- the bible version translated, as returned by get_bible_versions
+        target_version {dict} -- the reference bible version
+
+    Keyword Arguments:
+        batch_size {int} -- verses translated at once (default: {TRANSLATE_BATCH_SIZE})
+        max_workers {int or None} -- number of worker processes (default: {None}, i.e. one per cpu)
+        use_cache {bool} -- whether to reuse and store verse scores (default: {True})
+    """
+    pairs = get_test_verse_pairs(source_version, target_version, max_workers)
+    verse_ids = list(pairs)
+    sources = [pairs[verse_id][0] for verse_id in verse_ids]
+    references = [pairs[verse_id][1] for verse_id in verse_ids]
+
+    predictions = []
+
+    for start in range(0, len(sources), batch_size):
+        predictions.extend(translator.translate(sources[start:start + batch_size]))
+
+    return evaluate_translations(verse_ids, predictions, references, max_workers, use_cache)
@@ -0,0 +1,158 @@
+"""
+Persistent cache of HTTP responses, so rerunning web_scrape.py doesn't download the corpora again.
+
+Every successful (200) response is stored under HTTP_CACHE_PATH, keyed by its url: its body,
+and its content type, ETag and Last-Modified headers. A cached url is revalidated with a
+conditional GET (If-None-Match / If-Modified-Since), where a 304 Not Modified answer costs
+no body download. In offline mode, cached responses are returned without any request,
+and uncached urls raise OfflineCacheMiss: re-parsing a scraped corpus needs no network I/O.
+
+Example usage:
+    cache = ResponseCache(offline = True)
+    beautify(url, cache = cache)
+    cache.stats()
+"""
+
+from src.paths import HTTP_CACHE_PATH
+
+# Standard libraries
+import hashlib, json, os, tempfile, threading, time
+from pathlib import Path
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# response headers kept along with the bodies
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+class OfflineCacheMiss(requests.exceptions.RequestException):
+    """ Raised in offline mode when a url isn't cached """
+
+class ResponseCache:
+    """
+    Disk-backed HTTP response cache (see the module docstring), shareable between threads.
+
+    Keyword Arguments:
+        directory {Path} -- where responses are stored (default: {HTTP_CACHE_PATH})
+        offline {bool} -- whether to only ever serve cached responses (default: {False})
+        revalidate {bool} -- whether to revalidate cached responses with a conditional GET,
+                             instead of returning them as is (default: {True})
+    """
+
+    def __init__(self, directory: Path = HTTP_CACHE_PATH, offline: bool = False, revalidate: bool = True):
+        self.directory = directory
+        self.offline = offline
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def _get_paths(self, url: str) -> (Path, Path):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return (self.directory / f'{key}.json', self.directory / f'{key}.body')
+
+    def _count(self, counter: str):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _read(self, url: str) -> (dict, bytes) or None:
+        (metadata_path, body_path) = self._get_paths(url)
+
+        try:
+            with open(metadata_path, 'r', encoding = 'utf-8') as file:
+                metadata = json.load(file)
+            with open(body_path, 'rb') as file:
+                return (metadata, file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_atomic(self, path: Path, data: bytes):
+        fd, temp_path = tempfile.mkstemp(dir = self.directory, prefix = f'.{path.name}.')
+
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _write(self, url: str, response: requests.Response):
+        (metadata_path, body_path) = self._get_paths(url)
+        metadata = {
+            'url': url,
+            'encoding': response.encoding,
+            'headers': { name: response.headers[name] for name in CACHED_HEADERS if name in response.headers },
+            'fetched': time.time()
+        }
+
+        self.directory.mkdir(parents = True, exist_ok = True)
+        # body first, so metadata never points to a missing or older body
+        self._write_atomic(body_path, response.content)
+        self._write_atomic(metadata_path, json.dumps(metadata, ensure_ascii = False).encode('utf-8'))
+
+    @staticmethod
+    def _to_response(url: str, metadata: dict, body: bytes) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(metadata['headers'])
+        response.encoding = metadata['encoding']
+        response._content = body
+        response.from_cache = True
+        return response
+
+    def get(self, url: str, session: requests.Session or None = None, timeout: float or None = None) -> requests.Response:
+        """
+        Returns the response of a GET of url: the cached one (revalidated, unless offline or
+        revalidate is false), or a new one, stored if successful.
+
+        Arguments:
+            url {str} -- the url
+
+        Keyword Arguments:
+            session {requests.Session or None} -- session sending the requests, None for requests.get (default: {None})
+            timeout {float or None} -- seconds to wait for a response (default: {None})
+        """
+        cached = self._read(url)
+
+        if cached is not None and (self.offline or not self.revalidate):
+            self._count('hits')
+            return self._to_response(url, *cached)
+
+        if self.offline:
+            self._count('misses')
+            raise OfflineCacheMiss(f'{url} is not cached (offline mode)')
+
+        headers = {}
+
+        if cached is not None:
+            cached_headers = CaseInsensitiveDict(cached[0]['headers'])
+            'ETag' in cached_headers and headers.update({ 'If-None-Match': cached_headers['ETag'] })
+            'Last-Modified' in cached_headers and headers.update({ 'If-Modified-Since': cached_headers['Last-Modified'] })
+
+        response = (session or requests).get(url, headers = headers, timeout = timeout)
+
+        if cached is not None and response.status_code == 304:
+            self._count('revalidated')
+            return self._to_response(url, *cached)
+
+        self._count('misses')
+        response.status_code == 200 and self._write(url, response)
+
+        return response
+
+    def stats(self) -> {str: int}:
+        """
+        Example return:
+            { 'hits': 1180, 'revalidated': 9, 'misses': 2, 'hit_rate': 0.998 }
+        """
+        with self.lock:
+            lookups = self.hits + self.revalidated + self.misses
+
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.revalidated) / lookups if lookups else 0.
+            }
@@ -0,0 +1,217 @@
+"""
+Near-duplicate detection between bible versions, with MinHash signatures and LSH banding.
+
+Verses are compared as sets of shingles (lowercased word n-grams, see get_shingles):
+two verses are near-duplicates when the Jaccard similarity of their shingle sets is at
+least a threshold, i.e. KJV and WBT verses that only differ by a word or two.
+
+Every verse of a version gets a MinHash signature (num_perm seeded hash minimums, whose
+agreement rate between two verses estimates their Jaccard similarity). Signatures are
+split into bands of rows: verses of two versions sharing a whole band land in the same
+bucket and become candidate pairs, which are then checked against the threshold. Only
+verses that share a bucket are ever compared, so finding every near-duplicate pair of
+two versions is sub-quadratic, moved or repeated verses included.
+
+Aligned texts (the texts of one verse) need no search: preprocess_filter_near_duplicates
+(see data_manager) compares them exactly with are_distinct_texts.
+"""
+
+from src.paths import TABLE_DIRECTORY, TABLE_NAME_FORMAT
+from src.table_cache import load_verse_table
+from src.verse_join import get_sorted_keys
+from src.preprocess import tokenize_words
+
+# Standard libraries
+import zlib
+from itertools import combinations
+
+# additional libraries (pip install ...)
+import numpy
+
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NUM_PERMUTATIONS = 128
+SHINGLE_SIZE = 2
+
+# minhash permutations are multiply-shift hashes of the 32 bit shingle hashes: the top 32 bits
+# of (a * x + b) mod 2^64, for random odd 64 bit a and random b
+MAX_HASH = (1 << 32) - 1
+
+# verses whose signatures are computed at once (bounds memory to ~ batch shingles * num_perm * 8 bytes)
+SIGNATURE_BATCH_SIZE = 1024
+
+def get_shingles(text: str, shingle_size: int = SHINGLE_SIZE) -> {str}:
+    """
+    Shingles of a text: its lowercased word n-grams, punctuation ignored (a text shorter than
+    shingle_size words is a single shingle), i.e. get_shingles('In the beginning, God') ->
+    {'in the', 'the beginning', 'beginning god'}
+    """
+    words = tokenize_words(text)
+
+    if len(words) <= shingle_size:
+        return { ' '.join(words) } if words else set()
+
+    return { ' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1) }
+
+def jaccard_similarity(shingles1: {str}, shingles2: {str}) -> float:
+    union = len(shingles1 | shingles2)
+    return len(shingles1 & shingles2) / union if union else 1.
+
+def are_distinct_texts(texts: [str], threshold: float = NEAR_DUPLICATE_THRESHOLD, shingle_size: int = SHINGLE_SIZE) -> bool:
+    """ Whether no two of texts (the texts of one verse) are near-duplicates, see the module docstring """
+    shingles = [get_shingles(text, shingle_size) for text in texts]
+    return all(jaccard_similarity(a, b) < threshold for (a, b) in combinations(shingles, 2))
+
+def get_band_parameters(threshold: float, num_perm: int = NUM_PERMUTATIONS) -> (int, int):
+    """
+    Returns (# bands, # rows per band), with bands * rows == num_perm, for the LSH to catch
+    pairs at the threshold: the most rows per band (fewest candidates) whose band threshold
+    (1 / bands) ** (1 / rows), the similarity at which a pair becomes likely to collide,
+    is still at most threshold.
+    """
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return max((option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold), key = lambda option: option[1], default = options[0])
+
+class MinHasher:
+    """
+    Computes MinHash signatures of texts (see the module docstring).
+
+    Keyword Arguments:
+        num_perm {int} -- number of hash permutations, the signature length (default: {NUM_PERMUTATIONS})
+        shingle_size {int} -- number of words per shingle (default: {SHINGLE_SIZE})
+        seed {int} -- seed of the permutations (default: {1})
+    """
+
+    def __init__(self, num_perm: int = NUM_PERMUTATIONS, shingle_size: int = SHINGLE_SIZE, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = numpy.random.default_rng(seed)
+        self.a = rng.integers(0, 1 << 64, num_perm, dtype = numpy.uint64, endpoint = False) | numpy.uint64(1)
+        self.b = rng.integers(0, 1 << 64, num_perm, dtype = numpy.uint64, endpoint = False)
+
+    def signatures(self, texts: [str]) -> numpy.ndarray:
+        """
+        Returns the (len(texts), num_perm) uint64 signatures of texts (32 bit values). Texts
+        without any word get MAX_HASH everywhere (and are never near-duplicates, see find_near_duplicates).
+        """
+        signatures = numpy.full((len(texts), self.num_perm), MAX_HASH, dtype = numpy.uint64)
+
+        for batch_start in range(0, len(texts), SIGNATURE_BATCH_SIZE):
+            shingles = [get_shingles(text, self.shingle_size) for text in texts[batch_start:batch_start + SIGNATURE_BATCH_SIZE]]
+            lengths = numpy.array([len(text_shingles) for text_shingles in shingles])
+            hashes = numpy.fromiter((zlib.crc32(shingle.encode('utf-8')) for text_shingles in shingles for shingle in text_shingles), dtype = numpy.uint64, count = int(lengths.sum()))
+
+            if len(hashes) == 0:
+                continue
+
+            # one row per permutation, so the minimums reduce over contiguous memory
+            values = (self.a[:, None] * hashes + self.b[:, None]) >> numpy.uint64(32)
+            nonempty = numpy.flatnonzero(lengths > 0)
+            starts = (numpy.cumsum(lengths) - lengths)[nonempty]
+            signatures[batch_start + nonempty] = numpy.minimum.reduceat(values, starts, axis = 1).T
+
+        return signatures
+
+def find_near_duplicates(signatures1: numpy.ndarray, signatures2: numpy.ndarray, threshold: float = NEAR_DUPLICATE_THRESHOLD) -> (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+    """
+    Finds the pairs of rows (one of each signature matrix, see MinHasher.signatures) whose
+    estimated similarity is at least threshold, using LSH banding.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray) -- rows of signatures1, rows of signatures2, estimated similarities
+
+    Example return:
+        (array([0, 1, 5, ...]), array([0, 1, 5, ...]), array([1., 0.875, 0.953, ...]))
+    """
+    (num_bands, num_rows) = get_band_parameters(threshold, signatures1.shape[1])
+    valid1 = numpy.flatnonzero(signatures1[:, 0] != MAX_HASH)
+    valid2 = numpy.flatnonzero(signatures2[:, 0] != MAX_HASH)
+    candidates = set()
+
+    for band in range(num_bands):
+        columns = slice(band * num_rows, (band + 1) * num_rows)
+        keys = numpy.ascontiguousarray(numpy.concatenate((signatures1[valid1, columns], signatures2[valid2, columns])))
+        (_, buckets) = numpy.unique(keys.view(numpy.dtype((numpy.void, keys.dtype.itemsize * num_rows))).ravel(), return_inverse = True)
+
+        buckets1 = buckets[:len(valid1)]
+        buckets2 = buckets[len(valid1):]
+
+        # only buckets holding rows of both sides make candidate pairs
+        shared = numpy.intersect1d(buckets1, buckets2)
+        rows1 = { bucket: [] for bucket in shared.tolist() }
+        rows2 = { bucket: [] for bucket in shared.tolist() }
+
+        for (row, bucket) in zip(valid1[numpy.isin(buckets1, shared)].tolist(), buckets1[numpy.isin(buckets1, shared)].tolist()):
+            rows1[bucket].append(row)
+        for (row, bucket) in zip(valid2[numpy.isin(buckets2, shared)].tolist(), buckets2[numpy.isin(buckets2, shared)].tolist()):
+            rows2[bucket].append(row)
+
+        candidates.update((row1, row2) for bucket in rows1 for row1 in rows1[bucket] for row2 in rows2[bucket])
+
+    if not candidates:
+        empty = numpy.zeros(0, dtype = numpy.int64)
+        return (empty, empty, numpy.zeros(0))
+
+    pairs = numpy.array(sorted(candidates), dtype = numpy.int64)
+    similarities = (signatures1[pairs[:, 0]] == signatures2[pairs[:, 1]]).mean(axis = 1)
+    selected = similarities >= threshold
+
+    return (pairs[selected, 0], pairs[selected, 1], similarities[selected])
+
+def get_version_signatures(table: str, minhasher: MinHasher) -> (numpy.ndarray, numpy.ndarray):
+    """
+    Returns the sorted packed verse ids of a verse table (a repeated id keeping its last text,
+    see verse_join.get_sorted_keys) and the MinHash signatures of their texts.
+    """
+    with load_verse_table(TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = table)) as verse_table:
+        (keys, last_rows, _) = get_sorted_keys(verse_table)
+        texts = [verse_table.text(row) for row in last_rows]
+
+    return (numpy.array(keys, dtype = numpy.int64), minhasher.signatures(texts))
+
+def get_near_duplicate_report(tables: [str], threshold: float = NEAR_DUPLICATE_THRESHOLD, num_perm: int = NUM_PERMUTATIONS, shingle_size: int = SHINGLE_SIZE, seed: int = 1) -> [dict]:
+    """
+    Finds the near-duplicate verses of every pair of verse tables. Signatures are computed
+    once per table.
+
+    Arguments:
+        tables {[str]} -- verse table names, i.e. ['t_asv', 't_kjv', 't_wbt']
+
+    Keyword Arguments:
+        threshold {float} -- minimum (estimated) Jaccard similarity of near-duplicates (default: {NEAR_DUPLICATE_THRESHOLD})
+        num_perm {int} -- signature length (default: {NUM_PERMUTATIONS})
+        shingle_size {int} -- number of words per shingle (default: {SHINGLE_SIZE})
+        seed {int} -- seed of the minhash permutations (default: {1})
+
+    Returns:
+        [dict] -- one entry per pair of tables: the number of shared verses, how many of them
+                  are near-duplicates (aligned), and the number of near-duplicate pairs of
+                  different verses (i.e. repeated or moved verses)
+
+    Example return:
+        [
+            { 'tables': ('t_asv', 't_kjv'), 'shared_verses': 31086, 'aligned_duplicates': 17754, 'aligned_fraction': 0.571, 'other_duplicates': 193 },
+            ...
+        ]
+    """
+    minhasher = MinHasher(num_perm, shingle_size, seed)
+    signatures = { table: get_version_signatures(table, minhasher) for table in tables }
+    report = []
+
+    for (table1, table2) in combinations(tables, 2):
+        (keys1, signatures1) = signatures[table1]
+        (keys2, signatures2) = signatures[table2]
+        (rows1, rows2, _) = find_near_duplicates(signatures1, signatures2, threshold)
+
+        aligned = keys1[rows1] == keys2[rows2]
+        shared_verses = len(numpy.intersect1d(keys1, keys2, assume_unique = True))
+
+        report.append({
+            'tables': (table1, table2),
+            'shared_verses': shared_verses,
+            'aligned_duplicates': int(aligned.sum()),
+            'aligned_fraction': float(aligned.sum() / shared_verses) if shared_verses else 0.,
+            'other_duplicates': int((~aligned).sum())
+        })
+
+    return report
@@ -0,0 +1,125 @@
+"""
+Vocabulary-level Old and Middle English normalization (cltk), as done by Demo.ipynb's _normalize.
+
+Both normalizations work word by word: Old English ('ang') words are ascii encoded
+(their trailing punctuation kept as is), Middle English ('enm') spellings are normalized
+(i.e. þ -> th). So instead of running cltk on every word of every verse, each distinct
+word form is normalized once, and texts are normalized with one dictionary lookup per word.
+
+The normalized forms of a table's vocabulary are stored under NORMALIZATION_CACHE_PATH,
+per (table, language code), and rebuilt when the table's csv file changes. Words that
+were never seen are normalized (once per process) on the fly.
+
+cltk is only imported when a word needs to be normalized.
+"""
+
+from src.paths import NORMALIZATION_CACHE_PATH, NORMALIZATION_FORMAT, TABLE_DIRECTORY, TABLE_NAME_FORMAT
+from src.table_cache import get_table_hash, load_verse_table
+
+# Standard libraries
+import json, os, tempfile
+from collections import defaultdict
+from pathlib import Path
+
+NORMALIZED_LANGUAGE_CODES = ('ang', 'enm')
+
+# punctuation kept as is by the old english normalization
+OLD_ENGLISH_DONT_NORMALIZE = '!?.&,:;"'
+
+# normalized word forms of this process, by language code
+_normalized_forms = defaultdict(dict)
+
+def normalize_word(word: str, language_code: str) -> str:
+    """ Applies the cltk normalization of a language to a single word (no memoization, see normalize_text) """
+    if language_code == 'ang':
+        from cltk.phonology.old_english.phonology import Word
+
+        if word[-1] in OLD_ENGLISH_DONT_NORMALIZE:
+            return Word(word[:-1]).ascii_encoding() + word[-1]
+
+        return Word(word).ascii_encoding()
+
+    if language_code == 'enm':
+        from cltk.corpus.middle_english.alphabet import normalize_middle_english
+        return normalize_middle_english(word, to_lower = False, alpha_conv = True, punct = False)
+
+    return word
+
+def normalize_vocabulary(words, language_code: str) -> {str: str}:
+    """ Returns the normalized form of each distinct word, normalizing only those that this process hasn't yet """
+    forms = _normalized_forms[language_code]
+
+    for word in set(words).difference(forms):
+        forms[word] = normalize_word(word, language_code)
+
+    return { word: forms[word] for word in set(words) }
+
+def normalize_text(text: str, language_code: str) -> str:
+    """
+    Normalizes a text, one memoized lookup per (whitespace separated) word: ascii encoding of
+    old english ('ang'), middle english ('enm') spelling normalization, nothing for other
+    languages. Whitespace runs become single spaces.
+    """
+    if language_code not in NORMALIZED_LANGUAGE_CODES:
+        return text
+
+    words = text.split()
+    forms = _normalized_forms[language_code]
+
+    try:
+        return ' '.join([forms[word] for word in words])
+    except KeyError:
+        normalize_vocabulary(words, language_code)
+        return ' '.join([forms[word] for word in words])
+
+def get_table_vocabulary(table: str) -> {str}:
+    """ Returns the distinct (whitespace separated) words of a verse table's texts """
+    vocabulary = set()
+
+    with load_verse_table(TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = table)) as verse_table:
+        for text in verse_table.texts():
+            vocabulary.update(text.split())
+
+    return vocabulary
+
+def load_normalization_table(table: str, language_code: str, directory: Path = NORMALIZATION_CACHE_PATH) -> {str: str}:
+    """
+    Returns the normalized form of every word of a verse table (see the module docstring),
+    reading it from its file unless the table changed since it was written, and adds them
+    to the normalized forms of this process.
+
+    Arguments:
+        table {str} -- verse table name, i.e. 't_wsg'
+        language_code {str} -- 'ang' or 'enm'
+
+    Keyword Arguments:
+        directory {Path} -- where the normalization tables are stored (default: {NORMALIZATION_CACHE_PATH})
+    """
+    path = directory / NORMALIZATION_FORMAT.format(table = table, language_code = language_code)
+    table_hash = get_table_hash(TABLE_DIRECTORY / TABLE_NAME_FORMAT.format(table = table)).hex()
+
+    try:
+        with open(path, 'r', encoding = 'utf-8') as file:
+            normalization_table = json.load(file)
+    except (OSError, ValueError):
+        normalization_table = None
+
+    if normalization_table is not None and normalization_table.get('table_hash') == table_hash:
+        forms = normalization_table['forms']
+        _normalized_forms[language_code].update(forms)
+        return forms
+
+    forms = normalize_vocabulary(get_table_vocabulary(table), language_code)
+
+    directory.mkdir(parents = True, exist_ok = True)
+    fd, temp_path = tempfile.mkstemp(dir = directory, prefix = f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'w', encoding = 'utf-8') as file:
+            json.dump({ 'table_hash': table_hash, 'language_code': language_code, 'forms': forms }, file, ensure_ascii = False)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return forms
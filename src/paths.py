@@ -8,12 +8,27 @@ DATA_RAW_PATH = DATA_PATH / 'raw'
 
 KEY_GENRE_ENGLISH_PATH = DATA_PATH / 'key_genre_english.csv'
 KEY_ENGLISH_PATH = DATA_PATH / 'key_english.csv'
+KEY_ABBREVIATIONS_ENGLISH_PATH = DATA_PATH / 'key_abbreviations_english.csv'
 TABLE_KEY_PATH = DATA_PATH / 't_key.csv'
 
 TABLE_DIRECTORY = DATA_PATH
 
 TABLE_NAME_FORMAT = '{table}.csv'
 SPLIT_DATASET_FORMAT = '{table}_{dataset}.txt'
+SPLIT_MANIFEST_PATH = DATA_SPLIT_PATH / 'manifest.json'
+SPLIT_INDEX_FORMAT = '{name}.idx'
+SPLIT_ASSIGNMENT_PATH = DATA_SPLIT_PATH / 'assignment.json'
+
+DATA_ARROW_PATH = DATA_PATH / 'arrow'
+ARROW_DATASET_FORMAT = '{dataset}.{format}'
+
+DATA_TOKENS_PATH = DATA_PATH / 'tokens'
+TOKENS_FORMAT = '{name}.tokens.npy'
+OFFSETS_FORMAT = '{name}.offsets.npy'
+VOCAB_FORMAT = 'vocab_{table}.json'
+
+DATA_CONCORDANCE_PATH = DATA_PATH / 'concordance'
+CONCORDANCE_MANIFEST_PATH = DATA_CONCORDANCE_PATH / 'manifest.json'
 
 HELSINKI_RAW_PATH = DATA_RAW_PATH / 'helsinki'
 HELSINKI_RAW_TAR_PATH = f'{HELSINKI_RAW_PATH}.tar.gz'
@@ -30,3 +45,13 @@ AELFRIC_CSV_PATH = DATA_PATH / "t_alf.csv"
 
 MISC_TEXTS_PATH = DATA_PATH / "misc_texts"
 MISC_TEXTS_KEY_PATH = MISC_TEXTS_PATH / "t_key.csv"
+
+DATA_CACHE_PATH = DATA_PATH / 'cache'
+TABLE_CACHE_FORMAT = '{table}.bin'
+VERSE_INDEX_FORMAT = '{table}.verses.idx'
+DATASET_CACHE_PATH = DATA_CACHE_PATH / 'datasets'
+TRANSLATION_CACHE_PATH = DATA_CACHE_PATH / 'translations.sqlite'
+VERSE_SCORES_CACHE_PATH = DATA_CACHE_PATH / 'verse_scores.sqlite'
+NORMALIZATION_CACHE_PATH = DATA_CACHE_PATH / 'normalization'
+NORMALIZATION_FORMAT = '{table}.{language_code}.json'
+HTTP_CACHE_PATH = DATA_RAW_PATH / 'http_cache'
@@ -0,0 +1,365 @@
+"""
+Declarative preprocess operations and the engine that runs them.
+
+A preprocess operation is either a filter (drops a verse unless a feature of every
+one of its texts, e.g. its number of words, is within bounds), a verse filter (drops
+a verse depending on all of its texts at once, e.g. near-duplicate versions) or a
+transform (maps each text to a new text). Because operations describe themselves instead of being
+opaque functions over the whole verse dictionary, the engine can:
+
+- fuse them into a single pass per verse, instead of one pass (and one new dict)
+  per operation
+- run filters before transforms when that cannot change the result: a filter can
+  move in front of transforms that leave its feature unchanged, and a bound check
+  can move in front of transforms that only move the feature away from that bound
+  (e.g. a max_num_words check in front of transforms that never remove words)
+- short-circuit across a verse's versions: texts are processed one version at a
+  time, so as soon as one text fails a filter, the other versions are skipped
+- report the time spent and the number of verses dropped per operation
+
+Filters that run before any transform only depend on the raw texts, whose features
+are precomputed in the table cache, so create_datasets evaluates them as vectorized
+masks over the joined tables before any text is decoded (see split_leading_filters).
+"""
+
+# Standard libraries
+import copy, re
+from collections import defaultdict
+from time import perf_counter
+from typing import Callable
+
+SENTENCE_DELIMITER = re.compile(r'[.!?].')
+
+# word forms: letters and digits (including þ, ð, æ, ...), with inner apostrophes (it's, o'er)
+WORD_PATTERN = re.compile(r"\w+(?:'\w+)*")
+
+def count_words(text: str) -> int:
+    """ Number of words in a text, split on whitespace """
+    return len(text.split())
+
+def count_sentences(text: str) -> int:
+    """ Number of sentences in a text, split on .!? followed by a character """
+    return len(re.split(SENTENCE_DELIMITER, text))
+
+def count_characters(text: str) -> int:
+    """ Number of characters in a text """
+    return len(text)
+
+def tokenize_words(text: str) -> [str]:
+    """ Lowercased word forms of a text, i.e. "It's the Lord's." -> ["it's", 'the', "lord's"] """
+    return WORD_PATTERN.findall(text.lower())
+
+# features that filters can bound, and their relative cost (cheapest filters run first)
+FEATURES = {
+    'num_words': (count_words, 1),
+    'num_sentences': (count_sentences, 2),
+    'num_characters': (count_characters, 0)
+}
+
+# how a transform changes a feature, see PreprocessTransform
+SAME = 'same'
+NONDECREASING = 'nondecreasing'
+NONINCREASING = 'nonincreasing'
+
+class PreprocessOperation:
+    """
+    Base class of the preprocess operations. Operations are still callable on a
+    whole shared verses dictionary (see data_manager.run_preprocess_operations),
+    so they can be used anywhere the old dict -> dict lambdas were.
+    """
+    name = None
+    params = {}
+
+    def __call__(self, shared_verses: dict) -> dict:
+        return run_fused_operations(shared_verses, [self])
+
+    def describe(self) -> str:
+        """ Canonical description of the operation and its parameters, i.e. 'filter_num_words(max = 35, min = 4)' """
+        return f"{self.name}({', '.join(f'{k} = {v!r}' for (k, v) in sorted(self.params.items()))})"
+
+    def __repr__(self) -> str:
+        return self.describe()
+
+class PreprocessFilter(PreprocessOperation):
+    """
+    Keeps a verse only if min_value <= feature(text) <= max_value for every one of its texts.
+
+    Arguments:
+        name {str} -- operation name
+        feature {str} -- name of the bounded feature, a key of FEATURES
+
+    Keyword Arguments:
+        min_value {int or None} -- minimum feature value, None for no minimum (default: {None})
+        max_value {int or None} -- maximum feature value, None for no maximum (default: {None})
+    """
+    kind = 'filter'
+
+    def __init__(self, name: str, feature: str, min_value: int or None = None, max_value: int or None = None):
+        self.name = name
+        self.feature = feature
+        self.min_value = min_value
+        self.max_value = max_value
+        self.params = { 'min': min_value, 'max': max_value }
+        self.function, self.cost = FEATURES[feature]
+
+    def accepts(self, text: str) -> bool:
+        value = self.function(text)
+        return (self.min_value is None or self.min_value <= value) and (self.max_value is None or value <= self.max_value)
+
+    def bound_check(self, bound: str) -> 'PreprocessFilter':
+        """ A filter checking only one of this filter's bounds, 'min' or 'max' """
+        return PreprocessFilter(f'{self.name} ({bound} pre-check)', self.feature,
+            min_value = self.min_value if bound == 'min' else None,
+            max_value = self.max_value if bound == 'max' else None)
+
+class PreprocessTransform(PreprocessOperation):
+    """
+    Maps each text of a verse to function(text, **params). The function must be defined
+    at module level (so operations can be sent to worker processes). A transform given
+    tables only maps the texts of those tables, once bound to the order of the verses'
+    texts (see bind_tables), and leaves the other texts untouched.
+
+    Arguments:
+        name {str} -- operation name
+        function {Callable[..., str]} -- the transform, called as function(text, **params)
+
+    Keyword Arguments:
+        params {dict} -- keyword arguments of function (default: {{}})
+        effects {{str: str}} -- how the transform changes each feature it is known to affect
+                                predictably: SAME, NONDECREASING or NONINCREASING. Features that
+                                are left out are assumed to change unpredictably (default: {{}})
+        tables {[str] or None} -- names of the tables whose texts are mapped, None for every text (default: {None})
+    """
+    kind = 'transform'
+
+    def __init__(self, name: str, function: Callable[..., str], params: dict = {}, effects: {str: str} = {}, tables: [str] or None = None):
+        self.name = name
+        self.function = function
+        self.params = dict(params)
+        self.effects = dict(effects)
+        self.tables = list(tables) if tables is not None else None
+        # indexes of the mapped texts in a verse, None for every text (set by bind)
+        self.columns = None
+
+    def describe(self) -> str:
+        """ Same as PreprocessOperation.describe, followed by the tables if any, i.e. "normalize(language_code = 'enm') on t_wyc" """
+        description = super().describe()
+        return description if self.tables is None else f"{description} on {', '.join(self.tables)}"
+
+    def bind(self, table_names: [str]) -> 'PreprocessTransform':
+        """ This transform, for verses whose texts are those of table_names, in order """
+        if self.tables is None:
+            return self
+
+        transform = copy.copy(self)
+        transform.columns = frozenset(i for (i, table) in enumerate(table_names) if table in self.tables)
+        return transform
+
+    def apply(self, text: str) -> str:
+        return self.function(text, **self.params)
+
+class PreprocessVerseFilter(PreprocessOperation):
+    """
+    Keeps a verse only if function(texts, **params) is true, texts being every one of its
+    texts (one per version), for filters that compare versions, i.e. near-duplicate pairs.
+    The function must be defined at module level (so operations can be sent to worker processes).
+
+    Arguments:
+        name {str} -- operation name
+        function {Callable[..., bool]} -- the check, called as function(texts, **params)
+
+    Keyword Arguments:
+        params {dict} -- keyword arguments of function (default: {{}})
+    """
+    kind = 'verse_filter'
+
+    def __init__(self, name: str, function: Callable[..., bool], params: dict = {}):
+        self.name = name
+        self.function = function
+        self.params = dict(params)
+
+    def accepts_verse(self, texts: [str]) -> bool:
+        return self.function(texts, **self.params)
+
+class PreprocessStats:
+    """
+    Time spent and verses dropped per preprocess operation (in execution order).
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.dropped = defaultdict(int)
+
+    def merge(self, other: 'PreprocessStats'):
+        for (name, seconds) in other.seconds.items():
+            self.seconds[name] += seconds
+        for (name, dropped) in other.dropped.items():
+            self.dropped[name] += dropped
+
+    def report(self) -> str:
+        """
+        Example output:
+            operation                                     time (s)   # dropped
+            filter_num_words (max pre-check)                 0.012       9,906
+            expand_contractions                              0.405           0
+            ...
+        """
+        lines = [f"{'operation':45} {'time (s)':>8} {'# dropped':>11}"]
+        lines += [f'{name:45} {seconds:8.3f} {self.dropped[name]:11,d}' for (name, seconds) in self.seconds.items()]
+        return '\n'.join(lines)
+
+def bind_tables(operations: [PreprocessOperation], table_names: [str]) -> [PreprocessOperation]:
+    """ Binds the transforms of a list of operations to the tables of the verses' texts, in order (see PreprocessTransform.bind) """
+    return [operation.bind(table_names) if isinstance(operation, PreprocessTransform) else operation for operation in operations]
+
+def _is_safe_to_hoist(transforms: [PreprocessTransform], feature: str, allowed: {str}) -> bool:
+    return all(transform.effects.get(feature) in allowed for transform in transforms)
+
+def plan_operations(operations: [PreprocessOperation]) -> [PreprocessOperation]:
+    """
+    Returns the order in which to run a list of preprocess operations, hoisting
+    filters (or some of their bounds) in front of transforms when that provably
+    yields the same result as running the operations in the given order.
+    """
+    hoisted = []
+    plan = []
+    transforms = []
+
+    for operation in operations:
+        if operation.kind == 'transform':
+            transforms.append(operation)
+            plan.append(operation)
+        elif operation.kind == 'verse_filter':
+            # never moves: it sees the texts as transformed so far, all versions at once
+            plan.append(operation)
+        elif _is_safe_to_hoist(transforms, operation.feature, {SAME}):
+            hoisted.append(operation)
+        else:
+            plan.append(operation)
+
+            # the exact filter stays in place, but a bound that no preceding transform can
+            # bring a text back within can be checked up front as well
+            if operation.max_value is not None and _is_safe_to_hoist(transforms, operation.feature, {SAME, NONDECREASING}):
+                hoisted.append(operation.bound_check('max'))
+            if operation.min_value is not None and _is_safe_to_hoist(transforms, operation.feature, {SAME, NONINCREASING}):
+                hoisted.append(operation.bound_check('min'))
+
+    return sorted(hoisted, key = lambda operation: operation.cost) + plan
+
+def _count_leading_filters(plan: [PreprocessOperation]) -> int:
+    return next((i for (i, operation) in enumerate(plan) if operation.kind != 'filter'), len(plan))
+
+def _split_stages(pipeline: [PreprocessOperation]) -> [([PreprocessOperation], PreprocessVerseFilter or None)]:
+    """ Splits a plan into stages of per text operations, each followed by a verse filter (None for the last stage) """
+    stages = [([], None)]
+
+    for operation in pipeline:
+        if operation.kind == 'verse_filter':
+            stages[-1] = (stages[-1][0], operation)
+            stages.append(([], None))
+        else:
+            stages[-1][0].append(operation)
+
+    return stages
+
+def split_leading_filters(operations: [PreprocessOperation]) -> ([PreprocessFilter], [PreprocessOperation]):
+    """
+    Splits the plan of a list of preprocess operations (see plan_operations) into its leading
+    filters, which only ever see the raw texts and so can be evaluated from the features
+    precomputed in the table cache (see verse_join.filter_joined_rows), and the operations
+    left to run after them.
+    """
+    plan = plan_operations(operations)
+    num_leading_filters = _count_leading_filters(plan)
+
+    return plan[:num_leading_filters], plan[num_leading_filters:]
+
+def run_fused_operations(shared_verses: dict, operations: [PreprocessOperation], stats: PreprocessStats or None = None) -> dict:
+    """
+    Runs preprocess operations over a shared verses dictionary (see
+    data_manager.get_shared_bible_verses) in a single pass per verse, returning
+    a new dictionary with the same result as running them one after the other.
+
+    Arguments:
+        shared_verses {{VerseIdentifier: [str]}} -- the verses to preprocess
+        operations {[PreprocessOperation]} -- the operations, in their semantic order
+
+    Keyword Arguments:
+        stats {PreprocessStats or None} -- collects per operation time and drop counts (default: {None})
+    """
+    plan = plan_operations(operations)
+    stats = stats if stats is not None else PreprocessStats()
+
+    for operation in plan:
+        if operation.kind == 'transform' and operation.tables is not None and operation.columns is None:
+            raise ValueError(f'{operation.describe()} only maps some tables, bind it to the order of the texts first (see bind_tables)')
+    seconds = { operation.name: 0. for operation in plan }
+    dropped = dict.fromkeys(seconds, 0)
+
+    # leading filters can be checked on every text before any transform runs
+    num_leading_filters = _count_leading_filters(plan)
+    leading_filters, pipeline = plan[:num_leading_filters], plan[num_leading_filters:]
+    stages = _split_stages(pipeline)
+
+    result = {}
+
+    for (verse_id, texts) in shared_verses.items():
+        failed = None
+
+        for operation in leading_filters:
+            start = perf_counter()
+            passed = all(operation.accepts(text) for text in texts)
+            seconds[operation.name] += perf_counter() - start
+
+            if not passed:
+                failed = operation
+                break
+
+        for (operations, verse_filter) in stages if failed is None else ():
+            new_texts = []
+
+            # one version at a time through the operations of the stage, stopping at the first failure
+            for (column, text) in enumerate(texts):
+                for operation in operations:
+                    start = perf_counter()
+
+                    if operation.kind == 'transform':
+                        if operation.columns is None or column in operation.columns:
+                            text = operation.apply(text)
+                    elif not operation.accepts(text):
+                        failed = operation
+
+                    seconds[operation.name] += perf_counter() - start
+
+                    if failed is not None:
+                        break
+
+                if failed is not None:
+                    break
+
+                new_texts.append(text)
+
+            texts = new_texts
+
+            # then all versions at once through the verse filter closing the stage
+            if failed is None and verse_filter is not None:
+                start = perf_counter()
+
+                if not verse_filter.accepts_verse(texts):
+                    failed = verse_filter
+
+                seconds[verse_filter.name] += perf_counter() - start
+
+            if failed is not None:
+                break
+
+        if failed is None:
+            result[verse_id] = texts
+        else:
+            dropped[failed.name] += 1
+
+    for name in seconds:
+        stats.seconds[name] += seconds[name]
+        stats.dropped[name] += dropped[name]
+
+    return result
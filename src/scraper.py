@@ -0,0 +1,187 @@
+"""
+Asynchronous scraping engine: concurrent downloads, rate limited per host, parsed on worker threads.
+
+Pages are downloaded with a pooled requests.Session (connections are kept alive and
+reused) from a bounded number of download threads, driven by asyncio, so at most
+max_in_flight requests are in flight at once. Every host has its own token bucket:
+it allows a burst of requests, then requests_per_second on average, instead of a fixed
+sleep after every page. Responses are parsed on a separate pool of threads, so parsing
+never holds up the downloads.
+
+Example usage:
+    async def collect(scraper: AsyncScraper) -> [BeautifulSoup]:
+        return await scraper.map(urls, parse_html)
+
+    with AsyncScraper(requests_per_second = 2) as scraper:
+        pages = scraper.run(collect(scraper))
+"""
+
+from src.http_cache import ResponseCache
+
+# Standard libraries
+import asyncio, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from urllib.parse import urlparse
+import requests
+
+# additional libraries (pip install ...)
+from bs4 import BeautifulSoup
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_REQUESTS_PER_SECOND = 2.
+DEFAULT_BURST = 4
+DEFAULT_TIMEOUT = 30.
+DEFAULT_MAX_RETRIES = 3
+
+# statuses worth retrying (after a backoff), any other error status is raised
+RETRY_STATUSES = { 429, 500, 502, 503, 504 }
+RETRY_BACKOFF = 2.
+
+USER_AGENT = 'custom-user-agent'
+
+class TokenBucket:
+    """
+    Asyncio token bucket: holds up to capacity tokens, refilled at rate tokens per second,
+    and acquire waits for a token.
+
+    Arguments:
+        rate {float} -- tokens added per second
+        capacity {int} -- maximum number of tokens (the burst size)
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # the lock queues the waiters, so tokens are handed out in order
+        async with self.lock:
+            self._refill()
+
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+
+            self.tokens -= 1
+
+def parse_html(response: requests.Response, parser: str = 'html.parser') -> BeautifulSoup:
+    return BeautifulSoup(response.text, parser)
+
+class AsyncScraper:
+    """
+    Downloads and parses pages concurrently (see the module docstring). Use it as a context
+    manager, or call close when done.
+
+    Keyword Arguments:
+        max_in_flight {int} -- maximum number of concurrent requests (default: {DEFAULT_MAX_IN_FLIGHT})
+        requests_per_second {float} -- average request rate allowed per host (default: {DEFAULT_REQUESTS_PER_SECOND})
+        burst {int} -- requests allowed at once per host, before the rate applies (default: {DEFAULT_BURST})
+        max_parse_workers {int} -- number of parsing threads (default: {4})
+        timeout {float} -- seconds to wait for a response (default: {DEFAULT_TIMEOUT})
+        max_retries {int} -- retries of a request failing with a RETRY_STATUSES status or a connection error (default: {DEFAULT_MAX_RETRIES})
+        session {requests.Session or None} -- the session, None for a new one (default: {None})
+        cache {ResponseCache or None} -- persistent response cache the pages go through (see src/http_cache.py) (default: {None})
+    """
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND, burst: int = DEFAULT_BURST, max_parse_workers: int = 4, timeout: float = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES, session: requests.Session or None = None, cache: ResponseCache or None = None):
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.cache = cache
+
+        if session is None:
+            session = requests.Session()
+            session.headers.update({ 'User-Agent': USER_AGENT })
+
+        # one pooled connection per download thread, per host
+        adapter = requests.adapters.HTTPAdapter(pool_connections = max_in_flight, pool_maxsize = max_in_flight)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        self.session = session
+        self.download_executor = ThreadPoolExecutor(max_workers = max_in_flight, thread_name_prefix = 'download')
+        self.parse_executor = ThreadPoolExecutor(max_workers = max_parse_workers, thread_name_prefix = 'parse')
+        self.buckets = {}
+        self.in_flight = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, coroutine):
+        """ Runs a coroutine using this scraper to completion, returning its result """
+        # the rate limiters and in-flight slots belong to one event loop
+        self.buckets = {}
+        self.in_flight = None
+
+        return asyncio.run(coroutine)
+
+    def _get_bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.requests_per_second, self.burst)
+
+        return self.buckets[host]
+
+    def _get(self, url: str) -> requests.Response:
+        if self.cache is not None:
+            return self.cache.get(url, self.session, self.timeout)
+
+        return self.session.get(url, timeout = self.timeout)
+
+    async def fetch(self, url: str) -> requests.Response:
+        """ Downloads a page, waiting for an in-flight slot and for its host's rate limit, raising HTTPError on error statuses """
+        loop = asyncio.get_running_loop()
+
+        # offline, cached pages need neither a slot nor a token
+        if self.cache is not None and self.cache.offline:
+            return await loop.run_in_executor(self.download_executor, self._get, url)
+
+        # created on first use, in the running event loop
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        for attempt in range(self.max_retries + 1):
+            await self._get_bucket(url).acquire()
+
+            async with self.in_flight:
+                try:
+                    response = await loop.run_in_executor(self.download_executor, self._get, url)
+                except requests.exceptions.ConnectionError:
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+
+            if response is not None and (response.status_code not in RETRY_STATUSES or attempt == self.max_retries):
+                response.raise_for_status()
+                return response
+
+            await asyncio.sleep(RETRY_BACKOFF ** attempt)
+
+    async def parse(self, url: str, parse: Callable[[requests.Response], object] = parse_html) -> object:
+        """ Downloads a page, then parses it on a parsing thread, returning parse(response) """
+        response = await self.fetch(url)
+        return await asyncio.get_running_loop().run_in_executor(self.parse_executor, parse, response)
+
+    async def map(self, urls: [str], parse: Callable[[requests.Response], object] = parse_html) -> [object]:
+        """ Downloads and parses pages concurrently, returning the parse results in the order of urls """
+        return await asyncio.gather(*(self.parse(url, parse) for url in urls))
+
+    def close(self):
+        self.download_executor.shutdown()
+        self.parse_executor.shutdown()
+        self.session.close()
@@ -0,0 +1,109 @@
+"""
+Stable, hash-based assignment of verses to the dataset splits.
+
+Test verses are still chosen by book (see data_manager.get_test_bible_book_ids). Every
+other verse goes to training if a seeded hash of its packed verse id, scaled to [0, 1),
+is below training_fraction, otherwise to validation. The assignment of a verse only
+depends on its id, the seed and the training fraction: not on the other verses, the
+random state, or the order verses are seen in. So it is O(1) per verse, streamable and
+shardable, and adding a version (or a preprocess filter) only removes verses from the
+split, it never moves the remaining ones to another dataset.
+
+Assignments are recorded in a manifest (SPLIT_ASSIGNMENT_PATH), which accumulates every
+verse assigned with the same parameters, so consumers can look up the dataset of any
+verse without recomputing the split.
+"""
+
+from src.paths import SPLIT_ASSIGNMENT_PATH
+from src.verse_join import encode_verse_id
+
+# Standard libraries
+import hashlib, json, os, tempfile
+from pathlib import Path
+
+SPLIT_ASSIGNMENT_VERSION = 1
+SPLIT_HASH = 'blake2b-64'
+
+def hash_verse_fraction(verse_id: int, seed: int = 0) -> float:
+    """ Seeded hash of a packed verse id (see verse_join.encode_verse_id), scaled to [0, 1) """
+    digest = hashlib.blake2b(verse_id.to_bytes(8, 'little'), digest_size = 8, key = str(seed).encode('utf-8')).digest()
+    return int.from_bytes(digest, 'little') / 2 ** 64
+
+class SplitAssignment:
+    """
+    Arguments:
+        training_fraction {float} -- fraction of non-test verses assigned to training
+        test_book_ids {[int]} -- books whose verses are assigned to test
+
+    Keyword Arguments:
+        seed {int} -- seed of the hash (default: {0})
+        datasets {{int: str}} -- previously recorded datasets by packed verse id (default: {None})
+    """
+
+    def __init__(self, training_fraction: float, test_book_ids: [int], seed: int = 0, datasets: {int: str} or None = None):
+        self.training_fraction = training_fraction
+        self.test_book_ids = set(test_book_ids)
+        self.seed = seed
+        self.datasets = datasets if datasets is not None else {}
+
+    @property
+    def parameters(self) -> dict:
+        return {
+            'training_fraction': self.training_fraction,
+            'test_books': sorted(self.test_book_ids),
+            'seed': self.seed,
+            'hash': SPLIT_HASH
+        }
+
+    def assign(self, book: int, chapter: int, verse: int) -> str:
+        """ Returns the dataset of a verse, 'training', 'validation' or 'test', and records it """
+        verse_id = encode_verse_id(book, chapter, verse)
+        dataset = self.datasets.get(verse_id)
+
+        if dataset is None:
+            if book in self.test_book_ids:
+                dataset = 'test'
+            elif hash_verse_fraction(verse_id, self.seed) < self.training_fraction:
+                dataset = 'training'
+            else:
+                dataset = 'validation'
+
+            self.datasets[verse_id] = dataset
+
+        return dataset
+
+    def save(self, path: Path = SPLIT_ASSIGNMENT_PATH):
+        """ Writes the assignment manifest, with the sorted verse ids of each dataset """
+        verse_ids = { 'training': [], 'validation': [], 'test': [] }
+
+        for (verse_id, dataset) in sorted(self.datasets.items()):
+            verse_ids[dataset].append(verse_id)
+
+        path.parent.mkdir(parents = True, exist_ok = True)
+        fd, temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+
+        try:
+            with os.fdopen(fd, 'w', encoding = 'utf-8') as file:
+                json.dump({ 'version': SPLIT_ASSIGNMENT_VERSION, 'parameters': self.parameters, 'verse_ids': verse_ids }, file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+def load_split_assignment(training_fraction: float, test_book_ids: [int], seed: int = 0, path: Path = SPLIT_ASSIGNMENT_PATH) -> SplitAssignment:
+    """
+    Returns the split assignment with the given parameters, along with the verses already
+    recorded in the manifest at path if it was written with the same parameters.
+    """
+    assignment = SplitAssignment(training_fraction, test_book_ids, seed)
+
+    try:
+        with open(path, 'r', encoding = 'utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return assignment
+
+    if manifest.get('version') == SPLIT_ASSIGNMENT_VERSION and manifest['parameters'] == assignment.parameters:
+        assignment.datasets = { verse_id: dataset for (dataset, verse_ids) in manifest['verse_ids'].items() for verse_id in verse_ids }
+
+    return assignment
@@ -0,0 +1,322 @@
+"""
+Atomic writing of the dataset split files (data/split), with a manifest.
+
+Every split file is written to a temporary file next to it and renamed into place
+once complete, so a reader never observes a half written file. Files whose content
+hash matches the previous manifest are left untouched (the temporary file is simply
+dropped), and files from a previous run that are no longer part of the split are
+removed. The manifest (SPLIT_MANIFEST_PATH) is written last, recording for each file
+its sha256 hash, line count and size, along with the parameters that generated the
+split, so consumers can check it instead of re-reading the files.
+
+Each split file also gets a line offset index (SPLIT_INDEX_FORMAT), so it can be
+opened as a lazy SplitLines sequence: memory-mapped, with random access by line,
+decoding only the lines that are accessed.
+"""
+
+from src.paths import DATA_SPLIT_PATH, SPLIT_DATASET_FORMAT, SPLIT_MANIFEST_PATH, SPLIT_INDEX_FORMAT
+
+# Standard libraries
+import hashlib, json, mmap, os, struct, tempfile
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+
+SPLIT_MANIFEST_VERSION = 1
+
+INDEX_MAGIC = b'ALFLINES'
+INDEX_FORMAT_VERSION = 1
+
+# magic, format version, split file mtime (ns), split file size, # lines
+INDEX_HEADER = struct.Struct('=8sIqqQ')
+
+def read_split_manifest(manifest_path: Path = SPLIT_MANIFEST_PATH) -> dict or None:
+    """
+    Returns the manifest of the split files, or None if there is none (or it was written
+    by a different version).
+
+    Example return:
+        {
+            'version': 1,
+            'parameters': { 'tables': ['t_asv', 't_bbe'], 'training_fraction': 0.8, ... },
+            'files': {
+                't_asv_training.txt': { 'dataset': 'training', 'table': 't_asv', 'sha256': '3f5a...', 'num_lines': 17396, 'size': 2345678 },
+                ...
+            }
+        }
+    """
+    try:
+        with open(manifest_path, 'r', encoding = 'utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    return manifest if manifest.get('version') == SPLIT_MANIFEST_VERSION else None
+
+def is_split_up_to_date(parameters: dict, manifest_path: Path = SPLIT_MANIFEST_PATH) -> bool:
+    """
+    Cheap check (one stat call per file) of whether the split files were generated with
+    the given parameters and are still the files described by the manifest.
+    """
+    manifest = read_split_manifest(manifest_path)
+
+    if manifest is None or manifest['parameters'] != parameters:
+        return False
+
+    for (name, entry) in manifest['files'].items():
+        try:
+            if os.stat(manifest_path.parent / name).st_size != entry['size']:
+                return False
+        except OSError:
+            return False
+
+    return True
+
+def _write_atomic(path: Path, data: bytes):
+    fd, temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def _get_index_path(path: Path) -> Path:
+    return path.with_name(SPLIT_INDEX_FORMAT.format(name = path.name))
+
+def build_line_index(data: bytes) -> array:
+    """
+    Returns the line offsets of newline separated data, as an array('q') of the start of
+    every line, followed by the end of the data plus one (as if it ended with a newline),
+    so line i spans data[offsets[i]:offsets[i + 1] - 1]. Lines are counted like
+    str.splitlines: empty data has no lines, and a trailing newline doesn't start one.
+    """
+    offsets = array('q')
+    size = len(data)
+
+    if size > 0:
+        if data[size - 1:size] == b'\n':
+            size -= 1
+
+        start = 0
+
+        while start != -1:
+            offsets.append(start)
+            end = data.find(b'\n', start, size)
+            start = end + 1 if end != -1 else -1
+
+    offsets.append(size + 1)
+
+    return offsets
+
+def write_line_index(path: Path, offsets: array):
+    """ Writes the line offset index of a split file, stamped with the file's current mtime and size """
+    stat = os.stat(path)
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size, len(offsets) - 1)
+    _write_atomic(_get_index_path(path), header + offsets.tobytes())
+
+def read_line_index(path: Path, data: bytes or None = None) -> array:
+    """
+    Returns the line offset index of a split file (see build_line_index), from its index
+    file if that is up to date with the split file, otherwise building (from data, the
+    file's contents, if given) and persisting it.
+    """
+    stat = os.stat(path)
+
+    try:
+        with open(_get_index_path(path), 'rb') as file:
+            (magic, version, mtime_ns, size, num_lines) = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+
+            if (magic, version, mtime_ns, size) == (INDEX_MAGIC, INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size):
+                offsets = array('q')
+                offsets.frombytes(file.read(8 * (num_lines + 1)))
+
+                if len(offsets) == num_lines + 1:
+                    return offsets
+    except (OSError, struct.error):
+        pass
+
+    offsets = build_line_index(data if data is not None else Path(path).read_bytes())
+    write_line_index(path, offsets)
+
+    return offsets
+
+class SplitLines(Sequence):
+    """
+    Read-only, lazy list of the lines of a split file. The file is memory-mapped and
+    indexed by line (see read_line_index), and a line is only decoded when accessed.
+    Supports len(), indexing, slicing (which returns a list, like a list slice) and
+    iteration, so it can stand in for the list of verses returned by create_datasets.
+
+    The file map stays valid even if the split files are rewritten, since split files
+    are replaced by renaming new files over them (see SplitWriter).
+
+    Arguments:
+        path {Path} -- path of the split file
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as file:
+            # empty files cannot be memory-mapped, and have no lines anyway
+            self._map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size > 0 else b''
+
+        self._offsets = read_line_index(self.path, self._map)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _line(self, index: int) -> str:
+        line = self._map[self._offsets[index]:self._offsets[index + 1] - 1].decode('utf-8')
+
+        # files written in text mode on windows
+        return line[:-1] if line.endswith('\r') else line
+
+    def __getitem__(self, index: int or slice) -> str or [str]:
+        if isinstance(index, slice):
+            return [self._line(i) for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('split line index out of range')
+
+        return self._line(index)
+
+    def __iter__(self):
+        return (self._line(i) for i in range(len(self)))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, (SplitLines, list)) and len(self) == len(other) and all(a == b for (a, b) in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f'SplitLines({str(self.path)!r}, {len(self)} lines)'
+
+    def close(self):
+        isinstance(self._map, mmap.mmap) and self._map.close()
+
+class _PendingFile:
+    """ A split file being written to a temporary file, hashing and counting lines as it goes """
+
+    def __init__(self, directory: Path, name: str):
+        self.name = name
+        fd, self.temp_path = tempfile.mkstemp(dir = directory, prefix = f'.{name}.')
+        self.file = os.fdopen(fd, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.offsets = array('q')
+        self.num_lines = 0
+        self.size = 0
+
+    def write_line(self, text: str):
+        # lines are separated, not terminated, by newlines (no trailing newline)
+        data = (text if self.num_lines == 0 else '\n' + text).encode('utf-8')
+        self.offsets.append(self.size if self.num_lines == 0 else self.size + 1)
+        self.last_line = text
+        self.file.write(data)
+        self.sha256.update(data)
+        self.num_lines += 1
+        self.size += len(data)
+
+    def get_line_index(self) -> array:
+        """ Same as build_line_index on the written data (which drops a last empty line, like str.splitlines) """
+        if self.num_lines > 0 and self.last_line == '':
+            return self.offsets[:-1] + array('q', [self.size])
+
+        return self.offsets + array('q', [self.size + 1])
+
+class SplitWriter:
+    """
+    Writes a full set of split files atomically (see the module docstring). Files are
+    only renamed into place, and the manifest written, on commit; abort (or an exception
+    inside a with block) discards everything written so far.
+
+    Keyword Arguments:
+        parameters {dict} -- json-serializable parameters that generated the split, stored in the manifest (default: {{}})
+        directory {Path} -- where the split files are written (default: {DATA_SPLIT_PATH})
+
+    Example usage:
+        with SplitWriter({ 'seed': 1 }) as writer:
+            writer.add_file('training', 't_asv')
+            writer.write_line('training', 't_asv', 'In the beginning God created the heavens and the earth.')
+    """
+
+    def __init__(self, parameters: dict = {}, directory: Path = DATA_SPLIT_PATH):
+        self.parameters = parameters
+        self.directory = directory
+        self.files = {}
+
+        directory.mkdir(parents = True, exist_ok = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def add_file(self, dataset: str, table: str):
+        """ Adds a (so far empty) split file, if it wasn't added yet """
+        if (dataset, table) not in self.files:
+            self.files[dataset, table] = _PendingFile(self.directory, SPLIT_DATASET_FORMAT.format(dataset = dataset, table = table))
+
+    def write_line(self, dataset: str, table: str, text: str):
+        """ Appends one line (verse) to a split file """
+        self.add_file(dataset, table)
+        self.files[dataset, table].write_line(text)
+
+    def commit(self) -> dict:
+        """
+        Moves the changed files into place, removes files that are no longer part of the
+        split, then writes and returns the new manifest.
+        """
+        previous_files = (read_split_manifest(self.directory / SPLIT_MANIFEST_PATH.name) or { 'files': {} })['files']
+        files = {}
+
+        for ((dataset, table), pending) in self.files.items():
+            pending.file.close()
+            path = self.directory / pending.name
+            entry = {
+                'dataset': dataset,
+                'table': table,
+                'sha256': pending.sha256.hexdigest(),
+                'num_lines': pending.num_lines,
+                'size': pending.size
+            }
+
+            if previous_files.get(pending.name) == entry and path.exists() and path.stat().st_size == pending.size:
+                os.unlink(pending.temp_path)
+            else:
+                os.replace(pending.temp_path, path)
+                write_line_index(path, pending.get_line_index())
+
+            files[pending.name] = entry
+
+        # split files (and their indexes) from a previous run (with or without a manifest) that aren't part of this one
+        for path in self.directory.glob('*.txt'):
+            if path.name not in files:
+                os.unlink(path)
+        for path in self.directory.glob(SPLIT_INDEX_FORMAT.format(name = '*')):
+            if path.name not in { SPLIT_INDEX_FORMAT.format(name = name) for name in files }:
+                os.unlink(path)
+
+        manifest = { 'version': SPLIT_MANIFEST_VERSION, 'parameters': self.parameters, 'files': files }
+        self._write_manifest(manifest)
+        self.files = {}
+
+        return manifest
+
+    def abort(self):
+        """ Discards every file written so far, leaving the previous split untouched """
+        for pending in self.files.values():
+            pending.file.close()
+            os.unlink(pending.temp_path)
+
+        self.files = {}
+
+    def _write_manifest(self, manifest: dict):
+        _write_atomic(self.directory / SPLIT_MANIFEST_PATH.name, json.dumps(manifest, indent = 4).encode('utf-8'))
@@ -0,0 +1,262 @@
+"""
+Compiled binary cache for the verse tables (t_*.csv).
+
+Each table is compiled once into a single file under DATA_CACHE_PATH holding
+packed int32 columns (book, chapter, verse, and the per-verse features used by
+the preprocess filters: number of words, sentences and characters), an int64
+offsets array and one UTF-8 text blob. Cache files are memory-mapped on load,
+so a warm load only costs a stat call and a header check instead of a full CSV
+parse, and length filters never need to split a text.
+
+A cache file is stamped with the source CSV's mtime, size and sha1 hash. If the
+mtime or size no longer match, the hash is recomputed: an identical hash just
+re-stamps the cache (e.g. after a fresh git checkout), otherwise the table is
+recompiled.
+"""
+
+from src.paths import DATA_CACHE_PATH, TABLE_CACHE_FORMAT
+from src.csv_keys import BOOK_KEY, CHAPTER_KEY, VERSE_KEY, TEXT_KEY
+from src.preprocess import FEATURES
+
+# Standard libraries
+import csv, hashlib, io, mmap, os, struct, tempfile
+from array import array
+from pathlib import Path
+
+CACHE_MAGIC = b'ALFTABLE'
+CACHE_FORMAT_VERSION = 2
+
+# magic, format version, source mtime (ns), source size, source sha1, # rows, text blob size
+CACHE_HEADER = struct.Struct('=8sIqq20sQQ')
+
+# order of the int32 columns in the cache file, also the VerseTable attribute names
+INT_COLUMNS = ('books', 'chapters', 'verses', 'num_words', 'num_sentences', 'num_characters')
+FEATURE_COLUMNS = INT_COLUMNS[3:]
+
+def _align(offset: int, alignment: int = 8) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+def _hash_file(path: Path) -> bytes:
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+
+    return sha1.digest()
+
+def _get_cache_path(csv_path: Path) -> Path:
+    return DATA_CACHE_PATH / TABLE_CACHE_FORMAT.format(table = csv_path.stem)
+
+def _read_header(cache_path: Path) -> tuple or None:
+    """
+    Returns the unpacked cache header, or None if the cache file is missing
+    or was written by a different format version.
+    """
+    try:
+        with open(cache_path, 'rb') as file:
+            header = CACHE_HEADER.unpack(file.read(CACHE_HEADER.size))
+    except (OSError, struct.error):
+        return None
+
+    if header[0] != CACHE_MAGIC or header[1] != CACHE_FORMAT_VERSION:
+        return None
+
+    return header
+
+def _write_atomic(path: Path, chunks: [bytes]):
+    """
+    Writes chunks to a temporary file next to path, then renames it over path,
+    so readers never observe a partially written file.
+    """
+    path.parent.mkdir(parents = True, exist_ok = True)
+    fd, temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def compile_table(csv_path: Path, cache_path: Path or None = None) -> Path:
+    """
+    Parses a verse table csv file and writes its compiled cache file.
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+
+    Keyword Arguments:
+        cache_path {Path or None} -- where to write the cache (default: {None}, i.e. under DATA_CACHE_PATH)
+
+    Returns:
+        Path -- path of the written cache file
+    """
+    cache_path = cache_path or _get_cache_path(csv_path)
+
+    stat = os.stat(csv_path)
+    data = Path(csv_path).read_bytes()
+
+    columns = { name: array('i') for name in INT_COLUMNS }
+    offsets = array('q', [0])
+    blob = bytearray()
+
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding = 'utf-8'))
+
+    headers = next(reader)
+    book_index = headers.index(BOOK_KEY)
+    chapter_index = headers.index(CHAPTER_KEY)
+    verse_index = headers.index(VERSE_KEY)
+    text_index = headers.index(TEXT_KEY)
+
+    features = [(columns[name], FEATURES[name][0]) for name in FEATURE_COLUMNS]
+
+    for verse in reader:
+        text = verse[text_index]
+        columns['books'].append(int(verse[book_index]))
+        columns['chapters'].append(int(verse[chapter_index]))
+        columns['verses'].append(int(verse[verse_index]))
+
+        for (column, function) in features:
+            column.append(function(text))
+
+        blob += text.encode('utf-8')
+        offsets.append(len(blob))
+
+    num_rows = len(offsets) - 1
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size,
+        hashlib.sha1(data).digest(), num_rows, len(blob))
+
+    chunks = [header, bytes(_align(len(header)) - len(header))]
+    int_columns_size = len(INT_COLUMNS) * 4 * num_rows
+    chunks += [columns[name].tobytes() for name in INT_COLUMNS]
+    chunks += [bytes(_align(int_columns_size) - int_columns_size), offsets.tobytes(), bytes(blob)]
+
+    _write_atomic(cache_path, chunks)
+
+    return cache_path
+
+def is_table_cache_fresh(csv_path: Path) -> bool:
+    """
+    Cheap check (one stat call and a header read) of whether the cache file of a verse
+    table exists and is stamped with the csv's current mtime and size.
+    """
+    header = _read_header(_get_cache_path(csv_path))
+    stat = os.stat(csv_path)
+
+    return header is not None and header[2:4] == (stat.st_mtime_ns, stat.st_size)
+
+def ensure_table_cache(csv_path: Path) -> Path:
+    """
+    Makes sure the cache file of a verse table is up to date with its csv file,
+    (re)compiling it if necessary.
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+
+    Returns:
+        Path -- path of the up to date cache file
+    """
+    cache_path = _get_cache_path(csv_path)
+    header = _read_header(cache_path)
+
+    if header is None:
+        return compile_table(csv_path, cache_path)
+
+    stat = os.stat(csv_path)
+    (_, _, mtime_ns, size, sha1, _, _) = header
+
+    if (mtime_ns, size) == (stat.st_mtime_ns, stat.st_size):
+        return cache_path
+
+    if size != stat.st_size or sha1 != _hash_file(csv_path):
+        return compile_table(csv_path, cache_path)
+
+    # same contents, only the mtime changed: re-stamp the header in place
+    with open(cache_path, 'r+b') as file:
+        file.write(CACHE_HEADER.pack(*header[:2], stat.st_mtime_ns, *header[3:]))
+
+    return cache_path
+
+def get_table_hash(csv_path: Path) -> bytes:
+    """
+    Returns the sha1 hash of a verse table's csv contents, as stamped in its (up to date) cache file.
+    """
+    return _read_header(ensure_table_cache(csv_path))[4]
+
+class VerseTable:
+    """
+    Read-only, memory-mapped view of a compiled verse table. Rows are kept in
+    csv order. The int columns (books, chapters, verses, num_words, num_sentences
+    and num_characters) are exposed as memoryviews (indexable like lists, and
+    usable as numpy.frombuffer(table.num_words, dtype = numpy.intc) without copying),
+    texts are only decoded when accessed.
+
+    Can be used as a context manager, which closes the underlying file map.
+    """
+
+    def __init__(self, cache_path: Path):
+        with open(cache_path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        (_, _, _, _, self.source_hash, num_rows, blob_size) = CACHE_HEADER.unpack_from(self._map)
+        self._num_rows = num_rows
+        self._view = memoryview(self._map)
+
+        offset = _align(CACHE_HEADER.size)
+        for name in INT_COLUMNS:
+            setattr(self, name, self._view[offset:offset + 4 * num_rows].cast('i'))
+            offset += 4 * num_rows
+
+        offset = _align(offset)
+        self._offsets = self._view[offset:offset + 8 * (num_rows + 1)].cast('q')
+        self._blob_offset = offset + 8 * (num_rows + 1)
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column(self, name: str) -> memoryview:
+        """ Returns an int column by name, i.e. table.column('num_words') """
+        return getattr(self, name)
+
+    def text(self, row: int) -> str:
+        """ Returns the decoded text of a single row """
+        start = self._blob_offset + self._offsets[row]
+        end = self._blob_offset + self._offsets[row + 1]
+        return self._map[start:end].decode('utf-8')
+
+    def texts(self):
+        """ Generator of every row's text, in csv order """
+        return (self.text(row) for row in range(self._num_rows))
+
+    def rows(self):
+        """ Generator of (book, chapter, verse, text) tuples, in csv order """
+        return zip(self.books, self.chapters, self.verses, self.texts())
+
+    def close(self):
+        for name in INT_COLUMNS:
+            getattr(self, name).release()
+        self._offsets.release()
+        self._view.release()
+        self._map.close()
+
+def load_verse_table(csv_path: Path) -> VerseTable:
+    """
+    Returns the memory-mapped compiled cache of a verse table, compiling it first
+    if it is missing or out of date.
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+
+    Returns:
+        VerseTable
+    """
+    return VerseTable(ensure_table_cache(csv_path))
@@ -0,0 +1,367 @@
+"""
+Pre-tokenized, integer id versions of the dataset splits.
+
+tokenize_datasets runs a tokenizer over every split of a create_datasets (or load_datasets)
+result once, and stores for each version and split a flat int32 array of token ids along
+with an int64 offsets array (verse i is tokens[offsets[i]:offsets[i + 1]]), as .npy files
+under DATA_TOKENS_PATH, in a directory keyed by the tokenizer's identity. Training and
+evaluation then only need load_tokenized_datasets, which memory-maps the arrays.
+
+Tokenizers are pluggable (see Tokenizer): tokenizers producing token strings (whitespace,
+pyonmttok) get one vocabulary per version, built from its training split, while tokenizers
+with their own vocabulary (sentencepiece, huggingface) produce their ids directly. Either
+way, the vocabulary is stored as vocab_{table}.json next to the arrays.
+
+Splits whose texts haven't changed since they were last tokenized (by sha256) are skipped.
+"""
+
+from src.paths import DATA_TOKENS_PATH, TOKENS_FORMAT, OFFSETS_FORMAT, VOCAB_FORMAT
+from src.dataset_cache import hash_key_parts
+
+# Standard libraries
+import hashlib, json, os, tempfile
+from collections import Counter
+from pathlib import Path
+
+# additional libraries (pip install ...)
+import numpy
+
+TOKENS_MANIFEST_VERSION = 1
+
+PAD_TOKEN = '<pad>'
+UNK_TOKEN = '<unk>'
+BOS_TOKEN = '<s>'
+EOS_TOKEN = '</s>'
+SPECIAL_TOKENS = (PAD_TOKEN, UNK_TOKEN, BOS_TOKEN, EOS_TOKEN)
+
+def _hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+class Tokenizer:
+    """
+    Base class of the pluggable tokenizers. Subclasses either return token strings from
+    tokenize (then a vocabulary is built from the training split), or set has_vocab and
+    return ids from encode, along with their vocabulary from get_vocab.
+    """
+    has_vocab = False
+
+    def describe(self) -> dict:
+        """ json-serializable identity of the tokenizer: anything that changes its output must be in here """
+        raise NotImplementedError
+
+    def tokenize(self, text: str) -> [str]:
+        raise NotImplementedError
+
+    def encode(self, text: str) -> [int]:
+        raise NotImplementedError
+
+    def get_vocab(self) -> [str]:
+        """ Token strings by id """
+        raise NotImplementedError
+
+    def get_key(self) -> str:
+        """ Name of the directory holding this tokenizer's arrays, i.e. 'onmt-1a2b3c4d5e6f' """
+        return f"{self.describe()['kind']}-{hash_key_parts(self.describe())[:12]}"
+
+class WhitespaceTokenizer(Tokenizer):
+    """ Splits on whitespace, optionally lowercasing """
+
+    def __init__(self, lowercase: bool = False):
+        self.lowercase = lowercase
+
+    def describe(self) -> dict:
+        return { 'kind': 'whitespace', 'lowercase': self.lowercase }
+
+    def tokenize(self, text: str) -> [str]:
+        return (text.lower() if self.lowercase else text).split()
+
+class OnmtTokenizer(Tokenizer):
+    """
+    pyonmttok tokenizer, as used by the OpenNMT notebooks, i.e. OnmtTokenizer('aggressive', joiner_annotate = True)
+
+    Arguments:
+        mode {str} -- pyonmttok tokenization mode
+
+    Keyword Arguments:
+        **kwargs -- pyonmttok.Tokenizer options
+    """
+
+    def __init__(self, mode: str = 'aggressive', **kwargs):
+        import pyonmttok
+
+        self.mode = mode
+        self.kwargs = kwargs
+        self.version = pyonmttok.__version__
+        self.tokenizer = pyonmttok.Tokenizer(mode, **kwargs)
+
+    def describe(self) -> dict:
+        return { 'kind': 'onmt', 'mode': self.mode, 'options': self.kwargs, 'version': self.version }
+
+    def tokenize(self, text: str) -> [str]:
+        return self.tokenizer.tokenize(text)[0]
+
+class SentencePieceTokenizer(Tokenizer):
+    """
+    sentencepiece model, identified by the hash of its model file
+
+    Arguments:
+        model_path {Path} -- path of the .model file
+    """
+    has_vocab = True
+
+    def __init__(self, model_path: Path):
+        import sentencepiece
+
+        self.model_path = Path(model_path)
+        self.model_hash = _hash_file(self.model_path)
+        self.processor = sentencepiece.SentencePieceProcessor(model_file = str(self.model_path))
+
+    def describe(self) -> dict:
+        return { 'kind': 'sentencepiece', 'model': self.model_hash }
+
+    def encode(self, text: str) -> [int]:
+        return self.processor.encode(text)
+
+    def get_vocab(self) -> [str]:
+        return [self.processor.id_to_piece(i) for i in range(self.processor.get_piece_size())]
+
+class HuggingfaceTokenizer(Tokenizer):
+    """
+    huggingface (transformers) tokenizer, i.e. HuggingfaceTokenizer('facebook/bart-base')
+
+    Arguments:
+        name_or_tokenizer {str or PreTrainedTokenizerBase} -- pretrained tokenizer name, or an already loaded tokenizer
+
+    Keyword Arguments:
+        add_special_tokens {bool} -- whether to add the model's special tokens (i.e. <s> and </s>) (default: {True})
+    """
+    has_vocab = True
+
+    def __init__(self, name_or_tokenizer, add_special_tokens: bool = True):
+        if isinstance(name_or_tokenizer, str):
+            from transformers import AutoTokenizer
+            name_or_tokenizer = AutoTokenizer.from_pretrained(name_or_tokenizer)
+
+        self.tokenizer = name_or_tokenizer
+        self.add_special_tokens = add_special_tokens
+
+    def describe(self) -> dict:
+        return {
+            'kind': 'huggingface',
+            'name': self.tokenizer.name_or_path,
+            'class': type(self.tokenizer).__name__,
+            'vocab': hash_key_parts(sorted(self.tokenizer.get_vocab().items())),
+            'add_special_tokens': self.add_special_tokens
+        }
+
+    def encode(self, text: str) -> [int]:
+        return self.tokenizer(text, add_special_tokens = self.add_special_tokens)['input_ids']
+
+    def get_vocab(self) -> [str]:
+        vocab = self.tokenizer.get_vocab()
+        tokens = [None] * (max(vocab.values()) + 1)
+
+        for (token, token_id) in vocab.items():
+            tokens[token_id] = token
+
+        return tokens
+
+def build_vocab(tokenized_texts: [[str]], min_frequency: int = 1) -> [str]:
+    """
+    Returns the vocabulary of tokenized texts: the special tokens (SPECIAL_TOKENS), then the
+    tokens appearing at least min_frequency times, most frequent first (ties by token).
+    """
+    counts = Counter(token for tokens in tokenized_texts for token in tokens)
+    tokens = sorted((token for (token, count) in counts.items() if count >= min_frequency and token not in SPECIAL_TOKENS),
+        key = lambda token: (-counts[token], token))
+
+    return list(SPECIAL_TOKENS) + tokens
+
+def _hash_texts(texts: [str]) -> str:
+    sha256 = hashlib.sha256()
+
+    for text in texts:
+        sha256.update(text.encode('utf-8'))
+        sha256.update(b'\n')
+
+    return sha256.hexdigest()
+
+def _save_atomic(path: Path, write: callable):
+    fd, temp_path = tempfile.mkstemp(dir = path.parent, prefix = f'.{path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def _save_json(path: Path, value: object):
+    _save_atomic(path, lambda file: file.write(json.dumps(value, ensure_ascii = False).encode('utf-8')))
+
+def _encode_texts(ids_of_texts) -> (numpy.ndarray, numpy.ndarray):
+    """ Flattens a sequence of id lists into (int32 tokens, int64 offsets) """
+    lengths = []
+    tokens = []
+
+    for ids in ids_of_texts:
+        lengths.append(len(ids))
+        tokens.extend(ids)
+
+    offsets = numpy.zeros(len(lengths) + 1, dtype = numpy.int64)
+    numpy.cumsum(lengths, out = offsets[1:])
+
+    return numpy.asarray(tokens, dtype = numpy.int32), offsets
+
+def _read_manifest(directory: Path) -> dict:
+    try:
+        with open(directory / 'manifest.json', 'r', encoding = 'utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = None
+
+    if manifest is None or manifest.get('version') != TOKENS_MANIFEST_VERSION:
+        return { 'version': TOKENS_MANIFEST_VERSION, 'vocabs': {}, 'files': {} }
+
+    return manifest
+
+def tokenize_datasets(zipped_verses: {str: {str: [str]}}, tokenizer: Tokenizer, directory: Path = DATA_TOKENS_PATH, vocab_dataset: str = 'training', min_frequency: int = 1) -> Path:
+    """
+    Tokenizes every split of a create_datasets (or load_datasets) result and stores the token
+    id arrays, offsets and vocabularies (see the module docstring).
+
+    Arguments:
+        zipped_verses {{str: {str: [str]}}} -- the datasets, as returned by create_datasets
+        tokenizer {Tokenizer} -- the tokenizer, i.e. WhitespaceTokenizer() or OnmtTokenizer('aggressive')
+
+    Keyword Arguments:
+        directory {Path} -- parent directory of the tokenizer directories (default: {DATA_TOKENS_PATH})
+        vocab_dataset {str} -- dataset the vocabularies of token string tokenizers are built from (default: {'training'})
+        min_frequency {int} -- minimum number of occurrences of a token in vocab_dataset to be in the
+                               vocabulary, for token string tokenizers (default: {1})
+
+    Returns:
+        Path -- the directory of the tokenizer's arrays
+    """
+    directory = directory / tokenizer.get_key()
+    directory.mkdir(parents = True, exist_ok = True)
+
+    # tables and splits tokenized by earlier calls stay in the manifest
+    manifest = _read_manifest(directory)
+    vocabs, files = dict(manifest['vocabs']), dict(manifest['files'])
+
+    tables = sorted({ table for verse_versions in zipped_verses.values() for table in verse_versions })
+    hashes = { (dataset, table): _hash_texts(verse_versions[table]) for (dataset, verse_versions) in zipped_verses.items() for table in verse_versions }
+
+    for table in tables:
+        vocab_path = directory / VOCAB_FORMAT.format(table = table)
+        # token string vocabularies depend on the texts they are built from, others only on the tokenizer
+        vocab_key = 'tokenizer' if tokenizer.has_vocab else f"{hashes.get((vocab_dataset, table), '')}:{min_frequency}"
+
+        if manifest['vocabs'].get(table) == vocab_key and vocab_path.exists():
+            with open(vocab_path, 'r', encoding = 'utf-8') as file:
+                vocab = json.load(file)
+        else:
+            vocab = tokenizer.get_vocab() if tokenizer.has_vocab else \
+                build_vocab(map(tokenizer.tokenize, zipped_verses.get(vocab_dataset, {}).get(table, [])), min_frequency)
+            _save_json(vocab_path, vocab)
+
+        vocabs[table] = vocab_key
+
+        # earlier splits of the table encoded with another vocabulary no longer match it
+        for name in [name for (name, key) in files.items() if name.rsplit('_', 1)[0] == table and key.split(':', 1)[1] != vocab_key]:
+            del files[name]
+
+        token_ids = { token: token_id for (token_id, token) in enumerate(vocab) }
+        unk_id = token_ids.get(UNK_TOKEN)
+
+        for (dataset, verse_versions) in zipped_verses.items():
+            if table not in verse_versions:
+                continue
+
+            name = f'{table}_{dataset}'
+            tokens_path = directory / TOKENS_FORMAT.format(name = name)
+            offsets_path = directory / OFFSETS_FORMAT.format(name = name)
+
+            # the text hash, and for token string tokenizers the vocabulary it was encoded with
+            key = f'{hashes[dataset, table]}:{vocab_key}'
+
+            if manifest['files'].get(name) != key or not tokens_path.exists() or not offsets_path.exists():
+                texts = verse_versions[table]
+
+                if tokenizer.has_vocab:
+                    ids_of_texts = map(tokenizer.encode, texts)
+                else:
+                    ids_of_texts = ([token_ids.get(token, unk_id) for token in tokenizer.tokenize(text)] for text in texts)
+
+                tokens, offsets = _encode_texts(ids_of_texts)
+                _save_atomic(tokens_path, lambda file: numpy.save(file, tokens))
+                _save_atomic(offsets_path, lambda file: numpy.save(file, offsets))
+
+            files[name] = key
+
+    _save_json(directory / 'tokenizer.json', tokenizer.describe())
+    _save_json(directory / 'manifest.json', { 'version': TOKENS_MANIFEST_VERSION, 'vocabs': vocabs, 'files': files })
+
+    return directory
+
+class TokenizedVerses:
+    """
+    Memory-mapped token ids of one version's split. Indexing returns the int32 ids of a
+    verse (a numpy view, nothing is copied), len() the number of verses.
+
+    Attributes:
+        tokens {numpy.ndarray} -- flat int32 token ids of all of the verses
+        offsets {numpy.ndarray} -- int64 offsets of each verse's ids in tokens, plus the end
+    """
+
+    def __init__(self, tokens_path: Path, offsets_path: Path):
+        self.tokens = numpy.load(tokens_path, mmap_mode = 'r')
+        self.offsets = numpy.load(offsets_path, mmap_mode = 'r')
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> numpy.ndarray:
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def lengths(self) -> numpy.ndarray:
+        """ Number of tokens of each verse """
+        return numpy.diff(self.offsets)
+
+def load_tokenized_datasets(tokenizer: Tokenizer or str, directory: Path = DATA_TOKENS_PATH) -> ({str: {str: TokenizedVerses}}, {str: [str]}):
+    """
+    Loads the arrays stored by tokenize_datasets.
+
+    Arguments:
+        tokenizer {Tokenizer or str} -- the tokenizer, or its key (see Tokenizer.get_key)
+
+    Returns:
+        ({str: {str: TokenizedVerses}}, {str: [str]}) -- the tokenized datasets, same shape as the
+        create_datasets return value, and the vocabulary of each version
+    """
+    directory = directory / (tokenizer if isinstance(tokenizer, str) else tokenizer.get_key())
+    manifest = _read_manifest(directory)
+
+    datasets = {}
+    vocabs = {}
+
+    for table in manifest['vocabs']:
+        with open(directory / VOCAB_FORMAT.format(table = table), 'r', encoding = 'utf-8') as file:
+            vocabs[table] = json.load(file)
+
+    for name in manifest['files']:
+        table, dataset = name.rsplit('_', 1)
+        datasets.setdefault(dataset, {})[table] = TokenizedVerses(directory / TOKENS_FORMAT.format(name = name), directory / OFFSETS_FORMAT.format(name = name))
+
+    return datasets, vocabs
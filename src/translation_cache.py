@@ -0,0 +1,204 @@
+"""
+Persistent cache of translations, in front of any Translator (see src/translators.py).
+
+Translations are stored in a SQLite database, keyed by the model and the normalized source
+text. The model key hashes the checkpoint contents (not its path, so a moved or copied
+checkpoint keeps its translations, and a retrained one at the same path gets none) with
+the decoding parameters of the translator (beam size, max length, language code...).
+
+A batch is looked up at once, and only its distinct misses are forwarded to the model,
+so verse texts shared between versions (i.e. KJV and WBT) or retranslated across demos
+and evaluations are only ever translated once per model. Least recently used entries
+are evicted once the cache holds more than max_entries translations.
+"""
+
+from src.paths import TRANSLATION_CACHE_PATH
+from src.dataset_cache import hash_key_parts
+from src.translators import Translator
+
+# Standard libraries
+import hashlib, os, re, sqlite3, threading, time, unicodedata
+from pathlib import Path
+
+TRANSLATION_CACHE_MAX_ENTRIES = 1000000
+
+# bound parameters per query (SQLite's historical limit is 999)
+LOOKUP_CHUNK_SIZE = 500
+
+HASH_CHUNK_SIZE = 2 ** 20
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# (path, size, mtime) -> checkpoint hash, so a checkpoint is only read once per process
+_checkpoint_hashes = {}
+
+def normalize_source_text(text: str) -> str:
+    """ Normalizes a source text for the cache key: unicode NFC form, whitespace runs collapsed and stripped """
+    return WHITESPACE_PATTERN.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+def get_checkpoint_hash(model: str) -> str:
+    """
+    Returns the sha256 of a model checkpoint: of the file, or of every file (and relative
+    path) of a saved model directory. A name that isn't a local path (i.e. a model on the
+    huggingface hub) is hashed as is.
+    """
+    path = Path(model)
+
+    if not path.exists():
+        return hashlib.sha256(model.encode('utf-8')).hexdigest()
+
+    files = sorted(file for file in path.rglob('*') if file.is_file()) if path.is_dir() else [path]
+    signature = tuple((str(file), file.stat().st_size, file.stat().st_mtime_ns) for file in files)
+
+    if signature not in _checkpoint_hashes:
+        digest = hashlib.sha256()
+
+        for file in files:
+            path.is_dir() and digest.update(file.relative_to(path).as_posix().encode('utf-8'))
+
+            with open(file, 'rb') as stream:
+                for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+
+        _checkpoint_hashes[signature] = digest.hexdigest()
+
+    return _checkpoint_hashes[signature]
+
+def get_model_key(translator: Translator) -> str:
+    """ Cache key of a translator: its checkpoint hash and decoding parameters, see the module docstring """
+    description = dict(translator.describe())
+    description['model'] = get_checkpoint_hash(description['model'])
+    return hash_key_parts(description)
+
+class TranslationCache:
+    """
+    SQLite store of translations, shareable between threads.
+
+    Keyword Arguments:
+        path {Path} -- database file (default: {TRANSLATION_CACHE_PATH})
+        max_entries {int} -- maximum number of cached translations (default: {TRANSLATION_CACHE_MAX_ENTRIES})
+    """
+
+    def __init__(self, path: Path = TRANSLATION_CACHE_PATH, max_entries: int = TRANSLATION_CACHE_MAX_ENTRIES):
+        Path(path).parent.mkdir(parents = True, exist_ok = True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread = False)
+        self.connection.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS translations (
+                model_key TEXT NOT NULL,
+                source TEXT NOT NULL,
+                translation TEXT NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (model_key, source)
+            );
+            CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used);
+        ''')
+
+    def get_many(self, model_key: str, sources: [str]) -> {str: str}:
+        """ Returns the cached translations of the (normalized) sources of a model, by source """
+        sources = list(set(sources))
+        found = {}
+
+        with self.lock, self.connection:
+            for start in range(0, len(sources), LOOKUP_CHUNK_SIZE):
+                chunk = sources[start:start + LOOKUP_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT source, translation FROM translations WHERE model_key = ? AND source IN ({', '.join('?' * len(chunk))})",
+                    (model_key, *chunk))
+                found.update(rows)
+
+            # refreshes the recency of the hits for the LRU eviction
+            now = time.time_ns()
+            self.connection.executemany('UPDATE translations SET last_used = ? WHERE model_key = ? AND source = ?',
+                ((now, model_key, source) for source in found))
+
+            self.hits += len(found)
+            self.misses += len(sources) - len(found)
+
+        return found
+
+    def put_many(self, model_key: str, translations: {str: str}):
+        """ Stores the translations of (normalized) sources of a model, then evicts entries over max_entries """
+        now = time.time_ns()
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)',
+                ((model_key, source, translation, now) for (source, translation) in translations.items()))
+
+            (num_entries,) = self.connection.execute('SELECT COUNT(*) FROM translations').fetchone()
+
+            if num_entries > self.max_entries:
+                self.connection.execute('DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations ORDER BY last_used LIMIT ?)',
+                    (num_entries - self.max_entries,))
+
+    def clear(self, model_key: str or None = None):
+        """ Removes the translations of a model, or all of them """
+        with self.lock, self.connection:
+            if model_key is None:
+                self.connection.execute('DELETE FROM translations')
+            else:
+                self.connection.execute('DELETE FROM translations WHERE model_key = ?', (model_key,))
+
+    def stats(self) -> dict:
+        """
+        Example return:
+            { 'hits': 29870, 'misses': 1216, 'hit_rate': 0.961, 'entries': 65012, 'bytes': 12615680 }
+        """
+        with self.lock:
+            (num_entries,) = self.connection.execute('SELECT COUNT(*) FROM translations').fetchone()
+            lookups = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'entries': num_entries,
+                'bytes': os.path.getsize(self.path)
+            }
+
+    def close(self):
+        self.connection.close()
+
+class CachedTranslator(Translator):
+    """
+    A translator whose translations go through a TranslationCache (see the module docstring).
+
+    Arguments:
+        translator {Translator} -- the model
+
+    Keyword Arguments:
+        cache {TranslationCache or None} -- the store, None for one at TRANSLATION_CACHE_PATH (default: {None})
+
+    Example usage:
+        translator = CachedTranslator(OnmtTranslator('models/kjv2bbe.pt'))
+        translator.translate(kjv_texts)
+        translator.translate(wbt_texts)   # only the texts that differ from the KJV are translated
+        translator.cache.stats()
+    """
+
+    def __init__(self, translator: Translator, cache: TranslationCache or None = None):
+        self.translator = translator
+        self.cache = cache if cache is not None else TranslationCache()
+        self.model_key = get_model_key(translator)
+
+    def translate(self, texts: [str]) -> [str]:
+        sources = [normalize_source_text(text) for text in texts]
+        translations = self.cache.get_many(self.model_key, sources)
+        misses = list(dict.fromkeys(source for source in sources if source not in translations))
+
+        if misses:
+            new_translations = dict(zip(misses, self.translator.translate(misses)))
+            self.cache.put_many(self.model_key, new_translations)
+            translations.update(new_translations)
+
+        return [translations[source] for source in sources]
+
+    def describe(self) -> dict:
+        return self.translator.describe()
@@ -0,0 +1,339 @@
+"""
+Long-lived local translation service, so notebooks and scripts share warm models.
+
+The server keeps its translators (see src/translators.py) loaded, and a DynamicBatcher
+per model coalesces concurrent requests: the first pending text opens a batch, which is
+translated as soon as it holds max_batch_size texts or max_latency seconds have passed,
+whichever comes first. Requests are served over HTTP, on a TCP port or a UNIX socket:
+
+    POST /translate  { "model": "kjv2bbe", "texts": ["...", ...] } -> { "translations": ["...", ...] }
+    GET  /stats      -> throughput, batch sizes and latency percentiles of each model
+    GET  /models     -> the model descriptions
+
+Start a server with serve_translations.py, and use it with TranslationClient:
+
+    client = TranslationClient('http://127.0.0.1:8765')      # or TranslationClient('unix:/tmp/translations.sock')
+    client.translate('kjv2bbe', ['In the beginning God created the heaven and the earth.'])
+"""
+
+from src.translators import Translator
+
+# Standard libraries
+import http.client, json, os, socket, socketserver, threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from urllib.parse import urlparse
+
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_MAX_LATENCY = 0.02
+
+# latencies kept for the percentiles, per model
+LATENCY_WINDOW = 10000
+
+# pending connections (socketserver's default of 5 resets bursts of concurrent clients)
+REQUEST_QUEUE_SIZE = 256
+
+class TranslationStats:
+    """ Thread-safe counters and a window of recent request latencies """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.started = perf_counter()
+        self.num_texts = 0
+        self.num_batches = 0
+        self.busy_seconds = 0.
+        self.latencies = deque(maxlen = window)
+
+    def add_batch(self, latencies: [float], seconds: float):
+        with self.lock:
+            self.num_texts += len(latencies)
+            self.num_batches += 1
+            self.busy_seconds += seconds
+            self.latencies.extend(latencies)
+
+    def summary(self) -> dict:
+        """
+        Example return:
+            { 'texts': 1200, 'batches': 75, 'mean_batch_size': 16.0, 'texts_per_second': 41.3, 'texts_per_busy_second': 52.9,
+              'latency_ms': { 'p50': 212.5, 'p90': 390.1, 'p99': 601.7, 'max': 655.0 } }
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            elapsed = perf_counter() - self.started
+
+            def percentile(p: float) -> float:
+                return round(1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1) if latencies else None
+
+            return {
+                'texts': self.num_texts,
+                'batches': self.num_batches,
+                'mean_batch_size': self.num_texts / self.num_batches if self.num_batches else 0.,
+                'texts_per_second': self.num_texts / elapsed if elapsed else 0.,
+                'texts_per_busy_second': self.num_texts / self.busy_seconds if self.busy_seconds else 0.,
+                'latency_ms': { 'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': percentile(1.) }
+            }
+
+class DynamicBatcher:
+    """
+    Coalesces the texts submitted by concurrent callers into batches for one translator,
+    translated on a single worker thread (see the module docstring).
+
+    Arguments:
+        translator {Translator} -- the model
+
+    Keyword Arguments:
+        max_batch_size {int} -- maximum number of texts per batch (default: {DEFAULT_MAX_BATCH_SIZE})
+        max_latency {float} -- seconds a batch waits for more texts after its first one (default: {DEFAULT_MAX_LATENCY})
+    """
+
+    def __init__(self, translator: Translator, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_latency: float = DEFAULT_MAX_LATENCY):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = TranslationStats()
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, texts: [str]) -> [Future]:
+        """ Queues texts for translation, returning one future translation per text """
+        futures = [Future() for _ in texts]
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('the batcher is closed')
+
+            self.pending.extend((text, future, perf_counter()) for (text, future) in zip(texts, futures))
+            self.condition.notify()
+
+        return futures
+
+    def translate(self, texts: [str]) -> [str]:
+        """ Translates texts (blocking), batched with the texts of other callers """
+        return [future.result() for future in self.submit(texts)]
+
+    def _next_batch(self) -> [(str, Future, float)] or None:
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+
+            if not self.pending:
+                return None
+
+            # the latency budget starts with the oldest pending text
+            deadline = self.pending[0][2] + self.max_latency
+
+            while len(self.pending) < self.max_batch_size and not self.closed:
+                remaining = deadline - perf_counter()
+
+                if remaining <= 0:
+                    break
+
+                self.condition.wait(remaining)
+
+            return [self.pending.popleft() for _ in range(min(self.max_batch_size, len(self.pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            if batch is None:
+                return
+
+            start = perf_counter()
+
+            try:
+                translations = self.translator.translate([text for (text, _, _) in batch])
+            except Exception as error:
+                for (_, future, _) in batch:
+                    future.set_exception(error)
+                continue
+
+            if len(translations) != len(batch):
+                error = RuntimeError(f'the translator returned {len(translations)} translations for {len(batch)} texts')
+
+                for (_, future, _) in batch:
+                    future.set_exception(error)
+                continue
+
+            end = perf_counter()
+
+            for ((_, future, _), translation) in zip(batch, translations):
+                future.set_result(translation)
+
+            self.stats.add_batch([end - submitted for (_, _, submitted) in batch], end - start)
+
+    def close(self):
+        """ Translates the pending texts, then stops the worker thread """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.thread.join()
+
+class _TranslationRequestHandler(BaseHTTPRequestHandler):
+    """ Routes the requests of a TranslationServer (see the module docstring) """
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii = False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, { name: batcher.stats.summary() for (name, batcher) in self.server.batchers.items() })
+        elif self.path == '/models':
+            self._send_json(200, { name: batcher.translator.describe() for (name, batcher) in self.server.batchers.items() })
+        else:
+            self._send_json(404, { 'error': f'unknown path {self.path}' })
+
+    def do_POST(self):
+        if self.path != '/translate':
+            return self._send_json(404, { 'error': f'unknown path {self.path}' })
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            batcher = self.server.batchers[request['model']]
+            texts = request['texts']
+        except (ValueError, KeyError, TypeError) as error:
+            return self._send_json(400, { 'error': f'invalid request: {error!r}' })
+
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return self._send_json(400, { 'error': 'invalid request: texts must be a list of strings' })
+
+        try:
+            self._send_json(200, { 'translations': batcher.translate(texts) })
+        except Exception as error:
+            self._send_json(500, { 'error': repr(error) })
+
+    def address_string(self) -> str:
+        # UNIX socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format: str, *args):
+        self.server.verbose and super().log_message(format, *args)
+
+class _ThreadingTCPHTTPServer(ThreadingHTTPServer):
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        (self.server_name, self.server_port) = ('localhost', 0)
+
+class TranslationServer:
+    """
+    Serves translators over HTTP, batching concurrent requests (see the module docstring).
+
+    Arguments:
+        translators {{str: Translator}} -- the models, by name
+
+    Keyword Arguments:
+        address {str} -- 'host:port' to listen on TCP, or 'unix:/path/to/socket' (default: {'127.0.0.1:8765'})
+        max_batch_size {int} -- maximum number of texts per batch (default: {DEFAULT_MAX_BATCH_SIZE})
+        max_latency {float} -- seconds a batch waits for more texts (default: {DEFAULT_MAX_LATENCY})
+        verbose {bool} -- whether to log every request (default: {False})
+    """
+
+    def __init__(self, translators: {str: Translator}, address: str = '127.0.0.1:8765', max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_latency: float = DEFAULT_MAX_LATENCY, verbose: bool = False):
+        if address.startswith('unix:'):
+            self.httpd = _ThreadingUnixHTTPServer(address[len('unix:'):], _TranslationRequestHandler)
+        else:
+            (host, port) = address.rsplit(':', 1)
+            self.httpd = _ThreadingTCPHTTPServer((host, int(port)), _TranslationRequestHandler)
+
+        self.address = address
+        self.httpd.verbose = verbose
+        self.httpd.batchers = { name: DynamicBatcher(translator, max_batch_size, max_latency) for (name, translator) in translators.items() }
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """ Stops serve_forever, from another thread """
+        self.httpd.shutdown()
+
+    def close(self):
+        for batcher in self.httpd.batchers.values():
+            batcher.close()
+
+        self.httpd.server_close()
+
+        if self.address.startswith('unix:'):
+            try:
+                os.unlink(self.address[len('unix:'):])
+            except OSError:
+                pass
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float or None = None):
+        super().__init__('localhost', timeout = timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class TranslationClient:
+    """
+    Client of a TranslationServer.
+
+    Arguments:
+        address {str} -- 'http://host:port', 'host:port' or 'unix:/path/to/socket'
+
+    Keyword Arguments:
+        timeout {float or None} -- seconds to wait for a response (default: {None})
+    """
+
+    def __init__(self, address: str, timeout: float or None = None):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.address.startswith('unix:'):
+            return _UnixHTTPConnection(self.address[len('unix:'):], self.timeout)
+
+        url = urlparse(self.address if '://' in self.address else f'http://{self.address}')
+        return http.client.HTTPConnection(url.hostname, url.port, timeout = self.timeout)
+
+    def _request(self, method: str, path: str, body: dict or None = None) -> dict:
+        connection = self._connect()
+
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            connection.request(method, path, body = data, headers = { 'Content-Type': 'application/json' } if data else {})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            raise RuntimeError(f"translation server error {response.status}: {result.get('error')}")
+
+        return result
+
+    def translate(self, model: str, texts: [str]) -> [str]:
+        """ Translates texts with one of the server's models """
+        return self._request('POST', '/translate', { 'model': model, 'texts': list(texts) })['translations']
+
+    def stats(self) -> dict:
+        """ Throughput and latency percentiles of each model, see TranslationStats.summary """
+        return self._request('GET', '/stats')
+
+    def models(self) -> dict:
+        """ Descriptions of the server's models, see Translator.describe """
+        return self._request('GET', '/models')
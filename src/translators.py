@@ -0,0 +1,130 @@
+"""
+Translation model backends behind one interface: translate a list of texts at once.
+
+OnmtTranslator wraps an OpenNMT-py model with the tokenization and language normalization
+of Demo.ipynb (gen_model_translator, preprocess_data, postprocess_data), and
+HuggingfaceTranslator wraps a transformers translation pipeline, like the BART notebook.
+Both translate whole batches, and describe themselves (model and decoding parameters) so
+their results can be shared or cached.
+
+OpenNMT-py, pyonmttok, transformers and torch are only imported when a translator
+needs them.
+"""
+
+from src.normalization import normalize_text
+
+# Standard libraries
+from argparse import Namespace
+
+# Demo.ipynb translation parameters
+MIN_SENTENCE_LENGTH = 1
+MAX_SENTENCE_LENGTH = 60
+BEAM_SIZE = 5
+
+def set_num_threads(num_threads: int or None):
+    """ Sets the number of threads torch uses for cpu inference (None to keep torch's default) """
+    if num_threads is not None:
+        import torch
+        torch.set_num_threads(num_threads)
+
+class Translator:
+    """ Base class of the translation backends """
+
+    def translate(self, texts: [str]) -> [str]:
+        """ Translates a batch of texts, returning one translation per text, in order """
+        raise NotImplementedError
+
+    def describe(self) -> dict:
+        """ json-serializable description of the model and decoding parameters """
+        raise NotImplementedError
+
+class OnmtTranslator(Translator):
+    """
+    An OpenNMT-py model, see Demo.ipynb.
+
+    Arguments:
+        model_path {str} -- path of the model checkpoint (.pt)
+
+    Keyword Arguments:
+        language_code {str} -- language of the source texts, 'eng', 'enm' or 'ang', see normalization.normalize_text (default: {'eng'})
+        beam_size {int} -- beam size (default: {BEAM_SIZE})
+        max_length {int} -- maximum number of tokens of a translation (default: {MAX_SENTENCE_LENGTH})
+        min_length {int} -- minimum number of tokens of a translation (default: {MIN_SENTENCE_LENGTH})
+    """
+
+    def __init__(self, model_path: str, language_code: str = 'eng', beam_size: int = BEAM_SIZE, max_length: int = MAX_SENTENCE_LENGTH, min_length: int = MIN_SENTENCE_LENGTH):
+        import pyonmttok
+        from onmt.translate.translator import build_translator
+
+        self.model_path = str(model_path)
+        self.language_code = language_code
+        self.beam_size = beam_size
+        self.max_length = max_length
+        self.min_length = min_length
+        self.tokenizer = pyonmttok.Tokenizer('aggressive', case_markup = True)
+
+        opt = Namespace(fix_word_vecs_dec = False, fix_word_vecs_enc = False, alpha = 0.0, ban_unk_token = False, batch_type = 'sents',
+            beam_size = beam_size, beta = -0.0, block_ngram_repeat = 0, coverage_penalty = 'none', data_type = 'text', dump_beam = '',
+            fp32 = False, gpu = -1, int8 = False, ignore_when_blocking = [], length_penalty = 'none', max_length = max_length,
+            max_sent_length = None, min_length = min_length, models = [self.model_path], n_best = 1, output = '/dev/null',
+            phrase_table = '', random_sampling_temp = 1.0, random_sampling_topk = 0, random_sampling_topp = 0.0, ratio = -0.0,
+            replace_unk = False, report_align = False, report_time = False, seed = 829, stepwise_penalty = False, tgt = None,
+            tgt_prefix = None, verbose = False)
+        self.translator = build_translator(opt, report_score = False)
+
+    def translate(self, texts: [str]) -> [str]:
+        if not texts:
+            return []
+
+        tokenized = [' '.join(self.tokenizer.tokenize(normalize_text(text, self.language_code))[0]) for text in texts]
+        (_, predictions) = self.translator.translate(tokenized, batch_size = len(tokenized))
+
+        return [self.tokenizer.detokenize(prediction[0].split(' ')) for prediction in predictions]
+
+    def describe(self) -> dict:
+        return {
+            'backend': 'onmt',
+            'model': self.model_path,
+            'language_code': self.language_code,
+            'beam_size': self.beam_size,
+            'max_length': self.max_length,
+            'min_length': self.min_length
+        }
+
+class HuggingfaceTranslator(Translator):
+    """
+    A transformers translation pipeline, see HuggingfaceBartTransformer.ipynb.
+
+    Arguments:
+        model {str} -- model name on the hub, or path of a saved model
+
+    Keyword Arguments:
+        task {str} -- pipeline task, i.e. 'translation_kjv_to_bbe' (default: {'translation'})
+        tokenizer {str or None} -- tokenizer name or path, None for the model's (default: {None})
+        num_beams {int or None} -- beam size, None for the model's default (default: {None})
+        max_length {int or None} -- maximum number of tokens of a translation, None for the model's default (default: {None})
+    """
+
+    def __init__(self, model: str, task: str = 'translation', tokenizer: str or None = None, num_beams: int or None = None, max_length: int or None = None):
+        from transformers import pipeline
+
+        self.model = str(model)
+        self.task = task
+        self.tokenizer = tokenizer
+        self.generate_kwargs = { key: value for (key, value) in (('num_beams', num_beams), ('max_length', max_length)) if value is not None }
+        self.pipeline = pipeline(task, model = self.model, tokenizer = tokenizer or self.model)
+
+    def translate(self, texts: [str]) -> [str]:
+        if not texts:
+            return []
+
+        return [result['translation_text'] for result in self.pipeline(list(texts), return_text = True, **self.generate_kwargs)]
+
+    def describe(self) -> dict:
+        return {
+            'backend': 'huggingface',
+            'model': self.model,
+            'task': self.task,
+            'tokenizer': self.tokenizer,
+            **self.generate_kwargs
+        }
@@ -24,7 +24,7 @@ def make_tarball(output_filename: Path, source_dir: Path) -> None:
     with tarfile.open(output_filename, "w:gz") as tar:
         tar.add(source_dir, arcname=source_dir.stem)
 
-def beautify(url: str, parser: str = "html.parser", session: requests.Session or None = None) -> BeautifulSoup or None:
+def beautify(url: str, parser: str = "html.parser", session: requests.Session or None = None, cache: 'ResponseCache' or None = None) -> BeautifulSoup or None:
     """
     Returns BeautifulSoup object of url or None
 
@@ -35,6 +35,7 @@ def beautify(url: str, parser: str = "html.parser", session: requests.Session or
         url {str} -- path to object
         parser{str} -- parser type, default is html.parser
         session {Session} -- Session is being maintained over connection
+        cache {ResponseCache} -- persistent response cache the page goes through (see src/http_cache.py), if any
 
     Returns:
         success -- BeautifulSoup
@@ -42,7 +43,10 @@ def beautify(url: str, parser: str = "html.parser", session: requests.Session or
     """
     while True:
         try:
-            response = requests.get(url) if session is None else session.get(url)
+            if cache is not None:
+                response = cache.get(url, session)
+            else:
+                response = requests.get(url) if session is None else session.get(url)
             response.raise_for_status()
             return BeautifulSoup(response.text, parser)
         except requests.exceptions.HTTPError as e:
@@ -0,0 +1,248 @@
+"""
+Sidecar index of the byte offsets of every book and chapter in a verse table (t_*.csv).
+
+The index is a small binary file under DATA_CACHE_PATH, holding one entry per chapter
+run (a chapter's rows, contiguous in the csv): its book and chapter ids, the byte span
+of its rows in the csv, its number of (distinct) verses and its first and last verse ids. Like the
+table cache (see src/table_cache.py), it is stamped with the csv's mtime and size, and
+rebuilt with a single pass over the csv whenever they change.
+
+It answers which books and chapters a table contains, and how many verses they hold,
+without reading the csv, and range queries (a book, a span of chapters, a span of verses)
+only seek to and parse the rows of the chapters they need.
+"""
+
+from src.paths import DATA_CACHE_PATH, VERSE_INDEX_FORMAT
+from src.csv_keys import BOOK_KEY, CHAPTER_KEY, VERSE_KEY, TEXT_KEY
+
+# Standard libraries
+import csv, io, os, struct, tempfile
+from array import array
+from collections import namedtuple
+from pathlib import Path
+
+VERSE_INDEX_MAGIC = b'ALFINDEX'
+VERSE_INDEX_FORMAT_VERSION = 1
+
+# magic, format version, source mtime (ns), source size, # chapter runs
+VERSE_INDEX_HEADER = struct.Struct('=8sIqqQ')
+
+ChapterSpan = namedtuple('ChapterSpan', ['book', 'chapter', 'start', 'end', 'num_verses', 'first_verse', 'last_verse'])
+
+def _get_index_path(csv_path: Path) -> Path:
+    return DATA_CACHE_PATH / VERSE_INDEX_FORMAT.format(table = Path(csv_path).stem)
+
+def _iter_records(data: bytes, start: int):
+    """
+    Generator of (start, end) byte spans of the csv records of data from start on, newline
+    excluded. A newline only ends a record outside of quotes, i.e. once the record holds
+    an even number of quote characters.
+    """
+    size = len(data)
+
+    while start < size:
+        end = data.find(b'\n', start)
+        end = size if end == -1 else end
+
+        while data.count(b'"', start, end) % 2 == 1 and end < size:
+            next_end = data.find(b'\n', end + 1)
+            end = size if next_end == -1 else next_end
+
+        yield (start, end)
+        start = end + 1
+
+def build_verse_index(csv_path: Path, index_path: Path or None = None) -> [ChapterSpan]:
+    """
+    Scans a verse table csv file once and writes its index.
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+
+    Keyword Arguments:
+        index_path {Path or None} -- where to write the index (default: {None}, i.e. under DATA_CACHE_PATH)
+
+    Returns:
+        [ChapterSpan] -- the chapter runs of the table, in csv order
+    """
+    index_path = index_path or _get_index_path(csv_path)
+
+    stat = os.stat(csv_path)
+    data = Path(csv_path).read_bytes()
+
+    header_end = data.find(b'\n') + 1 or len(data)
+    headers = next(csv.reader([data[:header_end].decode('utf-8-sig')]))
+    book_index = headers.index(BOOK_KEY)
+    chapter_index = headers.index(CHAPTER_KEY)
+    verse_index = headers.index(VERSE_KEY)
+
+    spans = []
+    verse_ids = set()
+
+    for (start, end) in _iter_records(data, header_end):
+        if start == end or data[start:end] == b'\r':
+            continue
+
+        verse = next(csv.reader([data[start:end].decode('utf-8')]))
+        (book, chapter, verse_id) = (int(verse[book_index]), int(verse[chapter_index]), int(verse[verse_index]))
+
+        if spans and spans[-1][:2] == [book, chapter]:
+            span = spans[-1]
+            span[3] = end + 1
+            span[5] = min(span[5], verse_id)
+            span[6] = max(span[6], verse_id)
+        else:
+            span = [book, chapter, start, end + 1, 0, verse_id, verse_id]
+            spans.append(span)
+            verse_ids = set()
+
+        # repeated verse ids are counted once, as in get_book_mapping (the last row wins)
+        if verse_id not in verse_ids:
+            verse_ids.add(verse_id)
+            span[4] += 1
+
+    entries = array('q', (value for span in spans for value in span))
+    header = VERSE_INDEX_HEADER.pack(VERSE_INDEX_MAGIC, VERSE_INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size, len(spans))
+
+    index_path.parent.mkdir(parents = True, exist_ok = True)
+    fd, temp_path = tempfile.mkstemp(dir = index_path.parent, prefix = f'.{index_path.name}.')
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header + entries.tobytes())
+        os.replace(temp_path, index_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return [ChapterSpan(*span) for span in spans]
+
+def _read_verse_index(csv_path: Path, index_path: Path) -> [ChapterSpan] or None:
+    """ Returns the chapter runs stored in the index, or None if it is missing or out of date """
+    stat = os.stat(csv_path)
+
+    try:
+        with open(index_path, 'rb') as file:
+            (magic, version, mtime_ns, size, num_spans) = VERSE_INDEX_HEADER.unpack(file.read(VERSE_INDEX_HEADER.size))
+
+            if (magic, version, mtime_ns, size) != (VERSE_INDEX_MAGIC, VERSE_INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size):
+                return None
+
+            entries = array('q')
+            entries.frombytes(file.read(8 * len(ChapterSpan._fields) * num_spans))
+    except (OSError, struct.error, ValueError):
+        return None
+
+    if len(entries) != len(ChapterSpan._fields) * num_spans:
+        return None
+
+    width = len(ChapterSpan._fields)
+    return [ChapterSpan(*entries[i:i + width]) for i in range(0, len(entries), width)]
+
+def is_verse_index_fresh(csv_path: Path) -> bool:
+    """ Cheap check (one stat call and a header read) of whether the index of a verse table is up to date """
+    stat = os.stat(csv_path)
+
+    try:
+        with open(_get_index_path(csv_path), 'rb') as file:
+            (magic, version, mtime_ns, size, _) = VERSE_INDEX_HEADER.unpack(file.read(VERSE_INDEX_HEADER.size))
+    except (OSError, struct.error):
+        return False
+
+    return (magic, version, mtime_ns, size) == (VERSE_INDEX_MAGIC, VERSE_INDEX_FORMAT_VERSION, stat.st_mtime_ns, stat.st_size)
+
+class VerseIndex:
+    """
+    Books and chapters of a verse table, with the byte spans of their rows in the csv
+    (see the module docstring).
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+        spans {[ChapterSpan]} -- chapter runs of the table, in csv order
+    """
+
+    def __init__(self, csv_path: Path, spans: [ChapterSpan]):
+        self.csv_path = Path(csv_path)
+        self.spans = spans
+
+    @property
+    def books(self) -> [int]:
+        """ Sorted ids of the books contained by the table """
+        return sorted({ span.book for span in self.spans })
+
+    def chapters(self, book: int) -> [int]:
+        """ Sorted ids of the chapters of a book """
+        return sorted({ span.chapter for span in self.spans if span.book == book })
+
+    def num_verses(self, book: int or None = None, chapter: int or None = None) -> int:
+        """ Number of verses of the table, of a book, or of one of its chapters """
+        return sum(span.num_verses for span in self.get_spans(book, chapter))
+
+    def get_spans(self, book: int or None = None, chapters: int or (int, int) or None = None) -> [ChapterSpan]:
+        """
+        Chapter runs of a book (every book if None), restricted to a chapter or an inclusive
+        (first, last) span of chapters, in csv order.
+        """
+        (first, last) = (chapters, chapters) if isinstance(chapters, int) else (chapters or (None, None))
+
+        return [span for span in self.spans if
+            (book is None or span.book == book) and
+            (first is None or span.chapter >= first) and
+            (last is None or span.chapter <= last)]
+
+    def read_rows(self, book: int, chapters: int or (int, int) or None = None, verses: (int, int) or None = None) -> [(int, int, int, str)]:
+        """
+        Reads the rows of a book, restricted to a chapter or an inclusive (first, last) span
+        of chapters, and to an inclusive (first, last) span of verses within those chapters.
+        Only the byte spans of the selected chapters are read and parsed.
+
+        Returns:
+            [(int, int, int, str)] -- (book, chapter, verse, text) tuples, in csv order
+
+        Example usage:
+            index.read_rows(66, 6, (1, 10))
+            -> [(66, 6, 1, 'And I saw when the Lamb opened one of the seven seals, ...'), ...]
+        """
+        (first_verse, last_verse) = verses or (None, None)
+        spans = [span for span in self.get_spans(book, chapters) if
+            (first_verse is None or span.last_verse >= first_verse) and
+            (last_verse is None or span.first_verse <= last_verse)]
+
+        rows = []
+
+        with open(self.csv_path, 'rb') as file:
+            headers = next(csv.reader([file.readline().decode('utf-8-sig')]))
+            indexes = [headers.index(key) for key in (BOOK_KEY, CHAPTER_KEY, VERSE_KEY, TEXT_KEY)]
+
+            for span in spans:
+                file.seek(span.start)
+                chunk = file.read(span.end - span.start).decode('utf-8')
+
+                for verse in csv.reader(io.StringIO(chunk, newline = '')):
+                    if not verse:
+                        continue
+
+                    (book_id, chapter, verse_id, text) = (verse[i] for i in indexes)
+                    verse_id = int(verse_id)
+
+                    if (first_verse is None or verse_id >= first_verse) and (last_verse is None or verse_id <= last_verse):
+                        rows.append((int(book_id), int(chapter), verse_id, text))
+
+        return rows
+
+def load_verse_index(csv_path: Path) -> VerseIndex:
+    """
+    Returns the index of a verse table, building it first if it is missing or out of date.
+
+    Arguments:
+        csv_path {Path} -- path of the verse table (t_*.csv)
+
+    Returns:
+        VerseIndex
+    """
+    index_path = _get_index_path(csv_path)
+    spans = _read_verse_index(csv_path, index_path)
+
+    if spans is None:
+        spans = build_verse_index(csv_path, index_path)
+
+    return VerseIndex(csv_path, spans)
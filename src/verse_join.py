@@ -0,0 +1,191 @@
+"""
+Join engine for finding the verses shared between several verse tables.
+
+Verses are encoded as the packed integer id already used in the csv id column
+(book * 10^6 + chapter * 10^3 + verse). Each table's keys are sorted once, and
+the tables are intersected smallest first, so the candidate set only ever
+shrinks: memory grows with the intersection rather than the union of all
+tables. Texts are only pulled for the verses that survive the join, and
+filters on the precomputed features (see filter_joined_rows).
+"""
+
+from src.table_cache import VerseTable
+from src.preprocess import PreprocessFilter, PreprocessStats
+
+# Standard libraries
+from array import array
+from bisect import bisect_left
+from time import perf_counter
+
+# Third party libraries
+import numpy
+
+BOOK_ID_FACTOR = 10 ** 6
+CHAPTER_ID_FACTOR = 10 ** 3
+
+def encode_verse_id(book: int, chapter: int, verse: int) -> int:
+    """ i.e. encode_verse_id(1, 2, 3) -> 1002003 """
+    return book * BOOK_ID_FACTOR + chapter * CHAPTER_ID_FACTOR + verse
+
+def decode_verse_id(verse_id: int) -> (int, int, int):
+    """ i.e. decode_verse_id(1002003) -> (1, 2, 3) """
+    book, rest = divmod(verse_id, BOOK_ID_FACTOR)
+    chapter, verse = divmod(rest, CHAPTER_ID_FACTOR)
+    return book, chapter, verse
+
+def get_sorted_keys(table: VerseTable) -> (array, array, array):
+    """
+    Returns the sorted, unique packed verse ids of a table, along with the
+    row of the last and first occurrence of each id. The last row holds the
+    verse text (later rows override earlier ones, like in a dict), the first
+    row gives the verse's position in the table.
+
+    Returns:
+        (array('q') keys, array('i') last rows, array('i') first rows)
+    """
+    keys = array('q', map(encode_verse_id, table.books, table.chapters, table.verses))
+    order = range(len(keys))
+
+    if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+        # stable sort, so duplicate ids stay in row order
+        order = sorted(order, key = keys.__getitem__)
+
+    unique_keys, last_rows, first_rows = array('q'), array('i'), array('i')
+
+    for row in order:
+        key = keys[row]
+
+        if unique_keys and unique_keys[-1] == key:
+            last_rows[-1] = row
+        else:
+            unique_keys.append(key)
+            last_rows.append(row)
+            first_rows.append(row)
+
+    return unique_keys, last_rows, first_rows
+
+def _intersect(candidates: array, keys: array) -> (array, array):
+    """
+    Intersects two sorted key arrays, returning the positions in candidates and
+    in keys of every shared key. Binary searches over keys (narrowing the lower
+    bound as it goes), so cost is O(len(candidates) * log(len(keys))).
+    """
+    candidate_positions, key_positions = array('i'), array('i')
+    position = 0
+
+    for (candidate_position, key) in enumerate(candidates):
+        position = bisect_left(keys, key, position)
+
+        if position == len(keys):
+            break
+
+        if keys[position] == key:
+            candidate_positions.append(candidate_position)
+            key_positions.append(position)
+
+    return candidate_positions, key_positions
+
+def _take(values: array, positions: array) -> array:
+    return array(values.typecode, (values[p] for p in positions))
+
+def join_verse_tables(tables: [VerseTable]) -> (array, [array]):
+    """
+    Finds the verses shared by all the given tables.
+
+    Arguments:
+        tables {[VerseTable]} -- the tables to join
+
+    Returns:
+        (array('q') keys, [array('i') rows]) -- the shared packed verse ids (in the
+        first table's row order), and for each table (in argument order) the row
+        holding each shared verse's text
+    """
+    if len(tables) == 0:
+        return array('q'), []
+
+    # smallest tables first, so the candidate set is as small as possible from the start
+    order = sorted(range(len(tables)), key = lambda i: len(tables[i]))
+
+    candidates = None
+    first_table_rows = None
+    rows = {}
+
+    for i in order:
+        keys, last_rows, first_rows = get_sorted_keys(tables[i])
+
+        if candidates is None:
+            candidates, positions = keys, range(len(keys))
+        else:
+            candidate_positions, positions = _intersect(candidates, keys)
+            candidates = _take(candidates, candidate_positions)
+            rows = { j: _take(table_rows, candidate_positions) for (j, table_rows) in rows.items() }
+
+            if first_table_rows is not None:
+                first_table_rows = _take(first_table_rows, candidate_positions)
+
+        rows[i] = _take(last_rows, positions)
+
+        if i == 0:
+            first_table_rows = _take(first_rows, positions)
+
+    # restore the first table's row order
+    order = sorted(range(len(candidates)), key = first_table_rows.__getitem__)
+
+    return _take(candidates, order), [_take(rows[i], order) for i in range(len(tables))]
+
+def filter_joined_rows(tables: [VerseTable], keys: array, rows: [array], filters: [PreprocessFilter], stats: PreprocessStats or None = None) -> (array, [array]):
+    """
+    Applies preprocess filters to the output of join_verse_tables, using the feature columns
+    precomputed in the table cache instead of the texts. Each filter is one vectorized mask
+    over the joined rows of every table, so no text is decoded. Same result (and drop counts)
+    as running the filters in order on the raw texts, as long as they come before any transform.
+
+    Arguments:
+        tables {[VerseTable]} -- the joined tables
+        keys {array} -- the shared packed verse ids, as returned by join_verse_tables
+        rows {[array]} -- the rows of each table, as returned by join_verse_tables
+        filters {[PreprocessFilter]} -- the filters, in the order they would run
+
+    Keyword Arguments:
+        stats {PreprocessStats or None} -- collects per filter time and drop counts (default: {None})
+
+    Returns:
+        (array('q') keys, [array('i') rows]) -- the keys and rows of the verses passing every filter
+    """
+    if len(filters) == 0:
+        return keys, rows
+
+    row_indexes = [numpy.frombuffer(table_rows, dtype = numpy.intc) for table_rows in rows]
+    mask = numpy.ones(len(keys), dtype = bool)
+
+    for operation in filters:
+        start = perf_counter()
+        passed = mask.copy()
+
+        for (table, table_rows) in zip(tables, row_indexes):
+            values = numpy.frombuffer(table.column(operation.feature), dtype = numpy.intc)[table_rows]
+
+            if operation.min_value is not None:
+                passed &= values >= operation.min_value
+            if operation.max_value is not None:
+                passed &= values <= operation.max_value
+
+        dropped = int(numpy.count_nonzero(mask)) - int(numpy.count_nonzero(passed))
+        mask = passed
+
+        if stats is not None:
+            stats.seconds[operation.name] += perf_counter() - start
+            stats.dropped[operation.name] += dropped
+
+    positions = numpy.flatnonzero(mask)
+    keys = numpy.frombuffer(keys, dtype = numpy.int64)[positions]
+
+    return array('q', keys.tobytes()), [array('i', table_rows[positions].tobytes()) for table_rows in row_indexes]
+
+def iter_joined_texts(tables: [VerseTable], keys: array, rows: [array]):
+    """
+    Generator of (packed verse id, [text of each table]) for the output of
+    join_verse_tables. Texts are decoded lazily, one verse at a time.
+    """
+    for (position, key) in enumerate(keys):
+        yield key, [table.text(table_rows[position]) for (table, table_rows) in zip(tables, rows)]
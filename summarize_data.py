@@ -1,10 +1,13 @@
-from src.data_manager import get_bible_versions, get_versions_missing_books, get_bible_book_genres, get_bible_books, get_book_mapping
+from src.data_manager import get_bible_versions, get_versions_missing_books, get_bible_book_genres, get_bible_books, get_verse_index
 from src.data_manager import TESTAMENT_NAMES
+from src.catalog import get_catalog
+from src.near_duplicates import get_near_duplicate_report, NEAR_DUPLICATE_THRESHOLD
 
 # Additional libraries (pip install ...)
 import texttable
 
 DEFAULT_BIBLE_TABLE = 't_kjv'
+DEFAULT_NEAR_DUPLICATE_TABLES = ['t_asv', 't_kjv', 't_wbt']
 
 def _print_table(title: str, headers: [str], rows: [int or str], align: [str] or None = None):
     """
@@ -26,13 +29,16 @@ def _print_table(title: str, headers: [str], rows: [int or str], align: [str] or
     print(title)
     print(table.draw())
 
-def print_version_table():
+def print_version_table(max_workers: int or None = None):
     """
     Prints a table summarizing the different versions of the Bible and their
     available books.
+
+    Keyword Arguments:
+        max_workers {int or None} -- number of processes used to load the versions' tables (default: {None}, i.e. one per cpu)
     """
     bible_versions = get_bible_versions()
-    missing_books = get_versions_missing_books(bible_versions)
+    missing_books = get_versions_missing_books(bible_versions, max_workers)
 
     rows = [(
         version['id'],
@@ -47,9 +53,6 @@ def print_version_table():
         rows = rows
     )
 
-def _get_num_verses_in_book(book_mapping_book: {int: {int: str}}) -> int:
-    return sum(len(chapter) for chapter in book_mapping_book.values())
-
 def print_genre_table(table: str = DEFAULT_BIBLE_TABLE):
     """
     Prints a breakdown of the different bible genres for a given version table name,
@@ -61,15 +64,15 @@ def print_genre_table(table: str = DEFAULT_BIBLE_TABLE):
     books = get_bible_books()
     genres = get_bible_book_genres()
     version = next(filter(lambda v: v['table'] == table, get_bible_versions()))
-    book_mapping = get_book_mapping(version)
-    books = dict(filter(lambda kv: kv[0] in book_mapping, books.items()))
+    index = get_verse_index(version)
+    books = dict(filter(lambda kv: kv[0] in index.books, books.items()))
     book_genres = [book['genre_id'] for (book_id, book) in books.items()]
 
     rows = [(
         genre_id,
         genre,
         book_genres.count(genre_id),
-        f"{sum((_get_num_verses_in_book(book_mapping[book_id]) for (book_id, book) in books.items() if book['genre_id'] == genre_id)):,d}"
+        f"{sum((index.num_verses(book_id) for (book_id, book) in books.items() if book['genre_id'] == genre_id)):,d}"
     ) for (genre_id, genre) in sorted(genres.items())]
 
     _print_table(
@@ -90,15 +93,15 @@ def print_testament_table(table: str = DEFAULT_BIBLE_TABLE):
     books = get_bible_books()
     all_testament_labels = {book['testament'] for book in books.values()}
     version = next(filter(lambda v: v['table'] == table, get_bible_versions()))
-    book_mapping = get_book_mapping(version)
-    books = dict(filter(lambda kv: kv[0] in book_mapping, books.items()))
+    index = get_verse_index(version)
+    books = dict(filter(lambda kv: kv[0] in index.books, books.items()))
     testament_labels = [book['testament'] for (book_id, book) in books.items()]
 
     rows = [(
         testament_label,
         TESTAMENT_NAMES[testament_label],
         testament_labels.count(testament_label),
-        f"{sum((_get_num_verses_in_book(book_mapping[book_id]) for (book_id, book) in books.items() if book['testament'] == testament_label)):,d}"
+        f"{sum((index.num_verses(book_id) for (book_id, book) in books.items() if book['testament'] == testament_label)):,d}"
     ) for testament_label in sorted(all_testament_labels, reverse = True)]
 
     _print_table(
@@ -109,7 +112,7 @@ def print_testament_table(table: str = DEFAULT_BIBLE_TABLE):
     )
 
 def _get_genre_dataset_split(genre_id: int, dataset: str) -> int:
-    return len(list(filter(lambda book: book['genre_id'] == genre_id and book['dataset'] == dataset, get_bible_books().values())))
+    return len(get_catalog().get_book_ids(genre_id = genre_id, dataset = dataset))
 
 def print_genre_data_split_table():
     """
@@ -131,7 +134,7 @@ def print_genre_data_split_table():
     )
 
 def _get_testament_dataset_split(testament: str, dataset: str) -> int:
-    return len(list(filter(lambda book: book['testament'] == testament and book['dataset'] == dataset, get_bible_books().values())))
+    return len(get_catalog().get_book_ids(testament = testament, dataset = dataset))
 
 def print_testament_data_split_table():
     """
@@ -153,6 +156,30 @@ def print_testament_data_split_table():
         align = ['l', 'c']
     )
 
+def print_near_duplicate_table(tables: [str] = DEFAULT_NEAR_DUPLICATE_TABLES, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+    """
+    Prints, for every pair of the given bible version tables, how many of their shared verses
+    are near-duplicates, and how many near-duplicate pairs are different verses (see src/near_duplicates.py).
+
+    Keyword Arguments:
+        tables {[str]} -- the bible version table names (default: {DEFAULT_NEAR_DUPLICATE_TABLES})
+        threshold {float} -- minimum similarity of near-duplicates (default: {NEAR_DUPLICATE_THRESHOLD})
+    """
+    rows = [(
+        ' / '.join(pair['tables']),
+        f"{pair['shared_verses']:,d}",
+        f"{pair['aligned_duplicates']:,d}",
+        f"{pair['aligned_fraction']:.1%}",
+        f"{pair['other_duplicates']:,d}"
+    ) for pair in get_near_duplicate_report(tables, threshold)]
+
+    _print_table(
+        title = f'Near-Duplicate Verse Table (similarity >= {threshold})',
+        headers = ['versions', '# shared verses', '# near-duplicates', '% near-duplicates', '# other verse pairs'],
+        rows = rows,
+        align = ['l', 'r', 'r', 'r', 'r']
+    )
+
 def _print_summary_tables():
     print_version_table()
     print()
@@ -1,9 +1,10 @@
 # Standard Libraries
+import argparse
+import asyncio
 import csv
 from pathlib import Path
 import re
 import requests
-import time
 from urllib.parse import urljoin, urlparse, parse_qs
 
 # additional libraries (pip install ...)
@@ -12,7 +13,9 @@ from bs4 import BeautifulSoup
 
 # Local libraries
 from src.data_manager import get_bible_book_id_map
-from src.utils import make_tarball, beautify, get_links
+from src.utils import make_tarball, get_links
+from src.scraper import AsyncScraper, parse_html
+from src.http_cache import ResponseCache
 
 from src.data_manager import BOOK_KEY, CHAPTER_KEY, VERSE_KEY, TEXT_KEY, ID_KEY
 from src.paths import *
@@ -29,10 +32,16 @@ def _get_url_params(url: str) -> {str: [str]}:
     return parse_qs(parsed.query)
 
 
-def _collect_helsinki() -> None:
+async def _collect_helsinki(scraper: AsyncScraper, base_url: str = HELSINKI_CORPUS_URL) -> None:
     """
     Collects RAW XML from Helsinki Corpus and stores in directory 'data/raw/helsinki'
 
+    Args:
+        scraper {AsyncScraper} -- downloads the pages concurrently
+
+    Keyword Args:
+        base_url {str} -- base url of the corpus (default: {HELSINKI_CORPUS_URL})
+
     Returns:
         None
     """
@@ -40,38 +49,46 @@ def _collect_helsinki() -> None:
     HELSINKI_RAW_PATH.mkdir(parents = True, exist_ok = True)
 
     # extract table of contents with links
-    toc_url = urljoin(HELSINKI_CORPUS_URL, 'browse.py?fs=100')
-    hs = beautify(toc_url)
+    toc_url = urljoin(base_url, 'browse.py?fs=100')
+    hs = await scraper.parse(toc_url)
     toc = hs.find('div', attrs={'id': 'toc'}).find('ul')
     doc_links = get_links(toc, 'browse.py?')
 
-    for idx, (href, name) in enumerate(doc_links):
-        print(f'[{idx}/{len(doc_links)}] {name}')
-
+    async def collect_document(idx: int, href: str, name: str):
         # Format link name to acceptable filename
         fn = re.sub('[^A-Za-z0-9]+', '', name)
 
         params = _get_url_params(href)
         if 'text' not in params:
             print('Unable to retrieve text', name)
-            continue
+            return
 
-        doc_url = urljoin(HELSINKI_CORPUS_URL, f"hc_xml/{params['text'][0]}.xml")
-        print('\t  retrieving:', doc_url)
+        doc_url = urljoin(base_url, f"hc_xml/{params['text'][0]}.xml")
 
-        xml_doc = requests.get(doc_url)
-        if xml_doc is None:
+        try:
+            xml_doc = await scraper.parse(doc_url, _get_text)
+        except requests.exceptions.RequestException:
             print('Unable to retrieve text', name)
-            continue
+            return
+
+        print(f'[{idx}/{len(doc_links)}] {name}')
 
         with open(HELSINKI_RAW_PATH / f'{idx}_{fn}.xml', 'w') as file:
-            file.write(xml_doc.text)
+            file.write(xml_doc)
 
+    await asyncio.gather(*(collect_document(idx, href, name) for (idx, (href, name)) in enumerate(doc_links)))
 
-def _collect_me_prose() -> None:
+
+async def _collect_me_prose(scraper: AsyncScraper, base_url: str = MIDDLE_ENGLISH_PROSE_VERSE_URL) -> None:
     """
     Collects texts from Middle English Corpus and stores as txt files in 'data/raw/middle_english_prose'
 
+    Args:
+        scraper {AsyncScraper} -- downloads the pages concurrently
+
+    Keyword Args:
+        base_url {str} -- base url of the corpus (default: {MIDDLE_ENGLISH_PROSE_VERSE_URL})
+
     Returns:
         None
     """
@@ -79,93 +96,120 @@ def _collect_me_prose() -> None:
     MIDDLE_ENGLISH_PROSE_VERSE_RAW_PATH.mkdir(parents = True, exist_ok = True)
 
     # extract table of contents with links
-    me = beautify(urljoin(MIDDLE_ENGLISH_PROSE_VERSE_URL, '/c/cme/browse.html'))
+    me = await scraper.parse(urljoin(base_url, '/c/cme/browse.html'))
     toc = me.find('div', attrs={'class': 'maincontent'})
     doc_links = get_links(toc, '/c/cme/')
 
-    for idx, (href, name) in enumerate(doc_links):
-        print(f'[{idx}/{len(doc_links)}] {name}')
-
+    async def collect_document(idx: int, href: str, name: str):
         # Format link name to acceptable filename
         fn = re.sub('[^A-Za-z0-9]+', '', name)[: 101 if len(name) > 100 else len(name)]
 
-        doc_url = urljoin(MIDDLE_ENGLISH_PROSE_VERSE_URL, href + '/?rgn=main;view=fulltext')
-        print('\t  retrieving: ', doc_url)
+        doc_url = urljoin(base_url, href + '/?rgn=main;view=fulltext')
 
-        html_doc = beautify(doc_url)
-        if html_doc is None:
+        try:
+            content = await scraper.parse(doc_url, _get_document_content)
+        except requests.exceptions.RequestException:
             print('Unable to retrieve text', name)
-            continue
+            return
+
+        print(f'[{idx}/{len(doc_links)}] {name}')
 
-        content = html_doc.find('div', attrs={'id': 'doccontent'})
         with open(MIDDLE_ENGLISH_PROSE_VERSE_RAW_PATH / f'{idx}_{fn}.txt', 'w', encoding='utf-8') as file:
-            file.write(content.text)
+            file.write(content)
+
+    await asyncio.gather(*(collect_document(idx, href, name) for (idx, (href, name)) in enumerate(doc_links)))
+
+
+def _get_text(response: requests.Response) -> str:
+    return response.text
 
 
-def _collect_bible_study(url_path: str, csv_file: Path) -> None:
+def _get_document_content(response: requests.Response) -> str:
+    """ Text of a Middle English Corpus document page """
+    return parse_html(response).find('div', attrs={'id': 'doccontent'}).text
+
+
+def _get_chapter_verses(response: requests.Response) -> [str]:
+    """ Verses of a studybible.info chapter page, without their notes """
+    text = parse_html(response).find('div', attrs={'class': 'passage'})
+    # First and second entry are garbage
+    verses = [x.strip() for x in text.contents if not isinstance(x, bs4.element.Tag)][2:]
+    # Remove notes from the verses
+    return [re.sub(r'\[.*\]', '', v).strip() for v in verses]
+
+
+async def _collect_bible_study(scraper: AsyncScraper, url_path: str, csv_file: Path, base_url: str = STUDY_BIBLE_URL) -> None:
     """
     Function to generate csv file for bibles at studybible.com. Given the name of the bible and the csv_file,
     generates csv with format following the bible corpus structure
 
     Args:
+        scraper {AsyncScraper} -- downloads the pages concurrently
         url_path {str} -- part of url following the base URL (https://studybible.info/Wycliffe -> /Wycliffe)
         csv_file {Path} -- destination csv
 
+    Keyword Args:
+        base_url {str} -- base url of the site (default: {STUDY_BIBLE_URL})
+
     Returns:
         None
     """
-    # Set up a session
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'custom-user-agent'})
-
     # Get ids for books
     id_ref = get_bible_book_id_map()
 
     # extract the table of contents for all books
-    ws_url = urljoin(STUDY_BIBLE_URL, '/version' + url_path)
-    ws = beautify(ws_url, session=session)
+    ws_url = urljoin(base_url, '/version' + url_path)
+    ws = await scraper.parse(ws_url)
     toc = ws.find('div', attrs={'class': 'version_toc'})
-    books = get_links(toc, url_path)
+    books = [(ex, name) for (ex, name) in get_links(toc, url_path) if name.lower() in id_ref]
+
+    # extract chapters
+    book_pages = await scraper.map([urljoin(base_url, ex) for (ex, _) in books])
+    book_chapters = [get_links(bs.find('div', attrs={'class': 'book_toc'}), ex) for ((ex, _), bs) in zip(books, book_pages)]
+
+    async def collect_book(name: str, chapters: [(str, str)]) -> [[str]]:
+        verses = await scraper.map([urljoin(base_url, c) for (c, _) in chapters], _get_chapter_verses)
+        print('Downloaded', name)
+        return verses
+
+    book_verses = await asyncio.gather(*(collect_book(name, chapters) for ((_, name), chapters) in zip(books, book_chapters)))
+
     with open(csv_file, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
         # Write the title row
         writer.writerow([ID_KEY, BOOK_KEY, CHAPTER_KEY, VERSE_KEY, TEXT_KEY])
-        for ex, name in books:
-            if name.lower() not in id_ref:
-                continue
-            print('Downloading', name)
+        for ((_, name), chapters, chapter_verses) in zip(books, book_chapters, book_verses):
             book_id = id_ref[name.lower()]
-            # extract chapters
-            book_url = urljoin(STUDY_BIBLE_URL, ex)
-            bs = beautify(book_url, session=session)
-            toc = bs.find('div', attrs={'class': 'book_toc'})
-            chapters = get_links(toc, ex)
-
-            for c, c_num in chapters:
-                print('\tCAP. ', c_num)
+            for ((_, c_num), verses) in zip(chapters, chapter_verses):
                 c_id = int(c_num)
-                chapter_url = urljoin(STUDY_BIBLE_URL, c)
-                cs = beautify(chapter_url, session=session)
-                text = cs.find('div', attrs={'class': 'passage'})
-                # First and second entry are garbage
-                verses = [x.strip() for x in text.contents if not isinstance(x, bs4.element.Tag)][2:]
                 for i, v in enumerate(verses):
                     v_id = i+1
-                    # Remove notes from the verses
-                    v = re.sub(r'\[.*\]', '', v).strip()
                     writer.writerow([f'%d%03d%03d' % (book_id, c_id, v_id), book_id, c_id, v_id, v])
-                # delay to not overload server with requests
-                time.sleep(5)
 
 
-def _collect_raw_corpus():
-    """ Retrieve corpora and individual texts """
-    # collect the corpus
-    _collect_helsinki()
-    _collect_me_prose()
+async def _collect_corpora(scraper: AsyncScraper) -> None:
+    """ Collects the corpus and individual texts, concurrently (each site has its own rate limit) """
+    await asyncio.gather(
+        _collect_helsinki(scraper),
+        _collect_me_prose(scraper),
+        _collect_bible_study(scraper, '/WestSaxon1175', WEST_SAXON_GOSPEL_CSV_PATH)
+    )
+
+
+def _collect_raw_corpus(offline: bool = False, use_cache: bool = True):
+    """
+    Retrieve corpora and individual texts
+
+    Keyword Args:
+        offline {bool} -- whether to only use the cached responses, i.e. to re-parse the corpora (default: {False})
+        use_cache {bool} -- whether to go through the response cache in data/raw (default: {True})
+    """
+    cache = ResponseCache(offline = offline) if use_cache else None
+
+    with AsyncScraper(cache = cache) as scraper:
+        scraper.run(_collect_corpora(scraper))
 
-    # collect individual texts
-    _collect_bible_study('/WestSaxon1175', WEST_SAXON_GOSPEL_CSV_PATH)
+    cache is not None and print('Response cache:', cache.stats())
 
     # store raw-texts as tar files
     make_tarball(HELSINKI_RAW_TAR_PATH, HELSINKI_RAW_PATH)
@@ -173,4 +217,9 @@ def _collect_raw_corpus():
 
 
 if __name__ == '__main__':
-    _collect_raw_corpus()
+    parser = argparse.ArgumentParser(description = 'Scrapes the online corpora.')
+    parser.add_argument('--offline', action = 'store_true', help = 'only use cached responses (no network I/O)')
+    parser.add_argument('--no-cache', action = 'store_true', help = 'download every page, bypassing the response cache')
+    args = parser.parse_args()
+
+    _collect_raw_corpus(offline = args.offline, use_cache = not args.no_cache)